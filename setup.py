@@ -24,9 +24,16 @@ setuptools.setup(
     package_dir={"": "src"},
     install_requires=requirements,
     extras_require={
+        "pyproj": [
+            "pyproj>=3.1",
+        ],
+        "brotli": [
+            "brotli",
+        ],
         "tests": [
             "pytest",
             "flask-sqlalchemy",
+            "pyproj>=3.1",
         ],
     },
     setup_requires=["wheel"],
@@ -0,0 +1,339 @@
+"""
+Cache des résultats de requêtes géographiques
+
+Les résultats (GeoJSON sérialisé en bytes) sont stockés dans un backend
+(mémoire ou disque) avec une durée de vie et une éviction LRU.
+Chaque entrée est associée aux tables interrogées, ce qui permet de l'invalider
+lors d'une écriture dans l'une de ces tables (cf ``invalidate_tables``).
+
+Les écritures faites via une session sont invalidées au commit de celle-ci
+(cf ``track_tables``) : une invalidation au flush laisserait une requête concurrente
+remettre en cache les données d'avant le commit.
+Les ``Query.update()`` / ``Query.delete()`` en masse ne déclenchent pas les
+événements de l'ORM : l'appelant doit alors invalider lui-même les tables modifiées
+(``invalidate_tables`` après le commit, ou ``track_tables`` avant).
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import Mapping
+from threading import Lock
+from weakref import WeakSet
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+
+
+class CacheBackend(ABC):
+    """
+    Interface d'un backend de cache
+
+    Les valeurs sont des bytes, associées à une date d'expiration
+    et à la liste des tables dont elles dépendent.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """Renvoie la valeur associée à ``key`` ou None si absente ou expirée"""
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None, tables=()):
+        """Stocke ``value`` pour ``ttl`` secondes (sans expiration si None)"""
+        pass
+
+    @abstractmethod
+    def invalidate_tables(self, tables):
+        """Supprime les entrées dépendant d'une des tables ``tables``"""
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    Backend en mémoire (propre au processus), borné à ``maxsize`` entrées
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires, _ = entry
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None, tables=()):
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires, frozenset(tables))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate_tables(self, tables):
+        tables = set(tables)
+        with self._lock:
+            for key in [key for key, entry in self._data.items() if entry[2] & tables]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DiskCacheBackend(CacheBackend):
+    """
+    Backend sur disque (base sqlite), partageable entre processus,
+    borné à ``maxsize`` entrées
+
+    Parameters:
+        path (str): chemin du fichier sqlite
+        maxsize (int): nombre maximum d'entrées
+    """
+
+    def __init__(self, path, maxsize=1024):
+        self.path = path
+        self.maxsize = maxsize
+        self._lock = Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS cache_entry (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires REAL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_entry_last_access ON cache_entry (last_access);
+            CREATE TABLE IF NOT EXISTS cache_entry_table (
+                key TEXT NOT NULL REFERENCES cache_entry (key) ON DELETE CASCADE,
+                table_name TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cache_entry_table_name ON cache_entry_table (table_name);
+            """
+        )
+        self._connection.execute("PRAGMA foreign_keys=ON")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires FROM cache_entry WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= now:
+                self._connection.execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+                return None
+            self._connection.execute(
+                "UPDATE cache_entry SET last_access = ? WHERE key = ?", (now, key)
+            )
+            return row[0]
+
+    def set(self, key, value, ttl=None, tables=()):
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+            self._connection.execute(
+                "INSERT INTO cache_entry (key, value, expires, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, expires, now),
+            )
+            self._connection.executemany(
+                "INSERT INTO cache_entry_table (key, table_name) VALUES (?, ?)",
+                [(key, table) for table in set(tables)],
+            )
+            self._connection.execute(
+                """
+                DELETE FROM cache_entry WHERE key IN (
+                    SELECT key FROM cache_entry ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self.maxsize,),
+            )
+
+    def invalidate_tables(self, tables):
+        tables = list(set(tables))
+        if not tables:
+            return
+        with self._lock:
+            self._connection.execute(
+                f"""
+                DELETE FROM cache_entry WHERE key IN (
+                    SELECT key FROM cache_entry_table
+                    WHERE table_name IN ({", ".join("?" * len(tables))})
+                )
+                """,
+                tables,
+            )
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM cache_entry")
+
+
+_caches = WeakSet()
+
+
+class CachedJSON(Mapping):
+    """
+    Objet json mis en cache, conservé sous sa forme sérialisée (``data``, bytes)
+
+    geojsonify et geojsonify_stream l'envoient tel quel. Il n'est décodé (une fois)
+    qu'à la lecture de son contenu, comme celui d'un dictionnaire en lecture seule.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._value = None
+
+    @property
+    def value(self):
+        if self._value is None:
+            self._value = json.loads(self.data)
+        return self._value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __repr__(self):
+        return f"CachedJSON({self.data!r})"
+
+
+class QueryCache:
+    """
+    Cache de résultats de requêtes
+
+    Parameters:
+        backend (CacheBackend): backend de stockage. Defaults to MemoryCacheBackend()
+        ttl (int): durée de vie des entrées en secondes (None : pas d'expiration)
+    """
+
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.ttl = ttl
+        _caches.add(self)
+
+    @staticmethod
+    def make_key(*parts):
+        """Construit une clé à partir de ``parts`` (convertis en json)"""
+        data = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @classmethod
+    def statement_key(cls, statement, *parts):
+        """
+        Construit une clé à partir du SQL compilé (normalisé) et des paramètres
+        d'une requête (texte ou expression SQLAlchemy)
+        """
+        if isinstance(statement, str):
+            sql, params = statement, {}
+        else:
+            compiled = statement.compile(dialect=postgresql.dialect())
+            sql, params = str(compiled), compiled.params
+        sql = re.sub(r"\s+", " ", sql).strip()
+        return cls.make_key(sql, params, *parts)
+
+    @staticmethod
+    def statement_tables(statement):
+        """Noms des tables (avec schéma) interrogées par une expression SQLAlchemy"""
+        if isinstance(statement, str):
+            return set()
+        return {table_name(table) for table in find_tables(statement, include_joins=True)}
+
+    def get_or_set(self, key, factory, tables=()):
+        """
+        Renvoie les bytes associés à ``key``, en appelant ``factory()``
+        pour les construire s'ils sont absents du cache
+        """
+        value = self.backend.get(key)
+        if value is None:
+            value = factory()
+            self.backend.set(key, value, ttl=self.ttl, tables=tables)
+        return value
+
+    def get_or_set_json(self, key, factory, tables=()):
+        """As get_or_set, pour une valeur sérialisable en json"""
+        value = self.get_or_set(key, lambda: json.dumps(factory()).encode(), tables)
+        return json.loads(value)
+
+    def get_or_set_document(self, key, factory, tables=()):
+        """
+        As get_or_set_json, pour un objet json (dict) renvoyé sous sa forme sérialisée
+        (CachedJSON) : il est envoyé tel quel par geojsonify, sans être décodé
+        """
+        return CachedJSON(self.get_or_set(key, lambda: json.dumps(factory()).encode(), tables))
+
+    def invalidate(self, *tables):
+        self.backend.invalidate_tables(tables)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def table_name(table):
+    """Nom d'une table, préfixé par son schéma le cas échéant"""
+    schema = getattr(table, "schema", None)
+    return f"{schema}.{table.name}" if schema else table.name
+
+
+def invalidate_tables(*tables):
+    """Invalide les entrées dépendant des tables ``tables`` dans tous les caches"""
+    for cache in list(_caches):
+        cache.invalidate(*tables)
+
+
+# tables modifiées dans une session, invalidées lors de son commit
+_SESSION_TABLES = "utils_flask_sqla_geo.cache.tables"
+
+
+def track_tables(session, *tables):
+    """
+    Enregistre les tables ``tables`` comme modifiées dans la session ``session`` :
+    les entrées en dépendant seront invalidées au commit de la session
+    (et oubliées en cas de rollback)
+    """
+    session.info.setdefault(_SESSION_TABLES, set()).update(tables)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed_tables(session):
+    tables = session.info.pop(_SESSION_TABLES, None)
+    if tables:
+        invalidate_tables(*tables)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_tables(session):
+    session.info.pop(_SESSION_TABLES, None)
@@ -0,0 +1,153 @@
+"""
+Enrichissement spatial des exports
+
+Une couche de référence (communes, espaces protégés, etc.) est chargée une seule fois
+dans un index STRtree shapely. Chaque lot de géométries exportées est ensuite
+confronté à cet index de manière vectorisée pour y rattacher les attributs
+de l'entité qui le contient.
+"""
+
+from threading import Lock
+
+import numpy as np
+from shapely import STRtree
+
+from utils_flask_sqla_geo.utilsgeometry import elements_to_shapes, reproject
+
+
+class ReferenceLayer:
+    """
+    Couche de référence indexée dans un STRtree
+
+    Parameters:
+        geometries (list): géométries shapely (ou geoalchemy) de la couche
+        attributes (list): attributs (dict) de chaque entité de la couche
+        srid (int): srid des géométries de la couche
+    """
+
+    def __init__(self, geometries, attributes, srid=4326):
+        self.geometries = elements_to_shapes(geometries)
+        self.attributes = list(attributes)
+        if len(self.attributes) != len(self.geometries):
+            raise ValueError("geometries and attributes must have the same length")
+        self.srid = srid
+        self.tree = STRtree(self.geometries)
+
+    @classmethod
+    def from_query(cls, query, geometry_field, fields, srid=4326):
+        """
+        Charge une couche de référence à partir d'une requête (objets ou lignes SQLAlchemy)
+
+        Parameters:
+            query: requête (ou itérable) SQLAlchemy
+            geometry_field (str): nom de la colonne géométrique
+            fields (list): noms des attributs à conserver
+            srid (int): srid de la colonne géométrique
+        """
+        geometries, attributes = [], []
+        for row in query:
+            geometries.append(getattr(row, geometry_field))
+            attributes.append({field: getattr(row, field) for field in fields})
+        return cls(geometries, attributes, srid=srid)
+
+    def lookup(self, geometries, srid=None, predicate="within"):
+        """
+        Renvoie, pour chaque géométrie, l'indice de l'entité de la couche qui la contient
+        (la première en cas de recouvrement), ou -1
+
+        Parameters:
+            geometries: tableau de géométries shapely (None accepté)
+            srid (int): srid des géométries, reprojetées si différent de celui de la couche
+            predicate (str): prédicat spatial (cf shapely.STRtree.query)
+        """
+        geometries = np.asarray(geometries, dtype=object)
+        if srid and srid != self.srid:
+            geometries = reproject(geometries, srid, self.srid)
+        result = np.full(len(geometries), -1)
+        input_idx, tree_idx = self.tree.query(geometries, predicate=predicate)
+        # paires triées par géométrie puis par entité : en cas de recouvrement,
+        # seule la première paire de chaque géométrie (le plus petit indice) est retenue
+        order = np.lexsort((tree_idx, input_idx))
+        input_idx, first = np.unique(input_idx[order], return_index=True)
+        result[input_idx] = tree_idx[order][first]
+        return result
+
+
+_layers = {}
+_layers_lock = Lock()
+
+
+def get_reference_layer(name, loader, version=None):
+    """
+    Renvoie la couche de référence ``name`` depuis le cache du processus
+
+    La couche est (re)chargée avec ``loader()`` si elle est absente du cache
+    ou si ``version`` (ex : date de dernière modification de la table) a changé.
+    """
+    with _layers_lock:
+        cached = _layers.get(name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    layer = loader()
+    with _layers_lock:
+        _layers[name] = (version, layer)
+    return layer
+
+
+def invalidate_reference_layer(name=None):
+    """Supprime la couche ``name`` du cache (toutes les couches si ``name`` est None)"""
+    with _layers_lock:
+        if name is None:
+            _layers.clear()
+        else:
+            _layers.pop(name, None)
+
+
+class SpatialEnrichment:
+    """
+    Etape d'enrichissement d'un export : ajoute à chaque objet exporté
+    les attributs de l'entité de la couche de référence qui contient sa géométrie
+
+    Parameters:
+        layer (ReferenceLayer): couche de référence
+        fields (list): attributs de la couche à ajouter. Defaults to None (tous)
+        prefix (str): préfixe des noms des attributs ajoutés
+        predicate (str): prédicat spatial. Defaults to "within"
+    """
+
+    def __init__(self, layer, fields=None, prefix="", predicate="within"):
+        self.layer = layer
+        if fields is None:
+            fields = list(layer.attributes[0]) if layer.attributes else []
+        self.fields = list(fields)
+        self.prefix = prefix
+        self.predicate = predicate
+
+    @property
+    def output_fields(self):
+        """Noms des attributs ajoutés aux données exportées"""
+        return [self.prefix + field for field in self.fields]
+
+    def fiona_properties(self):
+        """Types fiona des attributs ajoutés, déduits des valeurs de la couche"""
+        properties = {}
+        for field, output_field in zip(self.fields, self.output_fields):
+            values = (attrs[field] for attrs in self.layer.attributes)
+            value = next((v for v in values if v is not None), None)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                properties[output_field] = "str"
+            else:
+                properties[output_field] = "int" if isinstance(value, int) else "float"
+        return properties
+
+    def enrich(self, geometries, results, srid=None):
+        """
+        Ajoute aux dictionnaires ``results`` les attributs de l'entité contenant
+        la géométrie correspondante (None si aucune)
+        """
+        attributes = self.layer.attributes
+        for result, idx in zip(results, self.layer.lookup(geometries, srid, self.predicate)):
+            attrs = attributes[idx] if idx >= 0 else {}
+            for field, output_field in zip(self.fields, self.output_fields):
+                result[output_field] = attrs.get(field)
+        return results
@@ -1,12 +1,32 @@
+import asyncio
 import csv
+import inspect
+import io
 import json
+import os
+import sqlite3
+from contextlib import ExitStack, closing, nullcontext
+from itertools import islice
 from typing import Type
 
 import fiona
 from fiona.crs import from_epsg
 
 from utils_flask_sqla_geo.schema import GeoAlchemyAutoSchema
-from utils_flask_sqla_geo.utilsgeometry import FIONA_MAPPING
+from utils_flask_sqla_geo.utils import CompressedWriter, StreamCompressor
+from utils_flask_sqla_geo.utilsgeometry import (
+    fiona_field,
+    open_gpkg,
+    properties_converter,
+    write_records,
+)
+
+
+def _compressed(fp, compression, compression_level):
+    """Enveloppe fp (fichier binaire) pour compresser à la volée si compression est précisé"""
+    if compression:
+        return CompressedWriter(fp, compression, compression_level)
+    return nullcontext(fp)
 
 
 def export_csv(
@@ -17,6 +37,10 @@ def export_csv(
     chunk_size: int = 1000,
     separator=";",
     geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
 ):
     """Exporte une generic query au format csv
 
@@ -31,7 +55,31 @@ def export_csv(
         chunk_size (int, optional): taille pour le traitement par lots. Defaults to 1000.
         separator (str, optional): sparateur pour le csv. Defaults to ";".
         geometry_field_name (_type_, optional): nom du champ pour la colonne geométrique. Defaults to None.
+        target_srid (int, optional): srid de reprojection de la géométrie (faite côté python). Defaults to None.
+        enrichments (list, optional): étapes d'enrichissement spatial (SpatialEnrichment). Defaults to [].
+        compression (str, optional): compression à la volée ("gzip" ou "br"), fp doit alors
+            être un fichier binaire. Defaults to None.
+        compression_level (int, optional): niveau de compression. Defaults to None.
     """
+    schema, csv_columns = _csv_schema(
+        schema_class, columns, geometry_field_name, target_srid, enrichments
+    )
+
+    # écriture du fichier cscv
+    with _compressed(fp, compression, compression_level) as fp:
+        writer = csv.DictWriter(
+            fp, csv_columns, delimiter=separator, quoting=csv.QUOTE_ALL, extrasaction="ignore"
+        )
+
+        writer.writeheader()  # ligne d'entête
+
+        # écriture des lignes dans le fichier csv
+        for line in schema.dump(query.yield_per(chunk_size), many=True):
+            writer.writerow(line)
+
+
+def _csv_schema(schema_class, columns, geometry_field_name, target_srid, enrichments):
+    """Schéma (instance partagée) et colonnes d'un export csv"""
     # gestion de only
     only = columns.copy()
 
@@ -39,21 +87,13 @@ def export_csv(
     if geometry_field_name:
         only.append(f"+{geometry_field_name}")
 
-    # instantiation du schema avec only
-    schema = schema_class(only=only or None)
-
-    csv_columns = list(schema.dump_fields.keys())
-
-    # écriture du fichier cscv
-    writer = csv.DictWriter(
-        fp, csv_columns, delimiter=separator, quoting=csv.QUOTE_ALL, extrasaction="ignore"
+    # instantiation du schema avec only (instance partagée)
+    schema = schema_class.cached(
+        only=only or None, target_srid=target_srid, enrichments=tuple(enrichments)
     )
 
-    writer.writeheader()  # ligne d'entête
-
-    # écriture des lignes dans le fichier csv
-    for line in schema.dump(query.yield_per(chunk_size), many=True):
-        writer.writerow(line)
+    csv_columns = list(schema.dump_fields.keys()) + schema.enrichment_fields
+    return schema, csv_columns
 
 
 def export_geojson(
@@ -63,6 +103,10 @@ def export_geojson(
     columns: list = [],
     chunk_size: int = 1000,
     geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
 ):
     """Exporte une generic query au format geojson
 
@@ -76,19 +120,78 @@ def export_geojson(
         columns (list, optioname): liste des colonnes à exporter. Defaults to [] (toutes les colonnes de la vue).
         chunk_size (int, optional): taille pour le traitement par lots. Defaults to 1000.
         geometry_field_name (_type_, optional): nom du champ pour la colonne geométrique. Defaults to None.
+        target_srid (int, optional): srid de reprojection de la géométrie (faite côté python). Defaults to None.
+        enrichments (list, optional): étapes d'enrichissement spatial (SpatialEnrichment). Defaults to [].
+        compression (str, optional): compression à la volée ("gzip" ou "br"), fp doit alors
+            être un fichier binaire. Defaults to None.
+        compression_level (int, optional): niveau de compression. Defaults to None.
     """
 
-    # instantiation du schema
-    schema = schema_class(
-        only=columns or None, as_geojson=True, feature_geometry=geometry_field_name
+    # instantiation du schema (instance partagée)
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
     )
 
     # serialisation
     feature_collection = schema.dump(query.yield_per(chunk_size), many=True)
 
     # écriture du ficher geojson
-    for chunk in json.JSONEncoder().iterencode(feature_collection):
-        fp.write(chunk)
+    with _compressed(fp, compression, compression_level) as fp:
+        for chunk in json.JSONEncoder().iterencode(feature_collection):
+            fp.write(chunk)
+
+
+def export_geojsonseq(
+    query,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    fp,
+    columns: list = [],
+    chunk_size: int = 1000,
+    geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
+    rfc8142: bool = True,
+):
+    """Exporte une generic query au format GeoJSON Text Sequence (RFC 8142)
+
+    une feature par ligne, précédée du séparateur d'enregistrement (RS),
+    écrite au fur et à mesure de la sérialisation : le fichier peut être lu
+    pendant l'export et reste exploitable s'il est interrompu
+
+    Args:
+        rfc8142 (bool, optional): préfixe les features du séparateur RS.
+            Si False, le fichier est au format NDJSON (cf export_ndjson). Defaults to True.
+        Pour les autres paramètres, voir export_geojson
+    """
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
+    )
+
+    feature_collection = schema.dump(query.yield_per(chunk_size), many=True)
+
+    encoder = json.JSONEncoder()
+    prefix = "\x1e" if rfc8142 else ""
+    with _compressed(fp, compression, compression_level) as fp:
+        for feature in feature_collection["features"]:
+            fp.write(prefix + encoder.encode(feature) + "\n")
+
+
+def export_ndjson(query, schema_class: Type[GeoAlchemyAutoSchema], fp, **kwargs):
+    """Exporte une generic query au format NDJSON (une feature GeoJSON par ligne)
+
+    Les paramètres sont ceux de export_geojsonseq
+    """
+    export_geojsonseq(query, schema_class, fp, rfc8142=False, **kwargs)
 
 
 def export_json(
@@ -98,6 +201,10 @@ def export_json(
     columns: list = [],
     chunk_size: int = 1000,
     geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
 ):
     """Exporte une generic query au format json
 
@@ -112,23 +219,31 @@ def export_json(
         chunk_size (int, optional): taille pour le traitement par lots. Defaults to 1000.
         separator (str, optional): sparateur pour le csv. Defaults to ";".
         geometry_field_name (_type_, optional): nom du champ pour la colonne geométrique. Defaults to None.
+        target_srid (int, optional): srid de reprojection de la géométrie (faite côté python). Defaults to None.
+        enrichments (list, optional): étapes d'enrichissement spatial (SpatialEnrichment). Defaults to [].
+        compression (str, optional): compression à la volée ("gzip" ou "br"), fp doit alors
+            être un fichier binaire. Defaults to None.
+        compression_level (int, optional): niveau de compression. Defaults to None.
     """
 
     # gestion de only
-    only = columns
+    only = columns.copy()
 
     # ajout du champs geométrique si demandé (sera exporté en WKT)
     if geometry_field_name:
         only.append(f"+{geometry_field_name}")
-    # instantiation du schema avec only
-    schema = schema_class(only=only or None)
+    # instantiation du schema avec only (instance partagée)
+    schema = schema_class.cached(
+        only=only or None, target_srid=target_srid, enrichments=tuple(enrichments)
+    )
 
     # serialisation
     iterable_data = schema.dump(query.yield_per(chunk_size), many=True)
 
     # écriture du fichier json
-    for chunk in json.JSONEncoder().iterencode(iterable_data):
-        fp.write(chunk)
+    with _compressed(fp, compression, compression_level) as fp:
+        for chunk in json.JSONEncoder().iterencode(iterable_data):
+            fp.write(chunk)
 
 
 def export_geopackage(
@@ -139,22 +254,730 @@ def export_geopackage(
     geometry_field_name=None,
     columns: list = [],
     chunk_size: int = 1000,
+    target_srid=None,
+    bulk: bool = False,
+    spatial_index: bool = True,
+    enrichments: list = [],
 ):
-    schema = schema_class(
-        only=columns or None, as_geojson=True, feature_geometry=geometry_field_name
+    """Exporte une generic query au format geopackage
+
+    Args:
+        srid (int): srid de la géométrie
+        target_srid (int, optional): srid de reprojection de la géométrie (faite côté python).
+            Defaults to None (pas de reprojection).
+        enrichments (list, optional): étapes d'enrichissement spatial (SpatialEnrichment),
+            les attributs ajoutés sont des colonnes supplémentaires du geopackage. Defaults to [].
+        bulk (bool, optional): mode écriture en masse : les features sont écrites par lots de
+            chunk_size dans de grandes transactions, sans journalisation ni écritures synchrones.
+            Defaults to False.
+        spatial_index (bool, optional): création de l'index spatial (construit en une fois
+            à la fin de l'écriture). Defaults to True.
+    """
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
     )
 
     feature_collection = schema.dump(query.yield_per(chunk_size), many=True)
 
+    gpkg_schema, convert_properties = _geopackage_schema(schema_class, columns, enrichments)
+
+    with open_gpkg(
+        filename,
+        gpkg_schema,
+        crs=from_epsg(target_srid or srid),
+        bulk=bulk,
+        spatial_index=spatial_index,
+    ) as f:
+        features = _convert_features(feature_collection["features"], convert_properties)
+        if bulk:
+            write_records(f, features, chunk_size)
+        else:
+            for feature in features:
+                f.write(feature)
+
+
+def export_geopackage_layers(
+    query,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    filename: str,
+    srid: int,
+    geometry_fields: list = None,
+    columns: list = [],
+    chunk_size: int = 1000,
+    target_srid=None,
+    bulk: bool = False,
+    spatial_index: bool = True,
+    enrichments: list = [],
+):
+    """Exporte une generic query dont le modèle a plusieurs colonnes géométriques
+    dans un geopackage, avec une couche par colonne géométrique
+
+    La requête est lue et sérialisée une seule fois : chaque objet est écrit dans chacune
+    des couches (nommées d'après les colonnes), avec les mêmes attributs.
+
+    Args:
+        srid (int): srid des géométries
+        geometry_fields (list, optional): colonnes géométriques à exporter.
+            Defaults to None (toutes les colonnes géométriques du modèle)
+        enrichments (list, optional): étapes d'enrichissement spatial (SpatialEnrichment),
+            basées sur la première colonne géométrique. Defaults to [].
+        autres arguments: cf export_geopackage
+    """
+    model = schema_class.Meta.model
+    if geometry_fields is None:
+        geometry_fields = [
+            col.key
+            for col in model.__mapper__.columns
+            if col.key in schema_class.opts.geometry_fields
+        ]
+    if not geometry_fields:
+        raise TypeError("Missing 'geometry_fields'")
+    # les colonnes géométriques autres que feature_geometry sont exclues par défaut
+    only = set(columns or schema_class._declared_fields) - schema_class.opts.geometry_fields
+    schema = schema_class.cached(
+        only=only | set(geometry_fields),
+        as_geojson=True,
+        feature_geometry=geometry_fields[0],
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
+    )
+
+    feature_collection = schema.dump(query.yield_per(chunk_size), many=True)
+
+    gpkg_schema, convert_properties = _geopackage_schema(schema_class, columns, enrichments)
+
+    with ExitStack() as stack:
+        layers = [
+            stack.enter_context(
+                open_gpkg(
+                    filename,
+                    gpkg_schema,
+                    crs=from_epsg(target_srid or srid),
+                    bulk=bulk,
+                    spatial_index=spatial_index,
+                    layer=field,
+                )
+            )
+            for field in geometry_fields
+        ]
+        features = iter(feature_collection["features"])
+        while True:
+            chunk = list(islice(features, chunk_size))
+            if not chunk:
+                break
+            records = [[] for _ in geometry_fields]
+            for feature in chunk:
+                properties = feature["properties"]
+                geometries = [feature["geometry"]]
+                geometries.extend(properties.pop(field) for field in geometry_fields[1:])
+                if convert_properties is not None:
+                    properties = convert_properties(properties)
+                for layer_records, geometry in zip(records, geometries):
+                    layer_records.append({"geometry": geometry, "properties": properties})
+            for layer, layer_records in zip(layers, records):
+                layer.writerecords(layer_records)
+
+
+def _geopackage_schema(schema_class, columns, enrichments):
+    """
+    Schéma fiona d'un export geopackage et fonction de conversion des propriétés
+    (None si aucune conversion n'est nécessaire)
+    """
     # FIXME: filter tableDef columns with columns
-    properties = {
-        db_col.key: FIONA_MAPPING.get(db_col.type.__class__.__name__.lower(), "str")
-        for db_col in schema_class.Meta.model.__table__.columns
-        if not db_col.type.__class__.__name__ == "Geometry"
-        and (not columns or db_col.key in columns)
-    }
+    # types fiona natifs et fonctions de conversion des valeurs, déterminés une fois par export
+    properties, converters = {}, {}
+    for db_col in schema_class.Meta.model.__table__.columns:
+        if db_col.type.__class__.__name__ == "Geometry" or (columns and db_col.key not in columns):
+            continue
+        properties[db_col.key], converters[db_col.key] = fiona_field(db_col.type, "GPKG")
+    for enrichment in enrichments:
+        properties.update(enrichment.fiona_properties())
     gpkg_schema = {"geometry": "Unknown", "properties": properties}
+    return gpkg_schema, properties_converter(converters) if converters else None
 
-    with fiona.open(filename, "w", "GPKG", schema=gpkg_schema, crs=from_epsg(srid)) as f:
-        for feature in feature_collection["features"]:
-            f.write(feature)
+
+def _convert_features(features, convert_properties):
+    if convert_properties is None:
+        return features
+    return (
+        {**feature, "properties": convert_properties(feature["properties"])}
+        for feature in features
+    )
+
+
+# tags (métadonnées GDAL de la couche) des exports incrémentaux
+DELTA_FIELD_TAG = "delta_update_field"
+DELTA_MARK_TAG = "delta_high_water_mark"
+
+
+def _read_delta_mark(filename, layer, update_field, sql_type, gpkg_schema):
+    """
+    Renvoie la marque (valeur maximale de update_field) du précédent export incrémental,
+    ou None si le fichier doit être reconstruit (absent, autre champ, schéma modifié)
+    """
+    if not os.path.exists(filename) or layer not in fiona.listlayers(filename):
+        return None
+    with fiona.open(filename, layer=layer) as f:
+        tags = f.tags()
+        if tags.get(DELTA_FIELD_TAG) != update_field or DELTA_MARK_TAG not in tags:
+            return None
+        if list(f.schema["properties"]) != list(gpkg_schema["properties"]):
+            return None
+    return _parse_value(tags[DELTA_MARK_TAG], sql_type)
+
+
+def _format_value(value):
+    """Valeur (clé, date de mise à jour) sous forme de texte, cf _parse_value"""
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def _parse_value(value, sql_type):
+    """Valeur python d'une colonne de type sql_type à partir de sa forme texte"""
+    python_type = sql_type.python_type
+    if hasattr(python_type, "fromisoformat"):  # date, datetime
+        return python_type.fromisoformat(value)
+    return python_type(value)
+
+
+def _quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _gpkg_key_function(sql_type):
+    """
+    Fonction normalisant en texte les valeurs d'une colonne, converties comme lors de l'écriture
+    dans le geopackage (cf fiona_field), pour les comparer aux valeurs relues avec fiona
+    """
+    _, converter = fiona_field(sql_type, "GPKG")
+
+    def key(value):
+        if value is None:
+            return None
+        if converter is not None:
+            value = converter(value)
+        return _format_value(value)
+
+    return key
+
+
+def _delete_outdated(filename, layer, pk_field, key, updated_pks, max_fid, source_pks):
+    """
+    Supprime du geopackage les anciennes versions (fid <= max_fid) des lignes mises à jour
+    et les lignes absentes de la source. Renvoie le nombre de lignes supprimées de la source.
+
+    Les clés sont comparées après normalisation par key (cf _gpkg_key_function).
+    Les suppressions sont faites directement en SQL (SQLite), par fid : l'index spatial
+    et le nombre de features sont mis à jour par les triggers du geopackage.
+    """
+    updated_keys = {key(value) for value in updated_pks}
+    source_keys = {key(value) for value in source_pks}
+    outdated, deleted = [], []
+    with fiona.open(filename, layer=layer, include_fields=[pk_field], ignore_geometry=True) as f:
+        for feature in f:
+            fid, value = int(feature.id), key(feature["properties"][pk_field])
+            if value not in source_keys:
+                deleted.append((fid,))
+            elif fid <= max_fid and value in updated_keys:
+                outdated.append((fid,))
+    with closing(sqlite3.connect(filename)) as connection, connection:
+        connection.executemany(f"DELETE FROM {_quote(layer)} WHERE rowid = ?", outdated + deleted)
+    return len(deleted)
+
+
+def export_geopackage_delta(
+    query,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    filename: str,
+    srid: int,
+    update_field: str,
+    geometry_field_name=None,
+    columns: list = [],
+    chunk_size: int = 1000,
+    target_srid=None,
+    pk_field=None,
+    layer=None,
+    overlap=None,
+):
+    """Exporte une generic query au format geopackage de manière incrémentale
+
+    Le premier export écrit toutes les lignes et enregistre dans les métadonnées
+    de la couche la valeur maximale de update_field (marque). Les exports suivants
+    n'interrogent que les lignes dont update_field est supérieur à la marque :
+    elles sont ajoutées au fichier et remplacent leur version précédente (même clé primaire),
+    les lignes absentes de la requête sont supprimées.
+    La couche est reconstruite si son schéma ou update_field ont changé
+    (les autres couches du fichier sont conservées).
+
+    Les lignes dont update_field est NULL ne sont exportées que lors d'une reconstruction.
+    Une ligne validée après l'export précédent mais dont update_field est inférieur
+    ou égal à la marque (ex : date de mise à jour fixée au début d'une longue transaction)
+    n'est pas exportée : overlap permet de ré-interroger les lignes dont update_field est
+    supérieur à marque - overlap, elles remplacent alors leur version précédente.
+
+    Args:
+        srid (int): srid de la géométrie
+        update_field (str): colonne de date (ou de numéro de version) de mise à jour
+        pk_field (str, optional): clé primaire, identifiant les lignes dans le geopackage.
+            Defaults to None (clé primaire du modèle)
+        layer (str, optional): nom de la couche. Defaults to None (nom du fichier)
+        overlap (optional): marge soustraite à la marque (ex : timedelta(minutes=10)
+            pour une date, ou un entier pour un numéro de version). Defaults to None
+    Returns:
+        dict: {"full": reconstruction complète, "upserted": lignes écrites,
+            "deleted": lignes supprimées car absentes de la requête}
+    """
+    model = schema_class.Meta.model
+    pk_field = pk_field or model.__mapper__.primary_key[0].key
+    if columns and pk_field not in columns:
+        raise ValueError(f"Primary key '{pk_field}' must be exported")
+    layer = layer or os.path.splitext(os.path.basename(filename))[0]
+    update_col = getattr(model, update_field)
+
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+    )
+    gpkg_schema, convert_properties = _geopackage_schema(schema_class, columns, ())
+
+    mark = _read_delta_mark(filename, layer, update_field, update_col.type, gpkg_schema)
+    full = mark is None
+    state = {"mark": mark, "pks": []}
+
+    def track(objects):
+        for o in objects:
+            value = getattr(o, update_field)
+            if value is not None and (state["mark"] is None or value > state["mark"]):
+                state["mark"] = value
+            state["pks"].append(getattr(o, pk_field))
+            yield o
+
+    if full:
+        if os.path.exists(filename) and layer in fiona.listlayers(filename):
+            fiona.remove(filename, layer=layer)
+        objects = query.yield_per(chunk_size)
+        collection = open_gpkg(
+            filename, gpkg_schema, crs=from_epsg(target_srid or srid), bulk=True, layer=layer
+        )
+    else:
+        with closing(sqlite3.connect(filename)) as connection:
+            max_fid = connection.execute(f"SELECT max(rowid) FROM {_quote(layer)}").fetchone()[0]
+        since = mark - overlap if overlap else mark
+        objects = query.filter(update_col > since).yield_per(chunk_size)
+        collection = fiona.open(filename, "a", layer=layer)
+
+    with collection as f:
+        features = schema.dump(track(objects), many=True)["features"]
+        write_records(f, _convert_features(features, convert_properties), chunk_size)
+        if state["mark"] is not None:
+            mark = state["mark"]
+            f.update_tags({DELTA_FIELD_TAG: update_field, DELTA_MARK_TAG: _format_value(mark)})
+
+    deleted = 0
+    if not full:
+        pk_col = getattr(model, pk_field)
+        source_pks = {row[0] for row in query.order_by(None).with_entities(pk_col)}
+        deleted = _delete_outdated(
+            filename,
+            layer,
+            pk_field,
+            _gpkg_key_function(pk_col.type),
+            state["pks"],
+            max_fid or 0,
+            source_pks,
+        )
+    return {"full": full, "upserted": len(state["pks"]), "deleted": deleted}
+
+
+class ExportCheckpoint:
+    """
+    Point de reprise d'un export, enregistré dans un fichier json
+
+    Parameters:
+        path (str): chemin du fichier de reprise
+        every (int): fréquence d'enregistrement, en nombre de lots écrits
+    """
+
+    def __init__(self, path, every=10):
+        self.path = path
+        self.every = every
+
+    def load(self):
+        """Renvoie l'état enregistré ou None"""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, state):
+        # écriture atomique : l'état précédent est conservé en cas d'interruption
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _iter_keyset(query, pk_col, after, chunk_size):
+    """
+    Parcourt une requête par lots, triés selon la clé primaire et sélectionnés
+    par pagination par clé (pk > dernière clé du lot précédent), à partir de la clé after
+    """
+    query = query.order_by(None).order_by(pk_col)
+    while True:
+        chunk_query = query if after is None else query.filter(pk_col > after)
+        chunk = list(chunk_query.limit(chunk_size))
+        if not chunk:
+            return
+        yield chunk
+        after = getattr(chunk[-1], pk_col.key)
+
+
+def _resume_state(checkpoint, pk_col, columns):
+    """Etat enregistré par le point de reprise, s'il correspond au même export (colonnes)"""
+    state = checkpoint.load()
+    if state is None or state["columns"] != columns:
+        return None
+    state["key"] = _parse_value(state["key"], pk_col.type)
+    return state
+
+
+def export_csv_resumable(
+    query,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    filename: str,
+    checkpoint: ExportCheckpoint = None,
+    pk_field=None,
+    columns: list = [],
+    chunk_size: int = 1000,
+    separator=";",
+    geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+):
+    """Exporte une generic query au format csv, avec reprise après interruption
+
+    Les lignes sont lues par lots triés selon la clé primaire (pagination par clé).
+    Tous les checkpoint.every lots, la dernière clé écrite et la taille du fichier
+    sont enregistrées : si l'export est interrompu, un nouvel appel tronque le fichier
+    à cette taille et reprend après cette clé. Le point de reprise est supprimé
+    à la fin de l'export.
+
+    Args:
+        filename (str): chemin du fichier csv
+        checkpoint (ExportCheckpoint, optional): point de reprise.
+            Defaults to None (fichier <filename>.checkpoint)
+        pk_field (str, optional): clé primaire. Defaults to None (clé primaire du modèle)
+        autres arguments: cf export_csv
+    Returns:
+        dict: {"resumed": export repris, "count": nombre total de lignes exportées}
+    """
+    checkpoint = checkpoint or ExportCheckpoint(f"{filename}.checkpoint")
+    model = schema_class.Meta.model
+    pk_col = getattr(model, pk_field or model.__mapper__.primary_key[0].key)
+    schema, csv_columns = _csv_schema(
+        schema_class, columns, geometry_field_name, target_srid, enrichments
+    )
+
+    state = _resume_state(checkpoint, pk_col, csv_columns)
+    if (
+        state is not None
+        and os.path.exists(filename)
+        and os.path.getsize(filename) >= state["offset"]
+    ):
+        fp = open(filename, "r+", newline="", encoding="utf-8")
+        fp.seek(state["offset"])
+        fp.truncate()
+    else:
+        state = None
+        fp = open(filename, "w", newline="", encoding="utf-8")
+    resumed = state is not None
+    key, count = (state["key"], state["count"]) if resumed else (None, 0)
+
+    with fp:
+        writer = csv.DictWriter(
+            fp, csv_columns, delimiter=separator, quoting=csv.QUOTE_ALL, extrasaction="ignore"
+        )
+        if not resumed:
+            writer.writeheader()
+        for n, chunk in enumerate(_iter_keyset(query, pk_col, key, chunk_size), 1):
+            writer.writerows(schema.dump(chunk, many=True))
+            count += len(chunk)
+            if n % checkpoint.every == 0:
+                fp.flush()
+                os.fsync(fp.fileno())
+                checkpoint.save(
+                    {
+                        "columns": csv_columns,
+                        "key": _format_value(getattr(chunk[-1], pk_col.key)),
+                        "offset": fp.tell(),
+                        "count": count,
+                    }
+                )
+    checkpoint.clear()
+    return {"resumed": resumed, "count": count}
+
+
+def export_geopackage_resumable(
+    query,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    filename: str,
+    srid: int,
+    checkpoint: ExportCheckpoint = None,
+    pk_field=None,
+    geometry_field_name=None,
+    columns: list = [],
+    chunk_size: int = 1000,
+    target_srid=None,
+    spatial_index: bool = True,
+    enrichments: list = [],
+):
+    """Exporte une generic query au format geopackage, avec reprise après interruption
+
+    Comme pour export_csv_resumable, les lignes sont lues par pagination par clé et
+    la dernière clé écrite et le nombre de features sont enregistrés tous les
+    checkpoint.every lots (chaque lot est écrit dans une transaction). A la reprise, les
+    features écrites après le point de reprise sont supprimées avant de continuer.
+
+    L'index spatial d'un geopackage étant construit à la fermeture du fichier,
+    un export repris est recopié à la fin pour le construire.
+
+    Args:
+        srid (int): srid de la géométrie
+        checkpoint (ExportCheckpoint, optional): point de reprise.
+            Defaults to None (fichier <filename>.checkpoint)
+        pk_field (str, optional): clé primaire. Defaults to None (clé primaire du modèle)
+        autres arguments: cf export_geopackage
+    Returns:
+        dict: {"resumed": export repris, "count": nombre total de features exportées}
+    """
+    checkpoint = checkpoint or ExportCheckpoint(f"{filename}.checkpoint")
+    model = schema_class.Meta.model
+    pk_col = getattr(model, pk_field or model.__mapper__.primary_key[0].key)
+    layer = os.path.splitext(os.path.basename(filename))[0]
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
+    )
+    gpkg_schema, convert_properties = _geopackage_schema(schema_class, columns, enrichments)
+
+    state = _resume_state(checkpoint, pk_col, list(gpkg_schema["properties"]))
+    if state is not None and os.path.exists(filename):
+        # suppression des features écrites après le point de reprise
+        with closing(sqlite3.connect(filename)) as connection, connection:
+            # (les fid, en AUTOINCREMENT, croissent dans l'ordre d'écriture)
+            table = _quote(layer)
+            connection.execute(
+                f"DELETE FROM {table} WHERE rowid > "
+                f"(SELECT rowid FROM {table} ORDER BY rowid LIMIT 1 OFFSET ?)",
+                [state["count"] - 1],
+            )
+        collection = fiona.open(filename, "a", layer=layer)
+    else:
+        state = None
+        collection = open_gpkg(
+            filename,
+            gpkg_schema,
+            crs=from_epsg(target_srid or srid),
+            spatial_index=spatial_index,
+            layer=layer,
+        )
+    resumed = state is not None
+    key, count = (state["key"], state["count"]) if resumed else (None, 0)
+
+    with collection as f:
+        for n, chunk in enumerate(_iter_keyset(query, pk_col, key, chunk_size), 1):
+            features = schema.dump(chunk, many=True)["features"]
+            f.writerecords(list(_convert_features(features, convert_properties)))
+            count += len(chunk)
+            if n % checkpoint.every == 0:
+                checkpoint.save(
+                    {
+                        "columns": list(gpkg_schema["properties"]),
+                        "key": _format_value(getattr(chunk[-1], pk_col.key)),
+                        "count": count,
+                    }
+                )
+
+    if resumed and spatial_index:
+        tmp_filename = f"{filename}.tmp"
+        with fiona.open(filename, layer=layer) as src, open_gpkg(
+            tmp_filename, src.schema, crs=src.crs, bulk=True, layer=layer
+        ) as dst:
+            write_records(dst, src, chunk_size)
+        os.replace(tmp_filename, filename)
+    checkpoint.clear()
+    return {"resumed": resumed, "count": count}
+
+
+class _AsyncSink:
+    """Ecriture (éventuellement compressée) de texte dans un flux binaire asynchrone"""
+
+    def __init__(self, sink, compression=None, compression_level=None):
+        self.sink = sink
+        self.compressor = StreamCompressor(compression, compression_level) if compression else None
+
+    async def _write(self, data):
+        if not data:
+            return
+        result = self.sink.write(data)
+        if inspect.isawaitable(result):
+            await result
+
+    async def write(self, text):
+        data = text.encode("utf-8")
+        if self.compressor:
+            data = self.compressor.compress(data)
+        await self._write(data)
+
+    async def close(self):
+        if self.compressor:
+            await self._write(self.compressor.flush())
+
+
+async def _iter_partitions(session, statement, chunk_size):
+    """Lots d'objets (ou de lignes) d'une requête select exécutée en flux par une AsyncSession"""
+    descriptions = statement.column_descriptions
+    result = await session.stream(statement.execution_options(yield_per=chunk_size))
+    if len(descriptions) == 1 and isinstance(descriptions[0]["expr"], type):
+        # select(Model) : on récupère les objets plutôt que des lignes
+        result = result.scalars()
+    async for partition in result.partitions(chunk_size):
+        yield partition
+
+
+async def export_csv_async(
+    session,
+    statement,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    sink,
+    columns: list = [],
+    chunk_size: int = 1000,
+    separator=";",
+    geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
+):
+    """Version asynchrone de export_csv
+
+    La requête est exécutée en flux par une AsyncSession, la sérialisation
+    de chaque lot (géométries comprises) est faite dans un thread
+    pour ne pas bloquer la boucle d'évènements.
+
+    Args:
+        session (AsyncSession): session asynchrone
+        statement (Select): requete select
+        sink: flux binaire asynchrone (méthode write, éventuellement coroutine)
+        Pour les autres paramètres, voir export_csv
+    """
+    only = columns.copy()
+    if geometry_field_name:
+        only.append(f"+{geometry_field_name}")
+    schema = schema_class.cached(
+        only=only or None, target_srid=target_srid, enrichments=tuple(enrichments)
+    )
+    csv_columns = list(schema.dump_fields.keys()) + schema.enrichment_fields
+
+    def encode(rows=None):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(
+            buffer, csv_columns, delimiter=separator, quoting=csv.QUOTE_ALL, extrasaction="ignore"
+        )
+        if rows is None:
+            writer.writeheader()
+        else:
+            writer.writerows(schema.dump(rows, many=True))
+        return buffer.getvalue()
+
+    sink = _AsyncSink(sink, compression, compression_level)
+    await sink.write(encode())
+    async for rows in _iter_partitions(session, statement, chunk_size):
+        await sink.write(await asyncio.to_thread(encode, rows))
+    await sink.close()
+
+
+async def export_geojson_async(
+    session,
+    statement,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    sink,
+    columns: list = [],
+    chunk_size: int = 1000,
+    geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
+):
+    """Version asynchrone de export_geojson (cf export_csv_async)"""
+    schema = schema_class.cached(
+        only=columns or None,
+        as_geojson=True,
+        feature_geometry=geometry_field_name,
+        target_srid=target_srid,
+        enrichments=tuple(enrichments),
+    )
+    encoder = json.JSONEncoder()
+
+    def encode(rows):
+        return ", ".join(map(encoder.encode, schema.dump(rows, many=True)["features"]))
+
+    sink = _AsyncSink(sink, compression, compression_level)
+    await sink.write('{"type": "FeatureCollection", "features": [')
+    separator = ""
+    async for rows in _iter_partitions(session, statement, chunk_size):
+        await sink.write(separator + await asyncio.to_thread(encode, rows))
+        separator = ", "
+    await sink.write("]}")
+    await sink.close()
+
+
+async def export_json_async(
+    session,
+    statement,
+    schema_class: Type[GeoAlchemyAutoSchema],
+    sink,
+    columns: list = [],
+    chunk_size: int = 1000,
+    geometry_field_name=None,
+    target_srid=None,
+    enrichments: list = [],
+    compression=None,
+    compression_level=None,
+):
+    """Version asynchrone de export_json (cf export_csv_async)"""
+    only = columns.copy()
+    if geometry_field_name:
+        only.append(f"+{geometry_field_name}")
+    schema = schema_class.cached(
+        only=only or None, target_srid=target_srid, enrichments=tuple(enrichments)
+    )
+    encoder = json.JSONEncoder()
+
+    def encode(rows):
+        return ", ".join(map(encoder.encode, schema.dump(rows, many=True)))
+
+    sink = _AsyncSink(sink, compression, compression_level)
+    await sink.write("[")
+    separator = ""
+    async for rows in _iter_partitions(session, statement, chunk_size):
+        await sink.write(separator + await asyncio.to_thread(encode, rows))
+        separator = ", "
+    await sink.write("]")
+    await sink.close()
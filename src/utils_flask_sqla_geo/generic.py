@@ -1,24 +1,85 @@
+import hashlib
+import json
 from itertools import chain
 from typing import Union
 from warnings import warn
 
-from sqlalchemy import func
+from sqlalchemy import cast, func, literal_column, select
+from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape
 from geojson import Feature, FeatureCollection
 from utils_flask_sqla.generic import GenericQuery, GenericTable
 from utils_flask_sqla.schema import SmartRelationshipsMixin
 
+from utils_flask_sqla_geo.cache import QueryCache, table_name, track_tables
+from utils_flask_sqla_geo.ingest import bulk_insert_geofeatures
 from utils_flask_sqla_geo.schema import GeoAlchemyAutoSchema
-from utils_flask_sqla_geo.utilsgeometry import create_shapes_generic, export_geodata_as_file
+from utils_flask_sqla_geo.serializers import GeoFeature, sqla_query_to_grid_geojson
+from utils_flask_sqla_geo.utilsgeometry import (
+    create_shapes_generic,
+    export_geodata_as_file,
+    elements_to_shapes,
+    geometries_bbox,
+    reproject,
+    grid_cell_size,
+    cluster_grid,
+)
+
+
+# nombre de décimales des coordonnées, identique à la sérialisation par geojson
+GEOJSON_PRECISION = 6
+# nom de la colonne ST_AsGeoJSON ajoutée à la requête (cf GenericQueryGeo sql_geojson)
+GEOJSON_COLUMN = "_geojson"
+
+
+def load_sql_geojson(text):
+    """
+    Décode une géométrie encodée par ST_AsGeoJSON
+
+    PostGIS écrit les coordonnées entières sans décimale (ex : 0), elles sont lues
+    en float pour que la sérialisation soit identique à celle de geojson (ex : 0.0).
+    """
+    return json.loads(text, parse_int=float)
+
+
+# cache des emprises, par table (invalidé au commit des écritures, cf track_tables)
+EXTENT_CACHE = QueryCache(ttl=3600)
 
 
 def get_geojson_feature(wkb):
-    """retourne une feature geojson à partir d'un WKB"""
+    """
+    retourne une feature geojson à partir d'un WKB
+    ou d'une géométrie déjà encodée en GeoJSON (texte issu de ST_AsGeoJSON)
+    """
+    if isinstance(wkb, str):
+        return GeoFeature(geometry=load_sql_geojson(wkb), properties={})
     geometry = to_shape(wkb)
     feature = Feature(geometry=geometry, properties={})
     return feature
 
 
+def extent_bounds(bind, extent, srid):
+    """
+    Renvoie les bornes [xmin, ymin, xmax, ymax] en 4326 d'une emprise (box2d) calculée en SQL,
+    ou None si l'emprise est nulle (table vide, statistiques absentes)
+
+    Parameters:
+        bind: connexion ou session SQLAlchemy
+        extent: expression SQL de l'emprise (ex : ST_Extent, ST_EstimatedExtent)
+        srid (int): srid de l'emprise
+    """
+    geom = func.ST_SetSRID(cast(extent, Geometry), srid)
+    if srid != 4326:
+        geom = func.ST_Transform(geom, 4326)
+    geom = select(geom.label("geom")).subquery().c.geom
+    bounds = bind.execute(
+        select(func.ST_XMin(geom), func.ST_YMin(geom), func.ST_XMax(geom), func.ST_YMax(geom))
+    ).one()
+    if bounds[0] is None:
+        return None
+    return [float(bound) for bound in bounds]
+
+
 class GenericTableGeo(GenericTable):
     """
     Classe permettant de créer à la volée un mapping
@@ -36,10 +97,53 @@ class GenericTableGeo(GenericTable):
             except KeyError:
                 raise KeyError("field {} doesn't exists".format(geometry_field))
 
+        self.engine = engine
         self.geometry_field = geometry_field
         self.srid = srid
 
-    def as_geofeature(self, data, columns=[], fields=[]):
+    def extent(self, cache=EXTENT_CACHE):
+        """
+        Renvoie l'emprise [xmin, ymin, xmax, ymax] en 4326 de la table (None si vide)
+
+        Sous PostgreSQL, l'emprise est estimée à partir des statistiques de la table
+        (ST_EstimatedExtent, mises à jour par ANALYZE), à défaut calculée avec ST_Extent.
+        Pour les autres bases (ex : tests), elle est calculée côté python.
+
+        Parameters:
+            cache (QueryCache): cache des emprises (None : pas de cache)
+        """
+        if not self.geometry_field:
+            raise TypeError("Missing 'geometry_field'")
+        if cache is not None:
+            key = cache.make_key("extent", table_name(self.tableDef), self.geometry_field)
+            return cache.get_or_set_json(
+                key, lambda: self.extent(cache=None), tables=[table_name(self.tableDef)]
+            )
+
+        col = self.tableDef.columns[self.geometry_field]
+        srid = self.srid or 4326
+        with self.engine.connect() as connection:
+            if connection.dialect.name != "postgresql":
+                geometries = elements_to_shapes(row[0] for row in connection.execute(select(col)))
+                return geometries_bbox(reproject(geometries, srid, 4326))
+            estimated = func.ST_EstimatedExtent(
+                self.tableDef.schema or "public", self.tableDef.name, col.name
+            )
+            bounds = extent_bounds(connection, estimated, srid)
+            if bounds is None:
+                bounds = extent_bounds(
+                    connection, select(func.ST_Extent(col)).scalar_subquery(), srid
+                )
+            return bounds
+
+    def as_geofeature(self, data, columns=[], fields=[], geojson_col=None):
+        """
+        Renvoie la feature geojson d'une ligne
+
+        Parameters:
+            geojson_col (str): colonne contenant la géométrie déjà encodée en GeoJSON
+                (ST_AsGeoJSON), utilisée telle quelle au lieu de décoder le WKB
+        """
         fields = list(chain(fields, columns))
         if columns:
             warn(
@@ -47,7 +151,12 @@ class GenericTableGeo(GenericTable):
                 "directly in 'fields' argument.",
                 DeprecationWarning,
             )
-        if getattr(data, self.geometry_field) is not None:
+        if getattr(data, geojson_col or self.geometry_field) is not None:
+            if geojson_col is not None:
+                return GeoFeature(
+                    geometry=load_sql_geojson(getattr(data, geojson_col)),
+                    properties=self.as_dict(data, fields),
+                )
             geometry = to_shape(getattr(data, self.geometry_field))
             return Feature(geometry=geometry, properties=self.as_dict(data, fields))
 
@@ -126,10 +235,17 @@ class GenericQueryGeo(GenericQuery):
         offset=0,
         geometry_field=None,
         srid=None,
+        sql_geojson=False,
     ):
+        """
+        sql_geojson: les géométries sont encodées en GeoJSON par PostGIS (ST_AsGeoJSON)
+            et utilisées par as_geofeature sans décoder le WKB (même sérialisation, hormis
+            d'éventuels écarts d'arrondi à la 6e décimale entre PostGIS et python)
+        """
         super().__init__(DB, tableName, schemaName, filters, limit, offset)
 
         self.geometry_field = geometry_field
+        self.sql_geojson = sql_geojson
         self.view = GenericTableGeo(
             tableName=tableName,
             schemaName=schemaName,
@@ -139,17 +255,61 @@ class GenericQueryGeo(GenericQuery):
         )
         self.srid = srid
 
-    def as_geofeature(self):
+    def raw_query(self, process_filter=True):
+        q = super().raw_query(process_filter=process_filter)
+        if self.sql_geojson and self.geometry_field:
+            col = self.view.tableDef.columns[self.geometry_field]
+            # la géométrie n'est sélectionnée qu'encodée en GeoJSON (pas de WKB à transférer)
+            columns = [column for column in self.view.tableDef.columns if column is not col]
+            # options 0 : pas de crs dans le GeoJSON, comme pour la sérialisation python
+            q = q.with_entities(
+                *columns, func.ST_AsGeoJSON(col, GEOJSON_PRECISION, 0).label(GEOJSON_COLUMN)
+            )
+        return q
+
+    def as_geofeature(self, cache=None, bbox=False):
+        """
+        Lance la requête et renvoie les résultats (FeatureCollection si geometry_field)
+        dans un format standard
+
+        Parameters:
+            cache (QueryCache): cache des résultats, par table, filtres, limit et offset
+                (le résultat est alors un CachedJSON, envoyé tel quel par geojsonify)
+            bbox (bool): ajout de l'emprise des résultats (membre bbox de la FeatureCollection)
+        """
+        if cache is not None:
+            key = cache.make_key(
+                "GenericQueryGeo",
+                self.schemaName,
+                self.tableName,
+                self.geometry_field,
+                sorted((str(k), str(v)) for k, v in dict(self.filters).items()),
+                self.limit,
+                self.offset,
+                bbox,
+            )
+            return cache.get_or_set_document(
+                key, lambda: self.as_geofeature(bbox=bbox), tables=[table_name(self.view.tableDef)]
+            )
+
         data, nb_result_without_filter, nb_results = self.query()
 
         if self.geometry_field:
+            geojson_col = GEOJSON_COLUMN if self.sql_geojson else None
+            data = [d for d in data if getattr(d, geojson_col or self.geometry_field) is not None]
             results = FeatureCollection(
-                [
-                    self.view.as_geofeature(d)
-                    for d in data
-                    if getattr(d, self.geometry_field) is not None
-                ]
+                [self.view.as_geofeature(d, geojson_col=geojson_col) for d in data]
             )
+            if bbox:
+                # emprise dans le srid des géométries renvoyées
+                if self.sql_geojson:
+                    geometries = (feature["geometry"] for feature in results["features"])
+                else:
+                    geometries = elements_to_shapes(getattr(d, self.geometry_field) for d in data)
+                extent = geometries_bbox(geometries)
+                # pas de membre bbox pour une collection vide (RFC 7946)
+                if extent is not None:
+                    results["bbox"] = extent
         else:
             results = [self.view.as_dict(d) for d in data]
 
@@ -189,6 +349,22 @@ class GenericQueryGeo(GenericQuery):
 
         return Model
 
+    def bulk_insert_geofeatures(self, features, upsert=False, chunk_size=10000):
+        """
+        Insère en masse des features geojson (en 4326) dans la table
+        (cf utils_flask_sqla_geo.ingest.bulk_insert_geofeatures)
+        """
+        count = bulk_insert_geofeatures(
+            self.DB.session,
+            self.view.tableDef,
+            features,
+            geometry_field=self.geometry_field,
+            upsert=upsert,
+            chunk_size=chunk_size,
+        )
+        track_tables(self.DB.session, table_name(self.view.tableDef))
+        return count
+
     def get_marshmallow_schema(self, pk_name: Union[str, None] = None):
         """
         renvoie un marshmalow schema à partir d'un modèle
@@ -220,6 +396,183 @@ class GenericQueryGeo(GenericQuery):
     def return_query(self):
         return self.as_geofeature()
 
+    def filtered_query(self):
+        """
+        Renvoie la requête avec les filtres appliqués, sans tri ni pagination
+        """
+        q = self.DB.session.query(self.view.tableDef)
+        if self.filters:
+            q = self.build_query_filters(q, self.filters)
+        return q
+
+    def extent(self, filters=None, cache=EXTENT_CACHE):
+        """
+        Renvoie l'emprise [xmin, ymin, xmax, ymax] en 4326 des résultats filtrés (None si vide)
+
+        Sans filtre, l'emprise de la table est renvoyée (estimée, cf GenericTableGeo.extent),
+        sinon elle est calculée avec ST_Extent (côté python pour les autres bases)
+
+        Parameters:
+            filters (dict): filtres à appliquer. Defaults to None (filtres de la requête)
+            cache (QueryCache): cache des emprises (None : pas de cache)
+        """
+        if not self.geometry_field:
+            raise TypeError("Missing 'geometry_field'")
+        filters = self.filters if filters is None else filters
+        if not filters:
+            return self.view.extent(cache=cache)
+        if cache is not None:
+            key = cache.make_key(
+                "extent",
+                table_name(self.view.tableDef),
+                self.geometry_field,
+                sorted((str(k), str(v)) for k, v in dict(filters).items()),
+            )
+            return cache.get_or_set_json(
+                key,
+                lambda: self.extent(filters, cache=None),
+                tables=[table_name(self.view.tableDef)],
+            )
+
+        col = self.view.tableDef.columns[self.geometry_field]
+        srid = self.srid or 4326
+        query = self.build_query_filters(self.DB.session.query(self.view.tableDef), filters)
+        if self.DB.session.get_bind().dialect.name != "postgresql":
+            geometries = elements_to_shapes(row[0] for row in query.with_entities(col))
+            return geometries_bbox(reproject(geometries, srid, 4326))
+        extent = query.with_entities(func.ST_Extent(col)).scalar_subquery()
+        return extent_bounds(self.DB.session, extent, srid)
+
+    def cache_validators(self, update_field=None):
+        """
+        Calcule à moindre coût les valideurs HTTP (ETag, Last-Modified) des résultats
+        de la requête, sans les charger, à passer à geojsonify ou geojsonify_stream
+
+        Avec update_field, seul max(update_field) est calculé (un index sur la colonne
+        permet de l'obtenir sans parcourir les lignes) : les suppressions de lignes ne
+        modifient alors pas les valideurs, ni les mises à jour d'une même journée pour
+        une colonne de type Date.
+
+        Parameters:
+            update_field (str): colonne de date de mise à jour (ex : meta_update_date).
+                Si None, le marqueur de transaction PostgreSQL xmin est utilisé, avec
+                le nombre de lignes (non disponible pour les vues)
+        Returns:
+            dict: {"etag": ..., "last_modified": ...}
+        """
+        if update_field:
+            entities = (func.max(self.view.tableDef.columns[update_field]),)
+        else:
+            entities = (func.max(literal_column("xmin::text::bigint")), func.count())
+        marker, *count = (
+            self.filtered_query().with_entities(*entities).select_from(self.view.tableDef).one()
+        )
+        state = (
+            self.schemaName,
+            self.tableName,
+            sorted((str(k), str(v)) for k, v in dict(self.filters).items()),
+            self.limit,
+            self.offset,
+            str(marker),
+            *count,
+        )
+        return {
+            "etag": hashlib.sha1(repr(state).encode()).hexdigest(),
+            "last_modified": marker if update_field else None,
+        }
+
+    def as_clusters(self, bbox, zoom, method="grid", cells_per_tile=8):
+        """
+        Regroupe les géométries de la requête filtrée situées dans une emprise
+        et renvoie une feature (centroïde) par groupe avec le nombre d'éléments regroupés
+
+        Sous PostgreSQL, les regroupements sont calculés en SQL (grille ou ST_ClusterDBSCAN),
+        pour les autres bases (ex : tests), les géométries sont regroupées par grille côté python.
+
+        Parameters:
+            bbox (tuple): emprise (xmin, ymin, xmax, ymax) en 4326
+            zoom (int): niveau de zoom de la carte, détermine la taille des regroupements
+            method (str): "grid" ou "dbscan"
+            cells_per_tile (int): nombre de regroupements par tuile (en largeur)
+        Returns:
+            FeatureCollection
+        """
+        if method not in ("grid", "dbscan"):
+            raise ValueError(f"Unsupported clustering method '{method}'")
+        if not self.geometry_field:
+            raise TypeError("Missing 'geometry_field'")
+        cell_size = grid_cell_size(zoom, cells_per_tile)
+        srid = self.srid or 4326
+        col = self.view.tableDef.columns[self.geometry_field]
+
+        if self.DB.session.get_bind().dialect.name == "postgresql":
+            envelope = func.ST_MakeEnvelope(*bbox, 4326)
+            if srid != 4326:
+                envelope = func.ST_Transform(envelope, srid)
+            subquery = self.filtered_query().where(func.ST_Intersects(col, envelope)).subquery()
+            geom = subquery.c[self.geometry_field]
+            if srid != 4326:
+                geom = func.ST_Transform(geom, 4326)
+            if method == "grid":
+                centroid = func.ST_Centroid(geom)
+                # arrondi floor(x + 0.5), identique à celui de cluster_grid
+                geoms = select(
+                    geom.label("geom"),
+                    func.floor(func.ST_X(centroid) / cell_size + 0.5).label("cx"),
+                    func.floor(func.ST_Y(centroid) / cell_size + 0.5).label("cy"),
+                ).subquery()
+                group_by = (geoms.c.cx, geoms.c.cy)
+            else:
+                geoms = select(
+                    geom.label("geom"),
+                    func.ST_ClusterDBSCAN(geom, cell_size, 1).over().label("cluster_id"),
+                ).subquery()
+                group_by = (geoms.c.cluster_id,)
+            statement = select(
+                func.count().label("count"),
+                func.ST_AsGeoJSON(func.ST_Centroid(func.ST_Collect(geoms.c.geom))),
+            ).group_by(*group_by)
+            clusters = [
+                (json.loads(geometry), count)
+                for count, geometry in self.DB.session.execute(statement)
+            ]
+        else:
+            query = self.filtered_query().with_entities(col).where(col.isnot(None))
+            geometries = elements_to_shapes(row[0] for row in query)
+            geometries = reproject(geometries, srid, 4326)
+            clusters = cluster_grid(geometries, cell_size, bbox=bbox)
+
+        return FeatureCollection(
+            [
+                Feature(geometry=geometry, properties={"count": count})
+                for geometry, count in clusters
+            ]
+        )
+
+    def as_grid(self, size, shape="hexagon", aggregates=None):
+        """
+        Agrège les résultats de la requête filtrée dans une grille hexagonale ou carrée
+        (cf sqla_query_to_grid_geojson)
+
+        Parameters:
+            size (float): taille des cellules, dans l'unité du srid de la table
+            shape (str): "hexagon" ou "square"
+            aggregates (dict): agrégats à calculer, {nom_propriete: (fonction, nom_colonne)}
+        Returns:
+            FeatureCollection
+        """
+        if not self.geometry_field:
+            raise TypeError("Missing 'geometry_field'")
+        return sqla_query_to_grid_geojson(
+            self.DB.session,
+            self.filtered_query().statement,
+            self.geometry_field,
+            size,
+            shape=shape,
+            aggregates=aggregates,
+            geom_srid=self.srid or 4326,
+        )
+
     def build_query_filter(self, query, param_name, param_value):
         query = super().build_query_filter(query, param_name, param_value)
 
@@ -0,0 +1,234 @@
+"""
+Import en masse de features GeoJSON
+
+Les géométries sont converties en EWKB de manière vectorisée (shapely),
+puis les lignes sont envoyées par lots :
+    - sous PostgreSQL avec ``COPY ... FROM STDIN`` (format csv), directement dans la table
+      ou dans une table temporaire puis fusionnées (upsert) ;
+    - pour les autres bases, avec des INSERT multi-lignes (upsert avec ``ON CONFLICT``
+      sous SQLite, par UPDATE des lignes existantes puis INSERT des autres ailleurs).
+"""
+
+import io
+import json
+from itertools import islice
+from uuid import uuid4
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from geoalchemy2.elements import WKBElement
+from sqlalchemy import and_, bindparam, column, select, table as sql_table, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import text
+
+from utils_flask_sqla_geo.utilsgeometry import reproject
+
+
+def features_to_rows(features, columns, geometry_field, srid=4326):
+    """
+    Convertit des features GeoJSON (en 4326) en lignes (dict) dont la géométrie
+    est en EWKB hexadécimal, en 2D (cf remove_third_dimension) et dans le srid ``srid``
+
+    Parameters:
+        features (list): features GeoJSON
+        columns (list): noms des colonnes (hors géométrie) à renseigner depuis les properties,
+            les colonnes absentes des properties d'une feature ne sont pas renseignées
+        geometry_field (str): nom de la colonne géométrique
+        srid (int): srid de la colonne géométrique
+    """
+    features = list(features)
+    geometries = np.array(
+        [
+            shape(feature["geometry"]) if feature.get("geometry") is not None else None
+            for feature in features
+        ],
+        dtype=object,
+    )
+    geometries = shapely.force_2d(geometries)
+    if srid != 4326:
+        geometries = reproject(geometries, 4326, srid)
+    geometries = shapely.to_wkb(
+        shapely.set_srid(geometries, srid), hex=True, include_srid=True
+    ).tolist()
+    rows = []
+    for feature, geometry in zip(features, geometries):
+        properties = feature.get("properties") or {}
+        row = {col: properties[col] for col in columns if col in properties}
+        row[geometry_field] = geometry
+        rows.append(row)
+    return rows
+
+
+#: colonne de la table temporaire donnant le rang des lignes dans le lot (cf _insert_rows)
+STAGING_RANK = "_staging_rank"
+
+
+def _csv_value(value):
+    # valeur vide non quotée : NULL, valeur quotée : texte (cf COPY ... FORMAT csv)
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def rows_to_csv(rows, columns):
+    """Encode des lignes au format csv attendu par ``COPY ... FROM STDIN``"""
+    return "".join(",".join(_csv_value(row[col]) for col in columns) + "\n" for row in rows)
+
+
+def _copy(connection, table_name, columns, rows):
+    quoted_columns = ", ".join(f'"{col}"' for col in columns)
+    statement = f"COPY {table_name} ({quoted_columns}) FROM STDIN WITH (FORMAT csv)"
+    data = rows_to_csv(rows, columns)
+    with connection.connection.cursor() as cursor:
+        if hasattr(cursor, "copy_expert"):  # psycopg2
+            cursor.copy_expert(statement, io.StringIO(data))
+        else:  # psycopg 3
+            with cursor.copy(statement) as copy:
+                copy.write(data)
+
+
+def _on_conflict_update(statement, columns, primary_key):
+    """Ajoute la mise à jour des lignes existantes (upsert) à un INSERT postgresql ou sqlite"""
+    return statement.on_conflict_do_update(
+        index_elements=primary_key,
+        set_={col: statement.excluded[col] for col in columns if col not in primary_key},
+    )
+
+
+def _merge_rows(connection, target, columns, rows, primary_key):
+    """
+    Upsert générique (bases sans ``ON CONFLICT``) : mise à jour des lignes existantes
+    puis insertion des autres, la dernière ligne l'emportant en cas de clé en double
+    """
+    if not all(col in columns for col in primary_key):
+        # clé primaire non renseignée (ex : serial) : aucune ligne existante à mettre à jour
+        connection.execute(target.insert().values(rows))
+        return
+    rows = list({tuple(row[col] for col in primary_key): row for row in rows}.values())
+    keys = [tuple(row[col] for col in primary_key) for row in rows]
+    key_columns = [target.c[col] for col in primary_key]
+    if len(key_columns) == 1:
+        criterion = key_columns[0].in_([key[0] for key in keys])
+    else:
+        criterion = tuple_(*key_columns).in_(keys)
+    existing = {tuple(key) for key in connection.execute(select(*key_columns).where(criterion))}
+    update_columns = [col for col in columns if col not in primary_key]
+    updates = [row for row, key in zip(rows, keys) if key in existing]
+    if updates and update_columns:
+        # paramètres préfixés pour ne pas être confondus avec les colonnes de la table
+        params = {col: bindparam(f"_upsert_{col}", type_=target.c[col].type) for col in columns}
+        statement = (
+            target.update()
+            .where(and_(*(target.c[col] == params[col] for col in primary_key)))
+            .values({col: params[col] for col in update_columns})
+        )
+        connection.execute(
+            statement, [{f"_upsert_{col}": row[col] for col in columns} for row in updates]
+        )
+    inserts = [row for row, key in zip(rows, keys) if key not in existing]
+    if inserts:
+        connection.execute(target.insert().values(inserts))
+
+
+def _insert_rows(connection, target, columns, rows, geometry_field, srid, upsert):
+    """Insère des lignes renseignant toutes les mêmes colonnes (cf bulk_insert_geofeatures)"""
+    target_name = connection.dialect.identifier_preparer.format_table(target)
+    primary_key = [col.key for col in target.primary_key]
+    if connection.dialect.name == "postgresql":
+        if not upsert:
+            _copy(connection, target_name, columns, rows)
+            return
+        # table temporaire limitée aux colonnes renseignées (sans contraintes),
+        # avec le rang de chaque ligne dans le lot
+        staging_name = f"_staging_{target.name}_{uuid4().hex[:8]}"
+        quoted_columns = ", ".join(f'"{col}"' for col in columns)
+        connection.execute(
+            text(
+                f'CREATE TEMPORARY TABLE "{staging_name}" ON COMMIT DROP AS '
+                f'SELECT {quoted_columns}, 0::bigint AS "{STAGING_RANK}" '
+                f"FROM {target_name} WITH NO DATA"
+            )
+        )
+        _copy(
+            connection,
+            f'"{staging_name}"',
+            columns + [STAGING_RANK],
+            [dict(row, **{STAGING_RANK: rank}) for rank, row in enumerate(rows)],
+        )
+        staging = sql_table(staging_name, *(column(col) for col in columns + [STAGING_RANK]))
+        query = select(*(staging.c[col] for col in columns))
+        if all(col in columns for col in primary_key):
+            # une clé en double dans le lot ferait échouer ON CONFLICT DO UPDATE
+            # ("cannot affect row a second time") : la dernière ligne l'emporte
+            key = [staging.c[col] for col in primary_key]
+            query = query.distinct(*key).order_by(*key, staging.c[STAGING_RANK].desc())
+        statement = postgresql.insert(target).from_select(columns, query)
+        connection.execute(_on_conflict_update(statement, columns, primary_key))
+        connection.execute(text(f'DROP TABLE "{staging_name}"'))
+        return
+    # autres bases : INSERT multi-lignes
+    for row in rows:
+        if row[geometry_field] is not None:
+            row[geometry_field] = WKBElement(row[geometry_field], srid=srid, extended=True)
+    if not upsert:
+        connection.execute(target.insert().values(rows))
+    elif connection.dialect.name == "sqlite":
+        statement = _on_conflict_update(sqlite.insert(target).values(rows), columns, primary_key)
+        connection.execute(statement)
+    else:
+        _merge_rows(connection, target, columns, rows, primary_key)
+
+
+def bulk_insert_geofeatures(
+    session,
+    model,
+    features,
+    geometry_field="geom",
+    upsert=False,
+    chunk_size=10000,
+):
+    """
+    Insère en masse des features GeoJSON (en 4326) dans la table d'un modèle
+
+    Seules les colonnes présentes dans les properties sont renseignées : les autres prennent
+    leur valeur par défaut (ex : clé primaire serial) et ne sont pas modifiées par l'upsert.
+
+    Parameters:
+        session: session SQLAlchemy
+        model: modèle (ex : décoré par @geoserializable ou GenericQueryGeo.get_model()) ou table
+        features: features GeoJSON (itérable ou FeatureCollection)
+        geometry_field (str): nom de la colonne géométrique
+        upsert (bool): mise à jour des lignes existantes (même clé primaire),
+            la dernière feature l'emportant en cas de clé en double dans un lot
+        chunk_size (int): taille des lots
+    Returns:
+        int: nombre de features importées
+    """
+    target = getattr(model, "__table__", model)
+    if isinstance(features, dict):
+        features = features["features"]
+    geom_col = target.columns[geometry_field]
+    srid = geom_col.type.srid if geom_col.type.srid > 0 else 4326
+    columns = [col.key for col in target.columns if col.key != geometry_field]
+
+    connection = session.connection()
+    count = 0
+    features = iter(features)
+    while True:
+        chunk = list(islice(features, chunk_size))
+        if not chunk:
+            break
+        rows = features_to_rows(chunk, columns, geometry_field, srid)
+        count += len(rows)
+        # lignes regroupées selon les colonnes renseignées
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row), []).append(row)
+        for row_columns, group in groups.items():
+            _insert_rows(
+                connection, target, list(row_columns), group, geometry_field, srid, upsert
+            )
+    return count
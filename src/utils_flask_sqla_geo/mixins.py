@@ -1,6 +1,21 @@
 from geojson import FeatureCollection
 
+from .utils import JsonifiableGenerator
+
 
 class GeoFeatureCollectionMixin:
-    def as_geofeaturecollection(self, *args, **kwargs):
+    def as_geofeaturecollection(self, *args, stream=False, chunk_size=1000, **kwargs):
+        """
+        Renvoie les résultats de la requête sous la forme d'une FeatureCollection
+
+        Si stream est True, les features sont produites au fur et à mesure
+        (yield_per par lots de chunk_size) dans un JsonifiableGenerator, sans charger
+        tous les résultats en mémoire
+        """
+        if stream:
+            return FeatureCollection(
+                JsonifiableGenerator(
+                    o.as_geofeature(*args, **kwargs) for o in self.yield_per(chunk_size)
+                )
+            )
         return FeatureCollection([o.as_geofeature(*args, **kwargs) for o in self.all()])
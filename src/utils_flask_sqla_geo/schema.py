@@ -1,11 +1,17 @@
+from contextvars import ContextVar
 from enum import Enum
+from itertools import islice
+from threading import Lock
 
+import numpy as np
+import shapely
 from marshmallow import Schema, fields, RAISE, EXCLUDE
 from marshmallow.decorators import pre_load, post_dump
 from marshmallow.validate import OneOf, Range
 from marshmallow.exceptions import ValidationError
 
 from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement
 from geoalchemy2.shape import to_shape, from_shape
 from marshmallow_sqlalchemy.schema import SQLAlchemyAutoSchema, SQLAlchemyAutoSchemaOpts
 from marshmallow_sqlalchemy.convert import ModelConverter
@@ -22,7 +28,8 @@ from shapely.geometry import shape
 from shapely import wkt
 from shapely.errors import ShapelyError
 
-from .utils import JsonifiableGenerator, GeneratorField
+from .utils import JsonifiableGenerator, GeneratorField, JSONStreamReader, LRUCache
+from .utilsgeometry import elements_to_shapes, geometries_bbox, repair_geometries, reproject
 
 
 class GeometrySchema(Schema):
@@ -34,13 +41,68 @@ class GeometrySchema(Schema):
         GeometryType.line_string.value: LineStringSchema,
         GeometryType.multi_line_string.value: MultiLineStringSchema,
     }
+    # profondeur d'imbrication des positions dans "coordinates"
+    coordinates_depth = {
+        GeometryType.point.value: 0,
+        GeometryType.multi_point.value: 1,
+        GeometryType.line_string.value: 1,
+        GeometryType.multi_line_string.value: 2,
+        GeometryType.polygon.value: 2,
+        GeometryType.multi_polygon.value: 3,
+    }
 
     type = fields.Str(required=True, validate=OneOf(schema_map.keys()))
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._schemas = {}
+
+    @staticmethod
+    def _is_valid_position(position):
+        if type(position) not in (list, tuple) or len(position) != 2:
+            return False
+        x, y = position
+        return (
+            type(x) in (int, float)
+            and type(y) in (int, float)
+            and -180 <= x <= 180
+            and -90 <= y <= 90
+        )
+
+    def _is_valid_coordinates(self, coordinates, depth):
+        if depth == 0:
+            return self._is_valid_position(coordinates)
+        return type(coordinates) in (list, tuple) and all(
+            self._is_valid_coordinates(c, depth - 1) for c in coordinates
+        )
+
+    def is_valid_geometry(self, data):
+        """
+        Fast path: check directly the GeoJSON structure and coordinates nesting.
+        Return ``True`` only if ``data`` would be accepted as is by the
+        ``marshmallow_geojson`` schema.
+        """
+        if type(data) is not dict or data.keys() != {"type", "coordinates"}:
+            return False
+        depth = self.coordinates_depth.get(data["type"])
+        if depth is None:
+            return False
+        return self._is_valid_coordinates(data["coordinates"], depth)
+
+    def get_geometry_schema(self, geometry_type, many=None):
+        key = (geometry_type, many)
+        schema = self._schemas.get(key)
+        if schema is None:
+            schema = self._schemas[key] = self.schema_map[geometry_type](many=many)
+        return schema
+
     def load(self, data, *, many=None, **kwargs):
+        if not many and not kwargs and self.is_valid_geometry(data):
+            return data
         geometry_type = super().load(data, many=many, unknown=EXCLUDE)["type"]
-        schema = self.schema_map[geometry_type]
-        return schema(many=many, **kwargs).load(data)
+        if kwargs:
+            return self.schema_map[geometry_type](many=many, **kwargs).load(data)
+        return self.get_geometry_schema(geometry_type, many).load(data)
 
 
 class FeatureSchema(Schema):
@@ -56,6 +118,66 @@ class FeatureCollectionSchema(Schema):
     features = GeneratorField(fields.Nested(FeatureSchema), required=True)
 
 
+#: policies for invalid GeoJSON geometries on load (see ``GeoAlchemyAutoSchema``)
+ON_INVALID_POLICIES = ("reject", "make_valid", "drop")
+
+
+class _ValidatedGeometry:
+    """Geometry already validated and converted by ``GeometryField.deserialize_many``."""
+
+    __slots__ = ("element", "repaired")
+
+    def __init__(self, element, repaired=False):
+        self.element = element
+        self.repaired = repaired
+
+
+#: marker of invalid geometries dropped by ``GeometryField.deserialize_many``
+_DROPPED = object()
+
+# report of the current ``GeoAlchemyAutoSchema.load`` call
+_load_report = ContextVar("load_report", default=None)
+
+# session, transient and instance of the current loads of shared schema instances
+_shared_load_state = ContextVar("shared_load_state", default={})
+
+
+class _LoadAttribute:
+    """Load attribute set by marshmallow-sqlalchemy (``_session``, ``_transient``,
+    ``instance``), kept in the current context rather than on the schema instance
+    when it is shared (see ``GeoAlchemyAutoSchema.cached``).
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, schema, owner=None):
+        if schema is None:
+            return self
+        if schema._shared:
+            return _shared_load_state.get().get(schema, {}).get(self.name)
+        return schema.__dict__.get(self.name)
+
+    def __set__(self, schema, value):
+        if schema._shared:
+            states = _shared_load_state.get()
+            state = {**states.get(schema, {}), self.name: value}
+            _shared_load_state.set({**states, schema: state})
+        else:
+            schema.__dict__[self.name] = value
+
+
+class LoadResult(list):
+    """List of loaded items, with the indexes (in the loaded data)
+    of the items whose geometry was repaired or which were dropped.
+    """
+
+    def __init__(self, items=(), repaired=(), dropped=()):
+        super().__init__(items)
+        self.repaired = list(repaired)
+        self.dropped = list(dropped)
+
+
 class GeometryField(fields.Field):
     geometry_schema = GeometrySchema()
 
@@ -72,8 +194,14 @@ class GeometryField(fields.Field):
             raise ValidationError("Invalid geometry.") from error
 
     def _deserialize_geojson(self, value, attr, data, **kwargs):
+        if isinstance(value, _ValidatedGeometry):
+            return value.element
         try:
             geom = shape(self.geometry_schema.load(value))
+            if not geom.is_valid and getattr(self.parent, "on_invalid", None) == "make_valid":
+                geom = repair_geometries([geom])[0]
+                if geom.is_empty:
+                    raise ValidationError("Invalid geometry.")
             if not geom.is_valid:
                 raise ValidationError("Invalid geometry.")
             if geom.has_z:
@@ -82,9 +210,63 @@ class GeometryField(fields.Field):
         except ValueError as error:
             raise ValidationError("Invalid geometry.") from error
 
+    @classmethod
+    def deserialize_many(cls, values, on_invalid="reject"):
+        """
+        Validate a batch of GeoJSON geometries at once.
+
+        Structure is checked with ``GeometrySchema.is_valid_geometry`` and validity with
+        vectorized ``shapely.is_valid``. Valid geometries are returned wrapped so that field
+        deserialization uses them as is; other values (``None``, invalid geometries) are
+        returned unchanged and go through the regular path, which raises the usual errors.
+
+        Well-formed but invalid geometries are handled according to ``on_invalid``:
+        ``make_valid`` repairs them at once (see ``utilsgeometry.repair_geometries``) and
+        returns them wrapped with ``repaired`` set, ``drop`` replaces them with ``_DROPPED``.
+        """
+        values = list(values)
+        indices, geometries, invalid = [], [], []
+        for i, value in enumerate(values):
+            if cls.geometry_schema.is_valid_geometry(value):
+                try:
+                    geometries.append(shape(value))
+                except (ValueError, ShapelyError):
+                    invalid.append(i)
+                    continue
+                indices.append(i)
+        if geometries:
+            geometries = np.array(geometries, dtype=object)
+            indices = np.array(indices)
+            valid = shapely.is_valid(geometries)
+            wkbs = shapely.to_wkb(geometries[valid])
+            for i, wkb in zip(indices[valid], wkbs):
+                values[i] = _ValidatedGeometry(WKBElement(memoryview(wkb), srid=4326))
+            if on_invalid == "make_valid" and not valid.all():
+                repaired = repair_geometries(geometries[~valid])
+                repairable = ~shapely.is_empty(repaired)
+                wkbs = shapely.to_wkb(repaired[repairable])
+                for i, wkb in zip(indices[~valid][repairable], wkbs):
+                    values[i] = _ValidatedGeometry(
+                        WKBElement(memoryview(wkb), srid=4326), repaired=True
+                    )
+            invalid.extend(indices[~valid].tolist())
+        if on_invalid == "drop":
+            for i in invalid:
+                values[i] = _DROPPED
+        return values
+
+    def _serialize_element(self, value, attr, obj):
+        # conversion done by chunks by the schema (see GeoAlchemyAutoSchema.target_srid)
+        return value
+
     def _bind_to_schema(self, field_name, schema):
-        super()._bind_to_schema
-        if schema.as_geojson:
+        super()._bind_to_schema(field_name, schema)
+        if getattr(schema, "target_srid", None):
+            self._serialize = self._serialize_element
+            self._deserialize = (
+                self._deserialize_geojson if schema.as_geojson else self._deserialize_wkt
+            )
+        elif schema.as_geojson:
             self._serialize = self._serialize_geojson
             self._deserialize = self._deserialize_geojson
         else:
@@ -141,11 +323,37 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
         If ``None``, use ``feature_geometry`` specified on ``class Meta``.
         If not specified on ``class Meta`` either, auto-detect the geometry field.
         If none or several geometric fields are detected, raise a ``TypeError``.
+    :param target_srid: If set, geometries are reprojected to this SRID on serialization.
+        Reprojection is done client-side, by chunks of ``serialization_chunk_size`` objects,
+        with cached pyproj transformers.
+    :param enrichments: Spatial enrichment stages (see ``enrichment.SpatialEnrichment``)
+        adding to each object, by chunks, the attributes of the reference layer entity
+        containing its ``feature_geometry``.
+    :param bbox: If ``true``, add to dumped FeatureCollections a ``bbox`` member,
+        computed from the features geometries (not for generators, omitted when
+        there is no geometry).
+    :param on_invalid: Policy for invalid GeoJSON geometries on load: ``reject``
+        (``ValidationError``, default), ``make_valid`` (repaired at once with
+        ``shapely.make_valid``) or ``drop`` (items left out of the result, rejected
+        when loading a single item). When loading many items, a ``LoadResult`` is
+        returned with the indexes of the repaired and dropped items.
 
     Geometric fields are automatically removed from serialization.
+
+    Use ``cached`` instead of instantiating the schema to reuse instances
+    configured with the same options.
     """
 
     OPTIONS_CLASS = GeoAlchemyAutoSchemaOpts
+    #: whether the instance is shared by ``cached`` callers
+    _shared = False
+    _session = _LoadAttribute()
+    _transient = _LoadAttribute()
+    instance = _LoadAttribute()
+    #: maximum number of instances kept by ``cached`` for each schema class
+    cache_size = 128
+    _cache_lock = Lock()
+    serialization_chunk_size = 1000
 
     def __init__(
         self,
@@ -153,10 +361,20 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
         as_geojson=False,
         feature_id=None,
         feature_geometry=None,
+        target_srid=None,
+        enrichments=(),
+        bbox=False,
+        on_invalid="reject",
         only=None,
         exclude=(),
-        **kwargs
+        **kwargs,
     ):
+        self.target_srid = target_srid
+        self.enrichments = tuple(enrichments)
+        self.bbox = bbox
+        if on_invalid not in ON_INVALID_POLICIES:
+            raise ValueError(f"Unsupported on_invalid policy '{on_invalid}'")
+        self.on_invalid = on_invalid
         excluded_geometry_fields = self.opts.geometry_fields.copy()
         if only is not None:
             only = set(only)
@@ -174,17 +392,64 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
                 only = set(only) | {self.feature_geometry}
         super().__init__(*args, only=only, exclude=exclude, **kwargs)
 
+    @classmethod
+    def _get_cache(cls):
+        cache = cls.__dict__.get("_schema_cache")
+        if cache is None:
+            with cls._cache_lock:
+                cache = cls.__dict__.get("_schema_cache")
+                if cache is None:
+                    cache = LRUCache(cls.cache_size)
+                    cls._schema_cache = cache
+        return cache
+
+    @classmethod
+    def cached(cls, *, only=None, exclude=(), **kwargs):
+        """Return a shared instance of the schema configured with given options.
+
+        Instances are kept in a bounded LRU cache (of ``cache_size`` items) for each schema
+        class, keyed by the normalized options. They must not be modified by callers.
+        Accept the same arguments as the schema constructor.
+
+        The ``session``, ``transient`` and ``instance`` passed to ``load`` only apply
+        to that call: they are not kept on the shared instance.
+
+        Instances with ``enrichments`` are not cached: they would keep their reference
+        layers (and spatial indexes) alive, including outdated versions
+        (see ``enrichment.get_reference_layer``).
+        """
+        if kwargs.get("enrichments"):
+            return cls(only=only, exclude=exclude, **kwargs)
+        try:
+            key = (
+                frozenset(only) if only is not None else None,
+                frozenset(exclude),
+                tuple(sorted(kwargs.items())),
+            )
+            hash(key)
+        except TypeError:  # unhashable options, e.g. context dict
+            return cls(only=only, exclude=exclude, **kwargs)
+        return cls._get_cache().get(key, lambda: cls._shared_instance(only, exclude, kwargs))
+
+    @classmethod
+    def _shared_instance(cls, only, exclude, kwargs):
+        schema = cls(only=only, exclude=exclude, **kwargs)
+        schema._shared = True
+        return schema
+
+    @classmethod
+    def cache_info(cls):
+        """Return hits, misses, maxsize and currsize of the ``cached`` instances cache."""
+        return cls._get_cache().cache_info()
+
     def to_feature(self, properties):
-        feature = {
-            "properties": properties,
-            "geometry": properties.pop(self.feature_geometry),
-        }
+        """Build the final feature mapping (as dumped by ``FeatureSchema``) in one pass."""
+        feature = {}
         if self.feature_id and self.feature_id in properties:
-            feature.update(
-                {
-                    "id": properties[self.feature_id],
-                }
-            )
+            feature["id"] = properties[self.feature_id]
+        feature["type"] = "Feature"
+        feature["geometry"] = properties.pop(self.feature_geometry)
+        feature["properties"] = properties
         return feature
 
     def from_feature(self, feature):
@@ -192,18 +457,151 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
         properties[self.opts.feature_geometry] = feature["geometry"]
         return properties
 
+    def validate_geometries(self, data):
+        """Validate at once the GeoJSON geometries of a list of deserialized features.
+
+        Repaired and dropped items (see ``on_invalid``) are recorded
+        in the report of the current ``load`` call.
+        """
+        repaired, dropped = set(), set()
+        for field_name in self.opts.geometry_fields:
+            field = self.load_fields.get(field_name)
+            if not isinstance(field, GeometryField):
+                continue
+            key = field.data_key or field_name
+            indexes = [i for i, item in enumerate(data) if isinstance(item, dict) and key in item]
+            geometries = field.deserialize_many(
+                (data[i][key] for i in indexes), on_invalid=self.on_invalid
+            )
+            for i, geometry in zip(indexes, geometries):
+                if geometry is _DROPPED:
+                    dropped.add(i)
+                    continue
+                if isinstance(geometry, _ValidatedGeometry) and geometry.repaired:
+                    repaired.add(i)
+                data[i][key] = geometry
+        report = _load_report.get()
+        if report is not None:
+            report["repaired"] = sorted(repaired - dropped)
+            report["dropped"] = sorted(dropped)
+            report["kept"] = [i for i in range(len(data)) if i not in dropped]
+        return [item for i, item in enumerate(data) if i not in dropped]
+
+    def load(self, data, *, many=None, **kwargs):
+        """Load data, see ``marshmallow.Schema.load``.
+
+        With an ``on_invalid`` policy other than ``reject``, a ``LoadResult`` is returned
+        when loading many items; indexes of error messages refer to the loaded data.
+        """
+        token = _shared_load_state.set(_shared_load_state.get())
+        try:
+            return self._load(data, many=many, **kwargs)
+        finally:
+            # forget the session, transient and instance of this call on shared instances
+            _shared_load_state.reset(token)
+
+    def validate(self, data, **kwargs):
+        token = _shared_load_state.set(_shared_load_state.get())
+        try:
+            return super().validate(data, **kwargs)
+        finally:
+            _shared_load_state.reset(token)
+
+    def _load(self, data, *, many=None, **kwargs):
+        if self.on_invalid == "reject":
+            return super().load(data, many=many, **kwargs)
+        report = {"repaired": [], "dropped": [], "kept": None}
+        token = _load_report.set(report)
+        try:
+            result = super().load(data, many=many, **kwargs)
+        except ValidationError as error:
+            kept = report["kept"]
+            if kept is None:
+                raise
+            raise ValidationError(
+                _map_error_indexes(error.messages, kept.__getitem__),
+                valid_data=error.valid_data,
+            ) from error
+        finally:
+            _load_report.reset(token)
+        if isinstance(result, list):
+            return LoadResult(result, report["repaired"], report["dropped"])
+        return result
+
+    def _reproject_geometries(self, results):
+        """Reproject and encode at once the geometries of a chunk of serialized objects."""
+        model = self.opts.model
+        for field_name, field in self.dump_fields.items():
+            if not isinstance(field, GeometryField):
+                continue
+            key = field.data_key or field_name
+            elements = [result.get(key) for result in results]
+            shapes = elements_to_shapes(elements)
+            column_srid = model.__mapper__.c[field_name].type.srid if model else -1
+            srids = np.array([getattr(element, "srid", -1) for element in elements])
+            srids[srids <= 0] = column_srid
+            for srid in np.unique(srids):
+                mask = srids == srid
+                shapes[mask] = reproject(
+                    shapes[mask], srid if srid > 0 else 4326, self.target_srid
+                )
+            if self.as_geojson:
+                values = [geom.__geo_interface__ if geom is not None else None for geom in shapes]
+            else:
+                values = shapely.to_wkt(shapes, rounding_precision=-1)
+            for result, value in zip(results, values):
+                if key in result:
+                    result[key] = value
+        return results
+
+    @property
+    def enrichment_fields(self):
+        """Names of the attributes added by ``enrichments``."""
+        return [field for enrichment in self.enrichments for field in enrichment.output_fields]
+
+    def _enrich(self, chunk, results):
+        geometry_field = self.feature_geometry if self.as_geojson else self.opts.feature_geometry
+        if not geometry_field:
+            raise TypeError("Missing 'feature_geometry'")
+        model = self.opts.model
+        srid = model.__mapper__.c[geometry_field].type.srid if model else -1
+        geometries = elements_to_shapes(getattr(o, geometry_field) for o in chunk)
+        for enrichment in self.enrichments:
+            enrichment.enrich(geometries, results, srid=srid if srid > 0 else None)
+        return results
+
+    def _serialize_chunk(self, chunk):
+        results = [super(GeoAlchemyAutoSchema, self)._serialize(o, many=False) for o in chunk]
+        if self.enrichments:
+            self._enrich(chunk, results)
+        if self.target_srid:
+            self._reproject_geometries(results)
+        return results
+
+    def _serialize_chunks(self, obj):
+        obj = iter(obj)
+        while True:
+            chunk = list(islice(obj, self.serialization_chunk_size))
+            if not chunk:
+                break
+            yield from self._serialize_chunk(chunk)
+
     def _serialize(self, obj, *, many=None):
         if many:
-            result = map(
-                lambda o: super(GeoAlchemyAutoSchema, self)._serialize(o, many=False), obj
-            )
+            if self.target_srid or self.enrichments:
+                result = self._serialize_chunks(obj)
+            else:
+                result = map(
+                    lambda o: super(GeoAlchemyAutoSchema, self)._serialize(o, many=False), obj
+                )
             if isinstance(obj, list):
                 return list(result)
             else:
                 return result
         else:
-            result = super(GeoAlchemyAutoSchema, self)._serialize(obj, many=False)
-            return result
+            if self.target_srid or self.enrichments:
+                return self._serialize_chunk([obj])[0]
+            return super(GeoAlchemyAutoSchema, self)._serialize(obj, many=False)
 
     @post_dump(pass_many=True)
     def to_geojson(self, data, many, **kwargs):
@@ -212,9 +610,18 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
                 features = map(self.to_feature, data)
                 if isinstance(data, list):
                     features = list(features)
-                return FeatureCollectionSchema().dump({"features": features})
+                else:
+                    features = JsonifiableGenerator(features)
+                collection = {"type": "FeatureCollection"}
+                if self.bbox and isinstance(features, list):
+                    bbox = geometries_bbox(feature["geometry"] for feature in features)
+                    # no bbox member without geometry (RFC 7946, section 5)
+                    if bbox is not None:
+                        collection["bbox"] = bbox
+                collection["features"] = features
+                return collection
             else:
-                return FeatureSchema().dump(self.to_feature(data))
+                return self.to_feature(data)
         else:
             if many and not isinstance(data, list):
                 data = JsonifiableGenerator(data)
@@ -226,7 +633,74 @@ class GeoAlchemyAutoSchema(SQLAlchemyAutoSchema):
             return data
         if many:
             collection = FeatureCollectionSchema(partial=False, unknown=RAISE).load(data)
-            return [self.from_feature(feature) for feature in collection["features"]]
+            data = [self.from_feature(feature) for feature in collection["features"]]
+            return self.validate_geometries(data)
         else:
             feature = FeatureSchema(partial=False, unknown=RAISE).load(data)
             return self.from_feature(feature)
+
+    def _iter_stream_features(self, reader):
+        members = {}
+        for key, _ in reader.iter_object():
+            if key == "features":
+                # early check of members preceding features (e.g. unknown fields),
+                # required members may follow features
+                FeatureCollectionSchema(partial=True, unknown=RAISE).load(members)
+                yield from reader.iter_array()
+                members["features"] = []
+            else:
+                members[key] = reader.read_value()
+        if reader.peek() is not None:
+            raise ValueError("Extra data after FeatureCollection")
+        FeatureCollectionSchema(partial=False, unknown=RAISE).load(members)
+
+    def load_stream(self, fp, batch_size=1000, chunk_size=65536, **kwargs):
+        """Load incrementally a large document from a file-like object (text or binary).
+
+        The document must be a FeatureCollection if ``as_geojson`` is ``true``, a JSON array
+        otherwise. Items are parsed one by one and loaded by batches of ``batch_size``,
+        so only the current batch is kept in memory.
+
+        :param fp: file-like object to read from.
+        :param batch_size: number of items loaded at once.
+        :param chunk_size: size of the reads from ``fp``.
+        :param kwargs: additional arguments passed to ``load``.
+        :return: a generator of lists of loaded items (dicts or model instances).
+        :raises ValidationError: indexes of error messages refer to the position of
+            the item in the whole document.
+        """
+        reader = JSONStreamReader(fp, chunk_size)
+        if self.as_geojson:
+            items = self._iter_stream_features(reader)
+        else:
+            items = reader.iter_array()
+        offset = 0
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                break
+            if self.as_geojson:
+                batch = {"type": "FeatureCollection", "features": batch}
+            try:
+                result = self.load(batch, many=True, **kwargs)
+            except ValidationError as error:
+                raise ValidationError(
+                    _map_error_indexes(error.messages, lambda i: i + offset),
+                    valid_data=error.valid_data,
+                ) from error
+            if isinstance(result, LoadResult):
+                result.repaired = [i + offset for i in result.repaired]
+                result.dropped = [i + offset for i in result.dropped]
+            yield result
+            offset += batch_size
+
+
+def _map_error_indexes(messages, index):
+    if not isinstance(messages, dict):
+        return messages
+    return {
+        (index(key) if isinstance(key, int) else key): (
+            _map_error_indexes(value, index) if key == "features" else value
+        )
+        for key, value in messages.items()
+    }
@@ -1,5 +1,9 @@
 import datetime
-from itertools import chain
+import json
+from decimal import Decimal
+from functools import lru_cache
+from itertools import chain, islice
+from operator import attrgetter
 from warnings import warn
 
 from shapely import wkb
@@ -9,14 +13,40 @@ from geojson import Feature, FeatureCollection
 
 from sqlalchemy.sql import text
 from sqlalchemy.dialects import postgresql
-from sqlalchemy import inspect
+from sqlalchemy import and_, event, inspect, func, select, true
+from sqlalchemy.orm import object_session
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import to_shape, from_shape
 
 from utils_flask_sqla.serializers import serializable
 from utils_flask_sqla.errors import UtilsSqlaError
 
-from .utilsgeometry import FionaShapeService, remove_third_dimension, FionaGpkgService
+from .cache import table_name, track_tables
+from .ingest import bulk_insert_geofeatures
+from .utilsgeometry import (
+    FionaShapeService,
+    remove_third_dimension,
+    FionaGpkgService,
+    elements_to_shapes,
+    repair_geometries,
+    shape_to_geojson,
+)
+
+
+class GeoFeature(Feature):
+    """
+    Feature geojson allégée
+
+    Contrairement à ``geojson.Feature``, la géométrie (déjà sous forme de dict geojson)
+    et les propriétés sont affectées telles quelles, sans validation ni copie.
+    """
+
+    def __init__(self, id=None, geometry=None, properties=None):
+        dict.__init__(self, type="Feature")
+        if id is not None:
+            self["id"] = id
+        self["geometry"] = geometry
+        self["properties"] = properties or {}
 
 
 def get_geoserializable_decorator(geoCol=None, idCol=None, **kwargs):
@@ -40,6 +70,24 @@ def get_geoserializable_decorator(geoCol=None, idCol=None, **kwargs):
         kwargs["exclude"] = list(chain(geom_exclude, exclude))
         cls = serializable(**kwargs)(cls)
 
+        @lru_cache(maxsize=None)
+        def get_feature_plan(geoCol, idCol):
+            """
+            Plan de sérialisation, compilé une seule fois par classe
+            et par couple (colonne géométrie, colonne identifiant)
+            """
+            get_geom = attrgetter(geoCol)
+            get_id = attrgetter(idCol)
+
+            def build_feature(obj, geometry, properties):
+                if geometry is None:
+                    geometry = {"type": "Point", "coordinates": [0, 0]}
+                else:
+                    geometry = shape_to_geojson(geometry)
+                return GeoFeature(id=str(get_id(obj)), geometry=geometry, properties=properties)
+
+            return get_geom, build_feature
+
         def serializegeofn(self, geoCol=None, idCol=None, *args, **kwargs):
             """
             Méthode qui renvoie les données de l'objet sous la forme
@@ -54,30 +102,49 @@ def get_geoserializable_decorator(geoCol=None, idCol=None, **kwargs):
 
             Pour les autres paramètres, voir la doc de @serializable
             """
-            if geoCol is None:
-                geoCol = defaultGeoCol
-            if idCol is None:
-                idCol = defaultIdCol
-
-            if not getattr(self, geoCol) is None:
-                geometry = to_shape(getattr(self, geoCol))
-            else:
-                geometry = {"type": "Point", "coordinates": [0, 0]}
-
-            feature = Feature(
-                id=str(getattr(self, idCol)),
-                geometry=geometry,
-                properties=self.as_dict(*args, **kwargs),
+            get_geom, build_feature = get_feature_plan(
+                geoCol or defaultGeoCol, idCol or defaultIdCol
+            )
+            geom = get_geom(self)
+            return build_feature(
+                self,
+                to_shape(geom) if geom is not None else None,
+                self.as_dict(*args, **kwargs),
             )
-            return feature
 
-        def populategeofn(self, geojson, recursif=True, col_geom_name="geom"):
+        def serializegeofns(cls, data, geoCol=None, idCol=None, *args, chunk_size=1000, **kwargs):
+            """
+            Méthode de classe qui renvoie un générateur de Feature geojson
+            à partir d'un itérable d'objets
+
+            Les géométries sont décodées de manière vectorisée, par lots de chunk_size objets.
+            Pour les autres paramètres, voir as_geofeature
+            """
+            get_geom, build_feature = get_feature_plan(
+                geoCol or defaultGeoCol, idCol or defaultIdCol
+            )
+            data = iter(data)
+            while True:
+                chunk = list(islice(data, chunk_size))
+                if not chunk:
+                    break
+                geometries = elements_to_shapes([get_geom(o) for o in chunk])
+                for obj, geometry in zip(chunk, geometries):
+                    yield build_feature(obj, geometry, obj.as_dict(*args, **kwargs))
+
+        def populategeofn(self, geojson, recursif=True, col_geom_name="geom", on_invalid=None):
             """
             Méthode qui initie les valeurs de l'objet SQLAlchemy à partir d'un geojson
 
             Parameters
             ----------
                 geojfeature_in : dictionnaire contenant les valeurs à passer à l'objet
+                on_invalid : traitement des géométries invalides : "reject" (UtilsSqlaError),
+                    "make_valid" (réparée, cf repair_geometries) ou "drop" (objet non renseigné).
+                    Par défaut, la géométrie n'est pas vérifiée
+            Returns
+            -------
+                bool : False si la feature a été écartée (géométrie invalide, on_invalid="drop")
             """
 
             typeg = geojson.get("type")
@@ -87,17 +154,52 @@ def get_geoserializable_decorator(geoCol=None, idCol=None, **kwargs):
             if not properties or not geometry or typeg != "Feature":
                 raise UtilsSqlaError("Input must be a geofeature")
 
-            # set properties
-            self.from_dict(properties, recursif=recursif)
-
             # voir si meilleure procédure pour mettre la geometrie en base
             _shape = shape(geometry)
             two_dimension_geom = remove_third_dimension(_shape)
+            if on_invalid is not None and not two_dimension_geom.is_valid:
+                if on_invalid == "drop":
+                    return False
+                if on_invalid == "make_valid":
+                    two_dimension_geom = repair_geometries([two_dimension_geom])[0]
+                if on_invalid != "make_valid" or two_dimension_geom.is_empty:
+                    raise UtilsSqlaError("Invalid geometry")
+
+            # set properties
+            self.from_dict(properties, recursif=recursif)
+
             geom = from_shape(two_dimension_geom, srid=4326)
             setattr(self, col_geom_name, geom)
+            return True
+
+        def bulkinsertgeofn(cls, session, features, col_geom_name="geom", **kwargs):
+            """
+            Méthode de classe qui insère en masse des features geojson dans la table
+            (COPY sous PostgreSQL, cf bulk_insert_geofeatures)
+            """
+            count = bulk_insert_geofeatures(
+                session, cls, features, geometry_field=col_geom_name, **kwargs
+            )
+            track_tables(session, *tables)
+            return count
 
         cls.as_geofeature = serializegeofn
+        cls.as_geofeatures = classmethod(serializegeofns)
         cls.from_geofeature = populategeofn
+        cls.bulk_from_geofeatures = classmethod(bulkinsertgeofn)
+
+        # invalidation des résultats mis en cache (QueryCache) au commit des écritures
+        # (les Query.update() / Query.delete() en masse ne passent pas par ces
+        # événements : cf utils_flask_sqla_geo.cache.invalidate_tables)
+        tables = [table_name(table) for table in mapper.tables]
+
+        def invalidate_cache(mapper, connection, target):
+            session = object_session(target)
+            if session is not None:
+                track_tables(session, *tables)
+
+        for identifier in ("after_insert", "after_update", "after_delete"):
+            event.listen(cls, identifier, invalidate_cache)
 
         return cls
 
@@ -267,29 +369,8 @@ def sqla_query_to_text(query):
     return strquery
 
 
-def txt_query_as_geojson(
-    session, query, id_col, geom_col, geom_srid=4326, is_geojson=False, keep_id_col=False
-):
-    """
-    Fonction qui permet de convertir une requete sql en geojson
-        En utilisant les fonctionnalités de serialisation de postresql
-
-    Parameters
-
-    session : Session sqlalchemy
-    query : requete au format text
-    id_col : nom de la colonne identifiant (id du geojson)
-    geom_col (string): nom de la colonne géométrique
-    geom_srid (int): srid de la géométrie
-    is_geojson (boolean): Est-ce que la colonne géometrie est déjà un geojson
-    keep_id_col (boolean): Est-ce que les valeurs de la colonne id_col doit être concervée dans les properties
-
-    Returns:
-        FeatureCollection
-    """
-
-    #  TODO add tests !!!!!
-
+def _geojson_statement(query, id_col, geom_col, geom_srid, is_geojson, keep_id_col):
+    """Requête postgresql construisant la FeatureCollection (cf txt_query_as_geojson)"""
     if is_geojson:
         q_geom = geom_col
     else:
@@ -323,14 +404,64 @@ def txt_query_as_geojson(
             id_col=id_col, q_asgeojson=q_asgeojson, q_rm_col=" - ".join(q_rm_col), query=query
         )
     )
+    return statement
 
-    results = session.execute(statement)
-    for r in results:
-        return r[0]
+
+def txt_query_as_geojson(
+    session,
+    query,
+    id_col,
+    geom_col,
+    geom_srid=4326,
+    is_geojson=False,
+    keep_id_col=False,
+    cache=None,
+    tables=(),
+):
+    """
+    Fonction qui permet de convertir une requete sql en geojson
+        En utilisant les fonctionnalités de serialisation de postresql
+
+    Parameters
+
+    session : Session sqlalchemy
+    query : requete au format text
+    id_col : nom de la colonne identifiant (id du geojson)
+    geom_col (string): nom de la colonne géométrique
+    geom_srid (int): srid de la géométrie
+    is_geojson (boolean): Est-ce que la colonne géometrie est déjà un geojson
+    keep_id_col (boolean): Est-ce que les valeurs de la colonne id_col doit être concervée dans les properties
+    cache (QueryCache): cache des résultats (clé : sql normalisé et paramètres)
+    tables (list): tables interrogées par la requête (pour l'invalidation du cache)
+
+    Returns:
+        FeatureCollection (CachedJSON avec un cache : envoyée telle quelle par geojsonify)
+    """
+
+    #  TODO add tests !!!!!
+
+    statement = _geojson_statement(query, id_col, geom_col, geom_srid, is_geojson, keep_id_col)
+
+    def execute():
+        results = session.execute(statement)
+        for r in results:
+            return r[0]
+
+    if cache is None:
+        return execute()
+    key = cache.statement_key(statement.text)
+    return cache.get_or_set_document(key, execute, tables=tables)
 
 
 def sqla_query_to_geojson(
-    session, query, id_col, geom_col, geom_srid=4326, is_geojson=False, keep_id_col=False
+    session,
+    query,
+    id_col,
+    geom_col,
+    geom_srid=4326,
+    is_geojson=False,
+    keep_id_col=False,
+    cache=None,
 ):
     """
     Fonction qui permet de convertir une requete sql en geojson
@@ -345,9 +476,10 @@ def sqla_query_to_geojson(
     geom_srid (int): srid de la géométrie
     is_geojson (boolean): Est-ce que la colonne géometrie est déjà un geojson
     keep_id_col (boolean): Est-ce que les valeurs de la colonne id_col doit être concervée dans les properties
+    cache (QueryCache): cache des résultats, invalidé par les écritures dans les tables interrogées
 
     Returns:
-        FeatureCollection
+        FeatureCollection (CachedJSON avec un cache, cf txt_query_as_geojson)
     """
 
     txt_query = sqla_query_to_text(query)
@@ -359,4 +491,122 @@ def sqla_query_to_geojson(
         geom_srid=geom_srid,
         is_geojson=is_geojson,
         keep_id_col=keep_id_col,
+        cache=cache,
+        tables=cache.statement_tables(query) if cache is not None else (),
+    )
+
+
+async def txt_query_as_geojson_async(
+    session, query, id_col, geom_col, geom_srid=4326, is_geojson=False, keep_id_col=False
+):
+    """
+    Version asynchrone de txt_query_as_geojson
+
+    Parameters
+
+    session : AsyncSession sqlalchemy
+    Pour les autres paramètres, voir txt_query_as_geojson
+    """
+    statement = _geojson_statement(query, id_col, geom_col, geom_srid, is_geojson, keep_id_col)
+    results = await session.execute(statement)
+    for r in results:
+        return r[0]
+
+
+async def sqla_query_to_geojson_async(
+    session, query, id_col, geom_col, geom_srid=4326, is_geojson=False, keep_id_col=False
+):
+    """
+    Version asynchrone de sqla_query_to_geojson
+
+    Parameters
+
+    session : AsyncSession sqlalchemy
+    Pour les autres paramètres, voir sqla_query_to_geojson
+    """
+    return await txt_query_as_geojson_async(
+        session,
+        sqla_query_to_text(query),
+        id_col,
+        geom_col,
+        geom_srid=geom_srid,
+        is_geojson=is_geojson,
+        keep_id_col=keep_id_col,
+    )
+
+
+GRID_FUNCTIONS = {
+    "hexagon": "ST_HexagonGrid",
+    "square": "ST_SquareGrid",
+}
+GRID_AGGREGATES = ("count", "sum", "avg", "min", "max")
+
+
+def sqla_query_to_grid_geojson(
+    session, query, geom_col, size, shape="hexagon", aggregates=None, geom_srid=4326
+):
+    """
+    Fonction qui agrège les résultats d'une requête dans les cellules d'une grille
+    hexagonale ou carrée (ST_HexagonGrid / ST_SquareGrid) couvrant l'emprise des données
+        et renvoie un geojson des cellules non vides
+
+    Parameters
+
+    session : Session sqlalchemy
+    query : requete au format Select
+    geom_col (string): nom de la colonne géométrique
+    size (float): taille des cellules, dans l'unité du srid de la géométrie
+    shape (string): "hexagon" ou "square"
+    aggregates (dict): agrégats à calculer pour chaque cellule, sous la forme
+        {nom_propriete: (fonction, nom_colonne)}, fonction parmi count, sum, avg, min, max
+    geom_srid (int): srid de la géométrie
+
+    Returns:
+        FeatureCollection (les propriétés de chaque cellule sont count et les agrégats)
+    """
+    if shape not in GRID_FUNCTIONS:
+        raise ValueError(f"Unsupported grid shape '{shape}'")
+    aggregates = aggregates or {}
+    for name, (function, column) in aggregates.items():
+        if function not in GRID_AGGREGATES:
+            raise ValueError(f"Unsupported aggregate function '{function}' for '{name}'")
+
+    data = query.subquery()
+    geom = data.c[geom_col]
+    extent = select(func.ST_SetSRID(func.ST_Extent(geom), geom_srid).label("geom")).subquery()
+    grid = getattr(func, GRID_FUNCTIONS[shape])(size, extent.c.geom).table_valued("geom", "i", "j")
+    cells = (
+        select(grid.c.geom, grid.c.i, grid.c.j).select_from(extent).join(grid, true()).cte("cells")
+    )
+    # agrégation par indices de cellule (un GROUP BY sur la géométrie comparerait les emprises)
+    stats = (
+        select(
+            cells.c.i,
+            cells.c.j,
+            func.count().label("count"),
+            *(
+                getattr(func, function)(data.c[column]).label(name)
+                for name, (function, column) in aggregates.items()
+            ),
+        )
+        .select_from(cells)
+        .join(data, func.ST_Intersects(cells.c.geom, geom))
+        .group_by(cells.c.i, cells.c.j)
+        .subquery()
     )
+    cell_geom = cells.c.geom
+    if geom_srid != 4326:
+        cell_geom = func.ST_Transform(cell_geom, 4326)
+    statement = select(
+        func.ST_AsGeoJSON(cell_geom),
+        stats.c["count"],
+        *(stats.c[name] for name in aggregates),
+    ).join(stats, and_(stats.c.i == cells.c.i, stats.c.j == cells.c.j))
+
+    features = []
+    for geometry, count, *values in session.execute(statement):
+        properties = {"count": count}
+        for name, value in zip(aggregates, values):
+            properties[name] = float(value) if isinstance(value, Decimal) else value
+        features.append(Feature(geometry=json.loads(geometry), properties=properties))
+    return FeatureCollection(features)
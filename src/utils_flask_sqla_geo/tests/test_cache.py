@@ -0,0 +1,128 @@
+import json
+import time
+
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+
+from utils_flask_sqla_geo.cache import (
+    CachedJSON,
+    DiskCacheBackend,
+    MemoryCacheBackend,
+    QueryCache,
+)
+from utils_flask_sqla_geo.serializers import geoserializable
+
+
+Base = declarative_base()
+
+
+@geoserializable
+class Layer(Base):
+    __tablename__ = "layer"
+    __table_args__ = {"schema": "ref"}
+    pk = Column(Integer, primary_key=True)
+    name = Column(String)
+
+
+@pytest.fixture(params=["memory", "disk"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryCacheBackend(maxsize=2)
+    return DiskCacheBackend(str(tmp_path / "cache" / "cache.sqlite"), maxsize=2)
+
+
+class TestCacheBackends:
+    def test_lru(self, backend):
+        backend.set("a", b"1")
+        backend.set("b", b"2")
+        time.sleep(0.01)
+        assert backend.get("a") == b"1"
+        backend.set("c", b"3")
+        assert backend.get("b") is None
+        assert backend.get("a") == b"1"
+        assert backend.get("c") == b"3"
+
+    def test_ttl(self, backend):
+        backend.set("a", b"1", ttl=-1)
+        backend.set("b", b"2", ttl=60)
+        assert backend.get("a") is None
+        assert backend.get("b") == b"2"
+
+    def test_invalidate_tables(self, backend):
+        backend.set("a", b"1", tables=["ref.layer", "ref.other"])
+        backend.set("b", b"2", tables=["ref.other"])
+        backend.invalidate_tables(["ref.layer"])
+        assert backend.get("a") is None
+        assert backend.get("b") == b"2"
+        backend.clear()
+        assert backend.get("b") is None
+
+
+class TestQueryCache:
+    def test_statement_key(self):
+        cache = QueryCache()
+        query = select(Layer).where(Layer.pk == 1)
+        assert cache.statement_key(query) == cache.statement_key(
+            select(Layer).where(Layer.pk == 1)
+        )
+        assert cache.statement_key(query) != cache.statement_key(
+            select(Layer).where(Layer.pk == 2)
+        )
+        assert cache.statement_key("SELECT  1\n") == cache.statement_key("SELECT 1")
+        assert cache.statement_tables(query) == {"ref.layer"}
+
+    def test_get_or_set_json(self):
+        cache = QueryCache(ttl=None)
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return {"type": "FeatureCollection", "features": []}
+
+        for _ in range(2):
+            assert cache.get_or_set_json("k", factory)["type"] == "FeatureCollection"
+        assert len(calls) == 1
+
+    def test_get_or_set_document(self):
+        cache = QueryCache(ttl=None)
+        document = {"type": "FeatureCollection", "features": []}
+        cache.get_or_set_document("k", lambda: document)
+        hit = cache.get_or_set_document("k", lambda: pytest.fail("cache miss"))
+        assert isinstance(hit, CachedJSON)
+        assert hit.data == json.dumps(document).encode()
+        # decoded only when its content is read
+        assert hit._value is None
+        assert hit["type"] == "FeatureCollection"
+        assert hit == document
+
+    def test_geoserializable_writes_invalidate(self):
+        engine = create_engine("sqlite://")
+        with engine.connect() as connection:
+            connection.exec_driver_sql("ATTACH DATABASE ':memory:' AS ref")
+            connection.exec_driver_sql(
+                "CREATE TABLE ref.layer (pk INTEGER PRIMARY KEY, name TEXT)"
+            )
+            cache = QueryCache()
+            cache.backend.set("k", b"{}", tables=["ref.layer"])
+            with Session(bind=connection) as session:
+                session.add(Layer(pk=1, name="a"))
+                session.flush()
+                # pas d'invalidation avant le commit
+                assert cache.backend.get("k") == b"{}"
+                session.rollback()
+                assert cache.backend.get("k") == b"{}"
+
+                session.add(Layer(pk=2, name="b"))
+                session.flush()
+                session.commit()
+                assert cache.backend.get("k") is None
+
+                # les tables d'une transaction annulée ne sont pas invalidées au commit suivant
+                cache.backend.set("k", b"{}", tables=["ref.layer"])
+                session.add(Layer(pk=3, name="c"))
+                session.flush()
+                session.rollback()
+                session.commit()
+                assert cache.backend.get("k") == b"{}"
@@ -0,0 +1,574 @@
+import asyncio
+import collections
+import csv
+import datetime
+import gzip
+import io
+import json
+import sqlite3
+import uuid
+
+import fiona
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String, select
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.declarative import declarative_base
+from geoalchemy2 import Geometry
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point, box
+
+from utils_flask_sqla_geo.enrichment import (
+    ReferenceLayer,
+    SpatialEnrichment,
+    get_reference_layer,
+    invalidate_reference_layer,
+)
+from utils_flask_sqla_geo.export import (
+    export_csv,
+    export_csv_async,
+    export_csv_resumable,
+    export_geojson,
+    export_geojson_async,
+    export_geojsonseq,
+    export_json,
+    export_json_async,
+    export_geopackage,
+    export_geopackage_delta,
+    export_geopackage_layers,
+    export_geopackage_resumable,
+    export_ndjson,
+)
+from utils_flask_sqla_geo.export import ExportCheckpoint
+from utils_flask_sqla_geo.schema import GeoAlchemyAutoSchema
+
+
+Base = declarative_base()
+
+
+class Observation(Base):
+    __tablename__ = "observation"
+    pk = Column(Integer, primary_key=True)
+    name = Column(String)
+    geom = Column(Geometry("POINT", 4326))
+
+
+class ObservationSchema(GeoAlchemyAutoSchema):
+    class Meta:
+        model = Observation
+        feature_id = "pk"
+
+
+class VersionedObservation(Base):
+    __tablename__ = "versioned_observation"
+    pk = Column(Integer, primary_key=True)
+    name = Column(String)
+    update_date = Column(DateTime)
+    geom = Column(Geometry("POINT", 4326))
+
+
+class VersionedObservationSchema(GeoAlchemyAutoSchema):
+    class Meta:
+        model = VersionedObservation
+
+
+class UUIDObservation(Base):
+    __tablename__ = "uuid_observation"
+    pk = Column(UUID(as_uuid=True), primary_key=True)
+    name = Column(String)
+    update_date = Column(DateTime)
+    geom = Column(Geometry("POINT", 4326))
+
+
+class UUIDObservationSchema(GeoAlchemyAutoSchema):
+    class Meta:
+        model = UUIDObservation
+
+
+class Site(Base):
+    __tablename__ = "site"
+    pk = Column(Integer, primary_key=True)
+    name = Column(String)
+    geom_point = Column(Geometry("POINT", 4326))
+    geom_area = Column(Geometry("POLYGON", 4326))
+
+
+class SiteSchema(GeoAlchemyAutoSchema):
+    class Meta:
+        model = Site
+
+
+class Query(list):
+    """Mimic a SQLAlchemy query over a list of objects."""
+
+    def yield_per(self, count):
+        return iter(self)
+
+    def filter(self, criterion):
+        # binary expression: column <operator> value
+        key, value = criterion.left.key, criterion.right.value
+        return Query(
+            o
+            for o in self
+            if getattr(o, key) is not None and criterion.operator(getattr(o, key), value)
+        )
+
+    def order_by(self, *criteria):
+        return self
+
+    def with_entities(self, *columns):
+        return Query(tuple(getattr(o, col.key) for col in columns) for o in self)
+
+    def limit(self, count):
+        return Query(self[:count])
+
+
+class FailingQuery(Query):
+    """Query failing after ``count`` chunks have been read (see ``limit``)."""
+
+    def __init__(self, objects, count):
+        super().__init__(objects)
+        self.counter = count if isinstance(count, list) else [count]
+
+    def filter(self, criterion):
+        return FailingQuery(super().filter(criterion), self.counter)
+
+    def limit(self, count):
+        self.counter[0] -= 1
+        if self.counter[0] < 0:
+            raise RuntimeError("Interrupted export")
+        return super().limit(count)
+
+
+class AsyncResult:
+    """Mimic a SQLAlchemy AsyncResult over a list of rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def scalars(self):
+        return AsyncResult([row[0] for row in self.rows])
+
+    async def partitions(self, size):
+        for i in range(0, len(self.rows), size):
+            await asyncio.sleep(0)
+            yield self.rows[i : i + size]
+
+
+class AsyncSession:
+    """Mimic a SQLAlchemy AsyncSession streaming a select over a list of objects."""
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.statements = []
+
+    async def stream(self, statement):
+        self.statements.append(statement)
+        descriptions = statement.column_descriptions
+        if len(descriptions) == 1 and isinstance(descriptions[0]["expr"], type):
+            return AsyncResult([(o,) for o in self.objects])
+        Row = collections.namedtuple("Row", [d["name"] for d in descriptions])
+        return AsyncResult(
+            [Row(*(getattr(o, d["name"]) for d in descriptions)) for o in self.objects]
+        )
+
+
+class AsyncSink(io.BytesIO):
+    async def write(self, data):
+        return super().write(data)
+
+
+@pytest.fixture
+def query():
+    return Query(
+        Observation(pk=i, name=f"o{i}", geom=from_shape(Point(i % 10, i % 5), srid=4326))
+        for i in range(25)
+    )
+
+
+@pytest.fixture
+def municipalities():
+    return ReferenceLayer(
+        [box(0, 0, 5, 5), box(4, 0, 10, 5)],
+        [{"code": 1, "name": "West"}, {"code": 2, "name": "East"}],
+    )
+
+
+class TestExport:
+    @pytest.mark.parametrize("bulk,spatial_index", [(False, True), (True, True), (True, False)])
+    def test_export_geopackage(self, tmp_path, query, bulk, spatial_index):
+        filename = str(tmp_path / "export.gpkg")
+        export_geopackage(
+            query,
+            ObservationSchema,
+            filename,
+            srid=4326,
+            chunk_size=10,
+            bulk=bulk,
+            spatial_index=spatial_index,
+        )
+        with fiona.open(filename) as f:
+            features = list(f)
+        assert [feature["properties"]["name"] for feature in features] == [
+            f"o{i}" for i in range(25)
+        ]
+        assert features[7]["geometry"]["coordinates"] == (7, 2)
+        with sqlite3.connect(filename) as connection:
+            rtree = connection.execute(
+                "SELECT name FROM sqlite_master WHERE name LIKE 'rtree_%'"
+            ).fetchall()
+        assert bool(rtree) == spatial_index
+
+    def test_export_csv_enrichment(self, query, municipalities):
+        query.append(Observation(pk=100, name="outside", geom=from_shape(Point(50, 50))))
+        fp = io.StringIO()
+        enrichment = SpatialEnrichment(municipalities, fields=["name"], prefix="municipality_")
+        export_csv(query, ObservationSchema, fp, enrichments=[enrichment])
+        fp.seek(0)
+        rows = list(csv.DictReader(fp, delimiter=";"))
+        assert list(rows[0]) == ["pk", "name", "municipality_name"]
+        # (0, 0) is on the boundary, hence not within West
+        assert [row["municipality_name"] for row in rows[:7]] == [""] + ["West"] * 4 + ["", "East"]
+        assert rows[-1]["municipality_name"] == ""
+
+    def test_export_geopackage_enrichment(self, tmp_path, query, municipalities):
+        filename = str(tmp_path / "export.gpkg")
+        enrichment = SpatialEnrichment(municipalities, prefix="municipality_")
+        export_geopackage(query, ObservationSchema, filename, srid=4326, enrichments=[enrichment])
+        with fiona.open(filename) as f:
+            assert f.schema["properties"]["municipality_code"].startswith("int")
+            properties = [feature["properties"] for feature in f]
+        assert properties[7]["municipality_code"] == 2
+        assert properties[7]["municipality_name"] == "East"
+
+    def test_reference_layer_lookup_overlap(self, municipalities):
+        # the references overlap on 4 <= x <= 5, the first one wins
+        layer = ReferenceLayer(
+            [box(4, 0, 10, 5), box(0, 0, 5, 5), box(4.2, 0, 4.8, 5)],
+            [{"code": 2}, {"code": 1}, {"code": 3}],
+        )
+        points = [Point(4.5, 1), Point(1, 1), None, Point(50, 50), Point(4.5, 2), Point(7, 1)]
+        assert layer.lookup(points).tolist() == [0, 1, -1, -1, 0, 0]
+        assert municipalities.lookup(points).tolist() == [0, 0, -1, -1, 0, 1]
+
+    def test_reference_layer_cache(self, municipalities):
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return municipalities
+
+        invalidate_reference_layer()
+        assert get_reference_layer("municipalities", loader, version=1) is municipalities
+        get_reference_layer("municipalities", loader, version=1)
+        assert len(loads) == 1
+        get_reference_layer("municipalities", loader, version=2)
+        assert len(loads) == 2
+        invalidate_reference_layer("municipalities")
+        get_reference_layer("municipalities", loader, version=2)
+        assert len(loads) == 3
+
+    def test_export_compressed(self, query):
+        expected = io.StringIO()
+        export_geojson(query, ObservationSchema, expected)
+        fp = io.BytesIO()
+        export_geojson(query, ObservationSchema, fp, compression="gzip", compression_level=1)
+        assert gzip.decompress(fp.getvalue()).decode() == expected.getvalue()
+
+    def test_export_geojson_async(self, query):
+        expected = io.StringIO()
+        export_geojson(query, ObservationSchema, expected)
+        sink = AsyncSink()
+        asyncio.run(
+            export_geojson_async(
+                AsyncSession(list(query)),
+                select(Observation),
+                ObservationSchema,
+                sink,
+                chunk_size=7,
+            )
+        )
+        assert sink.getvalue().decode() == expected.getvalue()
+
+    def test_export_csv_async(self, query):
+        expected = io.StringIO()
+        export_csv(query, ObservationSchema, expected)
+        sink = AsyncSink()
+        asyncio.run(
+            export_csv_async(
+                AsyncSession(list(query)),
+                select(Observation),
+                ObservationSchema,
+                sink,
+                chunk_size=7,
+                compression="gzip",
+            )
+        )
+        assert gzip.decompress(sink.getvalue()).decode() == expected.getvalue()
+
+    def test_export_json_async(self, query):
+        expected = io.StringIO()
+        export_json(query, ObservationSchema, expected, columns=["pk", "name"])
+        # plain binary file as sink, rows of columns rather than objects
+        sink = io.BytesIO()
+        session = AsyncSession(list(query))
+        asyncio.run(
+            export_json_async(
+                session,
+                select(Observation.pk, Observation.name),
+                ObservationSchema,
+                sink,
+                columns=["pk", "name"],
+                chunk_size=7,
+            )
+        )
+        assert sink.getvalue().decode() == expected.getvalue()
+        assert json.loads(sink.getvalue())[7] == {"pk": 7, "name": "o7"}
+        assert session.statements[0].get_execution_options()["yield_per"] == 7
+
+    def test_export_geojson_async_empty(self):
+        sink = AsyncSink()
+        asyncio.run(
+            export_geojson_async(
+                AsyncSession([]), select(Observation), ObservationSchema, sink, compression="gzip"
+            )
+        )
+        assert json.loads(gzip.decompress(sink.getvalue())) == {
+            "type": "FeatureCollection",
+            "features": [],
+        }
+
+    def test_export_geojsonseq(self, query):
+        collection = io.StringIO()
+        export_geojson(query, ObservationSchema, collection)
+        features = json.loads(collection.getvalue())["features"]
+        fp = io.StringIO()
+        export_geojsonseq(query, ObservationSchema, fp)
+        records = fp.getvalue().split("\x1e")
+        assert records[0] == ""
+        assert [json.loads(record) for record in records[1:]] == features
+        assert all(record.endswith("\n") for record in records[1:])
+        fp = io.StringIO()
+        export_ndjson(query, ObservationSchema, fp)
+        assert [json.loads(line) for line in fp.getvalue().splitlines()] == features
+
+    def test_export_geopackage_delta(self, tmp_path):
+        def observation(pk, name, day):
+            return VersionedObservation(
+                pk=pk,
+                name=name,
+                update_date=datetime.datetime(2024, 1, day),
+                geom=from_shape(Point(pk, pk), srid=4326),
+            )
+
+        def read(filename):
+            with fiona.open(filename) as f:
+                return {
+                    feature["properties"]["pk"]: feature["properties"]["name"] for feature in f
+                }
+
+        filename = str(tmp_path / "delta.gpkg")
+        query = Query(observation(i, f"o{i}", 1 + i % 2) for i in range(10))
+        stats = export_geopackage_delta(
+            query, VersionedObservationSchema, filename, srid=4326, update_field="update_date"
+        )
+        assert stats == {"full": True, "upserted": 10, "deleted": 0}
+        assert read(filename) == {i: f"o{i}" for i in range(10)}
+
+        # o3 updated, o5 deleted, o10 created
+        query[3] = observation(3, "o3 bis", 3)
+        del query[5]
+        query.append(observation(10, "o10", 3))
+        stats = export_geopackage_delta(
+            query, VersionedObservationSchema, filename, srid=4326, update_field="update_date"
+        )
+        assert stats == {"full": False, "upserted": 2, "deleted": 1}
+        expected = {o.pk: o.name for o in query}
+        assert read(filename) == expected
+        with fiona.open(filename) as f:
+            assert f.tags()["delta_high_water_mark"] == "2024-01-03T00:00:00"
+        with sqlite3.connect(filename) as connection:
+            assert connection.execute("SELECT count(*) FROM rtree_delta_geom").fetchone() == (10,)
+
+        stats = export_geopackage_delta(
+            query, VersionedObservationSchema, filename, srid=4326, update_field="update_date"
+        )
+        assert stats == {"full": False, "upserted": 0, "deleted": 0}
+        assert read(filename) == expected
+
+        # the file is rebuilt when the exported columns change
+        stats = export_geopackage_delta(
+            query,
+            VersionedObservationSchema,
+            filename,
+            srid=4326,
+            update_field="update_date",
+            columns=["pk", "name"],
+        )
+        assert stats == {"full": True, "upserted": 10, "deleted": 0}
+        assert read(filename) == expected
+
+    def test_export_geopackage_delta_layers(self, tmp_path):
+        filename = str(tmp_path / "delta.gpkg")
+        schema = {"geometry": "Point", "properties": {"code": "int"}}
+        with fiona.open(filename, "w", "GPKG", schema, layer="other") as f:
+            f.write(
+                {"geometry": {"type": "Point", "coordinates": (0, 0)}, "properties": {"code": 1}}
+            )
+        query = Query(
+            VersionedObservation(
+                pk=i,
+                name=f"o{i}",
+                update_date=datetime.datetime(2024, 1, 1),
+                geom=from_shape(Point(i, i), srid=4326),
+            )
+            for i in range(3)
+        )
+        for columns in ([], ["pk", "name"]):
+            stats = export_geopackage_delta(
+                query,
+                VersionedObservationSchema,
+                filename,
+                srid=4326,
+                update_field="update_date",
+                layer="observations",
+                columns=columns,
+            )
+            assert stats == {"full": True, "upserted": 3, "deleted": 0}
+            # a full rebuild only replaces its own layer
+            assert sorted(fiona.listlayers(filename)) == ["observations", "other"]
+        with fiona.open(filename, layer="other") as f:
+            assert len(f) == 1
+
+    def test_export_geopackage_delta_overlap(self, tmp_path):
+        def observation(pk, name, day):
+            return VersionedObservation(
+                pk=pk,
+                name=name,
+                update_date=datetime.datetime(2024, 1, day),
+                geom=from_shape(Point(pk, pk), srid=4326),
+            )
+
+        def export(overlap=None):
+            return export_geopackage_delta(
+                query,
+                VersionedObservationSchema,
+                filename,
+                srid=4326,
+                update_field="update_date",
+                overlap=overlap,
+            )
+
+        filename = str(tmp_path / "delta.gpkg")
+        query = Query(observation(i, f"o{i}", 1 + i) for i in range(3))
+        export()
+        # committed after the export, with a date equal to the mark
+        query.append(observation(3, "o3", 3))
+        assert export() == {"full": False, "upserted": 0, "deleted": 0}
+        assert export(datetime.timedelta(days=1)) == {"full": False, "upserted": 2, "deleted": 0}
+        with fiona.open(filename) as f:
+            assert sorted(feature["properties"]["pk"] for feature in f) == [0, 1, 2, 3]
+
+    def test_export_geopackage_delta_uuid(self, tmp_path):
+        def observation(pk, name, day):
+            return UUIDObservation(
+                pk=pk,
+                name=name,
+                update_date=datetime.datetime(2024, 1, day),
+                geom=from_shape(Point(1, 1), srid=4326),
+            )
+
+        filename = str(tmp_path / "delta.gpkg")
+        pks = [uuid.uuid4() for _ in range(4)]
+        query = Query(observation(pk, f"o{i}", 1) for i, pk in enumerate(pks))
+        export_geopackage_delta(
+            query, UUIDObservationSchema, filename, srid=4326, update_field="update_date"
+        )
+        query[1] = observation(pks[1], "o1 bis", 2)
+        del query[2]
+        stats = export_geopackage_delta(
+            query, UUIDObservationSchema, filename, srid=4326, update_field="update_date"
+        )
+        assert stats == {"full": False, "upserted": 1, "deleted": 1}
+        with fiona.open(filename) as f:
+            assert sorted(
+                (feature["properties"]["pk"], feature["properties"]["name"]) for feature in f
+            ) == sorted((str(o.pk), o.name) for o in query)
+
+    def test_export_csv_resumable(self, tmp_path, query):
+        filename = str(tmp_path / "export.csv")
+        checkpoint = ExportCheckpoint(str(tmp_path / "export.checkpoint"), every=2)
+        with pytest.raises(RuntimeError):
+            export_csv_resumable(
+                FailingQuery(query, 5), ObservationSchema, filename, checkpoint, chunk_size=2
+            )
+        # 5 chunks written, last checkpoint after 4 chunks
+        assert checkpoint.load()["count"] == 8
+
+        stats = export_csv_resumable(query, ObservationSchema, filename, checkpoint, chunk_size=2)
+        assert stats == {"resumed": True, "count": 25}
+        assert checkpoint.load() is None
+        expected = io.StringIO(newline="")
+        export_csv(query, ObservationSchema, expected)
+        with open(filename, newline="", encoding="utf-8") as f:
+            assert f.read() == expected.getvalue()
+
+    def test_export_geopackage_resumable(self, tmp_path, query):
+        filename = str(tmp_path / "export.gpkg")
+        checkpoint = ExportCheckpoint(str(tmp_path / "export.checkpoint"), every=2)
+        for count in (5, 3):
+            with pytest.raises(RuntimeError):
+                export_geopackage_resumable(
+                    FailingQuery(query, count),
+                    ObservationSchema,
+                    filename,
+                    srid=4326,
+                    checkpoint=checkpoint,
+                    chunk_size=2,
+                )
+        assert checkpoint.load()["count"] == 12
+
+        stats = export_geopackage_resumable(
+            query, ObservationSchema, filename, srid=4326, checkpoint=checkpoint, chunk_size=2
+        )
+        assert stats == {"resumed": True, "count": 25}
+        assert checkpoint.load() is None
+        with fiona.open(filename) as f:
+            assert [feature["properties"]["pk"] for feature in f] == list(range(25))
+        with sqlite3.connect(filename) as connection:
+            assert connection.execute("SELECT count(*) FROM rtree_export_geom").fetchone() == (25,)
+
+    @pytest.mark.parametrize("bulk", [False, True])
+    def test_export_geopackage_layers(self, tmp_path, bulk):
+        query = Query(
+            Site(
+                pk=i,
+                name=f"s{i}",
+                geom_point=from_shape(Point(i, i), srid=4326),
+                geom_area=from_shape(box(i, i, i + 1, i + 1), srid=4326) if i % 3 else None,
+            )
+            for i in range(10)
+        )
+        filename = str(tmp_path / "sites.gpkg")
+        export_geopackage_layers(query, SiteSchema, filename, srid=4326, chunk_size=4, bulk=bulk)
+        assert fiona.listlayers(filename) == ["geom_point", "geom_area"]
+        with fiona.open(filename, layer="geom_point") as f:
+            points = list(f)
+        with fiona.open(filename, layer="geom_area") as f:
+            assert list(f.schema["properties"]) == ["pk", "name"]
+            areas = list(f)
+        assert [dict(p["properties"]) for p in points] == [
+            {"pk": i, "name": f"s{i}"} for i in range(10)
+        ]
+        assert [dict(a["properties"]) for a in areas] == [dict(p["properties"]) for p in points]
+        assert points[4]["geometry"]["coordinates"] == (4, 4)
+        assert areas[4]["geometry"]["type"] == "Polygon"
+        assert areas[3]["geometry"] is None
+
+        filename = str(tmp_path / "areas.gpkg")
+        export_geopackage_layers(
+            query, SiteSchema, filename, srid=4326, geometry_fields=["geom_area"], columns=["pk"]
+        )
+        assert fiona.listlayers(filename) == ["geom_area"]
+        with fiona.open(filename, layer="geom_area") as f:
+            assert list(f.schema["properties"]) == ["pk"]
+            assert len(f) == 10
@@ -0,0 +1,231 @@
+import datetime
+import json
+from decimal import Decimal
+
+import pytest
+from flask import Flask
+
+from geoalchemy2.shape import from_shape
+import shapely
+from shapely.geometry import Point, Polygon
+from sqlalchemy import (
+    Column,
+    Date,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
+from geoalchemy2 import Geometry
+
+from utils_flask_sqla_geo.generic import (
+    GenericQueryGeo,
+    GenericTableGeo,
+    extent_bounds,
+    get_geojson_feature,
+)
+from utils_flask_sqla_geo.utils import geojsonify
+
+
+class FakeQuery(list):
+    def with_entities(self, *entities):
+        return self
+
+    def where(self, *criteria):
+        return self
+
+
+class FakeSession:
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.statements = []
+
+    def get_bind(self):
+        return self
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        return [(1, '{"type":"Point","coordinates":[1,0]}')]
+
+
+def clusters_query(dialect, points):
+    table = Table(
+        "observation",
+        MetaData(),
+        Column("pk", Integer, primary_key=True),
+        Column("geom", Geometry("POINT", 4326)),
+    )
+    query = GenericQueryGeo.__new__(GenericQueryGeo)
+    query.DB = type("DB", (), {"session": FakeSession(dialect)})
+    query.view = type("View", (), {"tableDef": table})
+    query.geometry_field = "geom"
+    query.srid = 4326
+    rows = FakeQuery((from_shape(point, srid=4326),) for point in points)
+    query.filtered_query = lambda: rows
+    return query
+
+
+class TestGeneric:
+    def test_get_geojson_feature_from_geojson_text(self):
+        polygon = Polygon([(0, 0), (1.123456789, 0), (1, 1), (0, 0)])
+        # as returned by ST_AsGeoJSON(geom, 6, 0)
+        text = '{"type":"Polygon","coordinates":[[[0,0],[1.123457,0],[1,1],[0,0]]]}'
+        from_wkb = get_geojson_feature(from_shape(polygon, srid=4326))
+        from_text = get_geojson_feature(text)
+        assert json.dumps(from_text) == json.dumps(from_wkb)
+        assert list(from_text) == list(from_wkb)
+
+    def test_extent_bounds(self):
+        class FakeResult:
+            def __init__(self, row):
+                self.row = row
+
+            def one(self):
+                return self.row
+
+        class FakeBind:
+            def __init__(self, row):
+                self.row = row
+                self.statements = []
+
+            def execute(self, statement):
+                self.statements.append(statement)
+                return FakeResult(self.row)
+
+        extent = func.ST_EstimatedExtent("public", "table", "geom")
+        bind = FakeBind((Decimal("1.5"), 2, 3, 4))
+        assert extent_bounds(bind, extent, 2154) == [1.5, 2.0, 3.0, 4.0]
+        sql = str(bind.statements[0].compile(dialect=postgresql.dialect()))
+        assert "ST_Transform(ST_SetSRID(CAST(ST_EstimatedExtent(" in sql
+        assert "ST_XMin(" in sql
+
+        bind = FakeBind((None, None, None, None))
+        assert extent_bounds(bind, extent, 4326) is None
+        sql = str(bind.statements[0].compile(dialect=postgresql.dialect()))
+        assert "ST_Transform" not in sql
+
+    def test_as_clusters_python_fallback(self):
+        # cell_size = 1 : 0.5 and 1.4 fall in the same cell (floor(x + 0.5)),
+        # unlike with the half-to-even rounding of numpy
+        points = [Point(0.5, 0), Point(1.4, 0), Point(3, 0), Point(50, 50)]
+        query = clusters_query(sqlite.dialect(), points)
+        result = query.as_clusters((-1, -1, 10, 10), zoom=0, cells_per_tile=360)
+        assert [
+            (feature["geometry"]["coordinates"], feature["properties"]["count"])
+            for feature in result["features"]
+        ] == [([0.95, 0.0], 2), ([3.0, 0.0], 1)]
+        assert query.DB.session.statements == []
+
+    def test_as_clusters_postgresql(self):
+        query = clusters_query(postgresql.dialect(), [])
+        query.filtered_query = lambda: select(query.view.tableDef)
+        result = query.as_clusters((-1, -1, 10, 10), zoom=0, cells_per_tile=360)
+        assert result["features"][0]["properties"] == {"count": 1}
+        sql = str(query.DB.session.statements[0].compile(dialect=postgresql.dialect()))
+        assert "floor(ST_X(ST_Centroid(" in sql
+        assert "round(" not in sql
+
+    @pytest.fixture
+    def app(self):
+        return Flask(__name__)
+
+    def test_cache_validators_date_column(self, app):
+        table = Table(
+            "observation",
+            MetaData(),
+            Column("pk", Integer, primary_key=True),
+            Column("update_date", Date),
+        )
+
+        class ValidatorsQuery:
+            def with_entities(self, *entities):
+                self.entities = entities
+                return self
+
+            def select_from(self, table):
+                return self
+
+            def one(self):
+                return (datetime.date(2024, 5, 2),)
+
+        query = GenericQueryGeo.__new__(GenericQueryGeo)
+        query.view = type("View", (), {"tableDef": table})
+        query.schemaName, query.tableName = "public", "observation"
+        query.filters, query.limit, query.offset = {}, 100, 0
+        filtered = ValidatorsQuery()
+        query.filtered_query = lambda: filtered
+        validators = query.cache_validators("update_date")
+        # max(update_field) only, without count(*)
+        assert [str(entity) for entity in filtered.entities] == ["max(observation.update_date)"]
+        assert validators["last_modified"] == datetime.date(2024, 5, 2)
+
+        with app.test_request_context(
+            headers={"If-Modified-Since": "Thu, 02 May 2024 00:00:00 GMT"}
+        ):
+            assert geojsonify({}, **validators).status_code == 304
+        with app.test_request_context():
+            response = geojsonify({}, **validators)
+            assert response.headers["Last-Modified"] == "Thu, 02 May 2024 00:00:00 GMT"
+
+    def test_as_geofeature_sql_geojson(self):
+        engine = create_engine("sqlite://")
+
+        @event.listens_for(engine, "connect")
+        def register_functions(connection, record):
+            # stands for ST_AsGeoJSON, named AsGeoJSON by geoalchemy2 on sqlite
+            connection.create_function(
+                "AsGeoJSON",
+                3,
+                lambda geom, precision, options: shapely.to_geojson(shapely.from_wkb(geom)),
+            )
+
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE TABLE observation (pk INTEGER PRIMARY KEY, name TEXT, geom BLOB)"
+            )
+            for pk, geom in ((1, Point(1.5, 2)), (2, None), (3, Point(-1, 0))):
+                connection.exec_driver_sql(
+                    "INSERT INTO observation VALUES (?, ?, ?)",
+                    (pk, f"o{pk}", geom.wkb if geom else None),
+                )
+        table = Table(
+            "observation",
+            MetaData(),
+            Column("pk", Integer, primary_key=True),
+            Column("name", String),
+            Column("geom", Geometry("POINT", 4326)),
+        )
+        view = GenericTableGeo.__new__(GenericTableGeo)
+        view.tableDef, view.geometry_field = table, "geom"
+        view.serialize_columns, view.db_cols = view.get_serialized_columns()
+        query = GenericQueryGeo.__new__(GenericQueryGeo)
+        query.DB = type("DB", (), {"session": Session(bind=engine)})
+        query.view, query.geometry_field, query.sql_geojson = view, "geom", True
+        query.filters, query.limit, query.offset = {}, 100, 0
+
+        # the WKB column is not selected
+        statement = query.raw_query().statement
+        assert list(statement.selected_columns.keys()) == ["pk", "name", "_geojson"]
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        assert sql.startswith(
+            "SELECT observation.pk, observation.name, " "ST_AsGeoJSON(observation.geom, "
+        )
+
+        result = query.as_geofeature(bbox=True)
+        assert result["total"] == 3
+        features = result["items"]["features"]
+        assert [feature["geometry"]["coordinates"] for feature in features] == [
+            [1.5, 2.0],
+            [-1.0, 0.0],
+        ]
+        assert [feature["properties"] for feature in features] == [
+            {"pk": 1, "name": "o1"},
+            {"pk": 3, "name": "o3"},
+        ]
+        assert result["items"]["bbox"] == [-1.0, 0.0, 1.5, 2.0]
@@ -0,0 +1,203 @@
+import csv
+import io
+
+from flask_sqlalchemy import SQLAlchemy
+from geoalchemy2 import Geometry
+from shapely import wkb
+from shapely.geometry import Point
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from utils_flask_sqla_geo.cache import _SESSION_TABLES
+from utils_flask_sqla_geo.generic import GenericQueryGeo
+from utils_flask_sqla_geo.ingest import _merge_rows, features_to_rows, rows_to_csv
+from utils_flask_sqla_geo.serializers import geoserializable
+
+
+FEATURES = [
+    {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [6, 10, 1500]},
+        "properties": {"pk": 1, "name": 'say "hi"', "extra": "ignored"},
+    },
+    {"type": "Feature", "geometry": None, "properties": {"pk": 2, "name": ""}},
+]
+
+
+class FakeCursor:
+    def __init__(self, copies):
+        self.copies = copies
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, statement, fp):
+        self.copies.append((statement, fp.read()))
+
+
+class FakeConnection:
+    """Mimic a SQLAlchemy connection, recording executed statements and COPY commands."""
+
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.statements = []
+        self.copies = []
+        self.connection = self
+
+    def cursor(self):
+        return FakeCursor(self.copies)
+
+    def execute(self, statement, parameters=None):
+        self.statements.append(str(statement.compile(dialect=self.dialect)))
+        return []
+
+
+class FakeSession:
+    def __init__(self, dialect):
+        self._connection = FakeConnection(dialect)
+        self.info = {}
+
+    def connection(self):
+        return self._connection
+
+
+db = SQLAlchemy()
+
+
+@geoserializable
+class Station(db.Model):
+    pk = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String)
+    status = db.Column(db.String, nullable=False, server_default="new")
+    geom = db.Column(Geometry("POINT", 4326))
+
+
+def station_features():
+    return [
+        {"type": "Feature", "geometry": None, "properties": {"name": "a"}},
+        {"type": "Feature", "geometry": None, "properties": {"name": "b", "status": "ok"}},
+        {"type": "Feature", "geometry": None, "properties": {"name": "c"}},
+    ]
+
+
+class TestIngest:
+    def test_features_to_rows(self):
+        rows = features_to_rows(FEATURES, ["pk", "name"], "geom")
+        assert [(row["pk"], row["name"]) for row in rows] == [(1, 'say "hi"'), (2, "")]
+        geom = wkb.loads(rows[0]["geom"], hex=True)
+        assert geom.equals(Point(6, 10)) and not geom.has_z
+        assert rows[0]["geom"].startswith("0101000020E6100000")  # EWKB point, srid 4326
+        assert rows[1]["geom"] is None
+        # absent properties are left out (database defaults)
+        rows = features_to_rows(FEATURES, ["pk", "name", "status"], "geom")
+        assert list(rows[1]) == ["pk", "name", "geom"]
+
+    def test_rows_to_csv(self):
+        rows = features_to_rows(FEATURES, ["pk", "name"], "geom")
+        data = rows_to_csv(rows, ["pk", "name", "geom"])
+        assert data.splitlines()[1] == '"2","",'  # empty string quoted, NULL unquoted
+        assert next(csv.reader(io.StringIO(data)))[:2] == ["1", 'say "hi"']
+
+    def test_bulk_from_geofeatures_postgresql(self):
+        session = FakeSession(postgresql.dialect())
+        assert Station.bulk_from_geofeatures(session, station_features()) == 3
+        copies = session.connection().copies
+        # serial primary key and server default are not written
+        assert copies == [
+            ('COPY station ("name", "geom") FROM STDIN WITH (FORMAT csv)', '"a",\n"c",\n'),
+            (
+                'COPY station ("name", "status", "geom") FROM STDIN WITH (FORMAT csv)',
+                '"b","ok",\n',
+            ),
+        ]
+        # cache invalidated when the session commits
+        assert session.info[_SESSION_TABLES] == {"station"}
+
+    def test_bulk_insert_geofeatures_upsert(self):
+        query = GenericQueryGeo.__new__(GenericQueryGeo)
+        query.DB = type("DB", (), {"session": FakeSession(postgresql.dialect())})
+        query.view = type("View", (), {"tableDef": Station.__table__})
+        query.geometry_field = "geom"
+        features = [
+            {"type": "Feature", "geometry": None, "properties": {"pk": 1, "name": "a"}},
+            {"type": "Feature", "geometry": None, "properties": {"pk": 1, "name": "b"}},
+        ]
+        assert query.bulk_insert_geofeatures(features, upsert=True) == 2
+        connection = query.DB.session.connection()
+        create, insert, drop = connection.statements
+        assert create.startswith('CREATE TEMPORARY TABLE "_staging_station_')
+        assert (
+            'SELECT "pk", "name", "geom", 0::bigint AS "_staging_rank" FROM station WITH NO DATA'
+            in create
+        )
+        assert connection.copies[0][0].endswith(
+            '("pk", "name", "geom", "_staging_rank") FROM STDIN WITH (FORMAT csv)'
+        )
+        assert connection.copies[0][1] == '"1","a",,"0"\n"1","b",,"1"\n'
+        # duplicate keys: only the last row of the chunk is merged
+        staging = create.split('"')[1]
+        assert " ".join(insert.replace(f"{staging}.", "").split()) == (
+            "INSERT INTO station (pk, name, geom) SELECT DISTINCT ON (pk) pk, name, geom "
+            f"FROM {staging} ORDER BY pk, _staging_rank DESC "
+            "ON CONFLICT (pk) DO UPDATE SET name = excluded.name, geom = excluded.geom"
+        )
+        assert "status" not in insert
+        assert drop.startswith('DROP TABLE "_staging_station_')
+
+    def test_bulk_from_geofeatures_sqlite(self):
+        session = FakeSession(sqlite.dialect())
+        Station.bulk_from_geofeatures(session, station_features(), upsert=True)
+        statements = session.connection().statements
+        assert len(statements) == 2
+        assert statements[0].startswith("INSERT INTO station (name, geom) VALUES")
+        assert "status" not in statements[0] and "pk" not in statements[0].split("ON CONFLICT")[0]
+        assert "DO UPDATE SET name = excluded.name, geom = excluded.geom" in statements[0]
+
+    def test_bulk_from_geofeatures_upsert_fallback(self):
+        # no ON CONFLICT support: existing keys looked up, then updated or inserted
+        session = FakeSession(mysql.dialect())
+        features = [
+            {"type": "Feature", "geometry": None, "properties": {"pk": 1, "name": "a"}},
+        ]
+        assert Station.bulk_from_geofeatures(session, features, upsert=True) == 1
+        lookup, insert = session.connection().statements
+        assert lookup.startswith("SELECT station.pk \nFROM station \nWHERE station.pk IN (")
+        assert insert.startswith("INSERT INTO station (pk, name, geom) VALUES")
+
+    def test_merge_rows(self):
+        table = Table(
+            "station",
+            MetaData(),
+            Column("pk", Integer, primary_key=True),
+            Column("name", String),
+            Column("status", String),
+        )
+        engine = create_engine("sqlite://")
+        with engine.begin() as connection:
+            table.create(connection)
+            connection.execute(
+                table.insert(),
+                [{"pk": 1, "name": "a", "status": "ok"}, {"pk": 2, "name": "b", "status": None}],
+            )
+            rows = [
+                {"pk": 1, "name": "x"},
+                {"pk": 3, "name": "y"},
+                {"pk": 1, "name": "z"},
+                {"pk": 3, "name": "t"},
+            ]
+            _merge_rows(connection, table, ["pk", "name"], rows, ["pk"])
+            # last duplicate wins, columns left out are kept
+            assert connection.execute(select(table).order_by(table.c.pk)).fetchall() == [
+                (1, "z", "ok"),
+                (2, "b", None),
+                (3, "t", None),
+            ]
+            # primary key not given (serial): plain insert
+            _merge_rows(connection, table, ["name"], [{"name": "u"}, {"name": "u"}], ["pk"])
+            assert connection.execute(select(table.c.name).where(table.c.pk > 3)).fetchall() == [
+                ("u",),
+                ("u",),
+            ]
@@ -0,0 +1,157 @@
+"""
+Memory budget of the streaming code paths
+
+Each serializer / exporter is run against synthetic datasets of growing size,
+generated lazily, under tracemalloc: the peak of traced memory must stay
+(almost) constant. A path which silently materializes its input or output
+(list instead of generator) sees its peak grow linearly and fails.
+"""
+
+import gc
+import json
+import tracemalloc
+
+import pytest
+from geoalchemy2 import Geometry
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+from utils_flask_sqla_geo.export import (
+    export_csv,
+    export_geojson,
+    export_geojsonseq,
+    export_geopackage,
+    export_json,
+)
+from utils_flask_sqla_geo.mixins import GeoFeatureCollectionMixin
+from utils_flask_sqla_geo.schema import GeoAlchemyAutoSchema
+from utils_flask_sqla_geo.serializers import geoserializable
+
+
+SIZES = (200, 1600)
+# peak of the largest dataset / peak of the smallest one, for 8 times more data
+MAX_GROWTH = 1.5
+CHUNK_SIZE = 50
+
+Base = declarative_base()
+
+
+@geoserializable(geoCol="geom", idCol="pk")
+class Site(Base):
+    __tablename__ = "site"
+    pk = Column(Integer, primary_key=True)
+    name = Column(String)
+    comment = Column(String)
+    geom = Column(Geometry("POINT", 4326))
+
+
+class SiteSchema(GeoAlchemyAutoSchema):
+    class Meta:
+        model = Site
+        feature_id = "pk"
+
+
+class SyntheticQuery(GeoFeatureCollectionMixin):
+    """Mimic a SQLAlchemy query whose rows are generated on the fly."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def yield_per(self, count):
+        for i in range(self.count):
+            yield Site(
+                pk=i,
+                name=f"site {i}",
+                comment="x" * 100,
+                geom=from_shape(Point(i % 360 - 180, i % 180 - 90), srid=4326),
+            )
+
+    def all(self):
+        return list(self.yield_per(CHUNK_SIZE))
+
+
+class NullWriter:
+    """File-like object discarding what is written."""
+
+    def write(self, data):
+        return len(data)
+
+
+def peak_memory(run, count):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(SyntheticQuery(count))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+
+def run_schema_dump(query):
+    data = SiteSchema(as_geojson=True).dump(query.yield_per(CHUNK_SIZE), many=True)
+    consume(json.JSONEncoder().iterencode(data))
+
+
+def run_as_geofeatures(query):
+    consume(Site.as_geofeatures(query.yield_per(CHUNK_SIZE), chunk_size=CHUNK_SIZE))
+
+
+def run_geofeaturecollection(query):
+    data = query.as_geofeaturecollection(stream=True, chunk_size=CHUNK_SIZE)
+    consume(json.JSONEncoder().iterencode(data))
+
+
+def exporter(export, **kwargs):
+    def run(query):
+        export(query, SiteSchema, NullWriter(), chunk_size=CHUNK_SIZE, **kwargs)
+
+    return run
+
+
+STREAMING_PATHS = {
+    "schema_dump": run_schema_dump,
+    "as_geofeatures": run_as_geofeatures,
+    "geofeaturecollection": run_geofeaturecollection,
+    "export_csv": exporter(export_csv),
+    "export_json": exporter(export_json),
+    "export_geojson": exporter(export_geojson),
+    "export_geojsonseq": exporter(export_geojsonseq),
+}
+
+
+class TestMemoryBudget:
+    def assert_bounded(self, run):
+        run(SyntheticQuery(CHUNK_SIZE))  # warm up caches (schemas, plans, ...)
+        small, large = (peak_memory(run, count) for count in SIZES)
+        assert large < small * MAX_GROWTH, f"peak memory {small} -> {large} bytes"
+
+    @pytest.mark.parametrize("name", STREAMING_PATHS)
+    def test_streaming_paths(self, name):
+        self.assert_bounded(STREAMING_PATHS[name])
+
+    @pytest.mark.parametrize("bulk", [False, True])
+    def test_export_geopackage(self, tmp_path, bulk):
+        paths = iter(range(len(SIZES) + 1))
+
+        def run(query):
+            export_geopackage(
+                query,
+                SiteSchema,
+                str(tmp_path / f"export_{next(paths)}.gpkg"),
+                srid=4326,
+                chunk_size=CHUNK_SIZE,
+                bulk=bulk,
+            )
+
+        self.assert_bounded(run)
+
+    def test_harness_detects_materialization(self):
+        with pytest.raises(AssertionError):
+            self.assert_bounded(lambda query: query.as_geofeaturecollection())
@@ -1,3 +1,4 @@
+import io
 import pytest
 import json
 from json import JSONEncoder
@@ -10,10 +11,17 @@ from sqlalchemy import Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2 import Geometry
 from geoalchemy2.shape import from_shape, to_shape
+from shapely import wkt
 from shapely.geometry import Point
 
 from utils_flask_sqla.schema import SmartRelationshipsMixin
-from utils_flask_sqla_geo.schema import GeoAlchemyAutoSchema
+from utils_flask_sqla_geo.enrichment import ReferenceLayer, SpatialEnrichment
+from utils_flask_sqla_geo.schema import (
+    GeoAlchemyAutoSchema,
+    FeatureSchema,
+    FeatureCollectionSchema,
+    LoadResult,
+)
 
 
 # TODO:
@@ -183,6 +191,14 @@ class TestGeoSchema:
         }
         assert ParentSchema(as_geojson=True).dump([p1, p2], many=True) == expected
 
+    def test_to_geojson_feature_collection_bbox(self, p1, p2):
+        p3 = Parent(pk=3, name="p3", geom=None)
+        data = ParentSchema(as_geojson=True, bbox=True).dump([p1, p2, p3], many=True)
+        assert data["bbox"] == [6.0, 6.0, 10.0, 10.0]
+        assert len(data["features"]) == 3
+        data = ParentSchema(as_geojson=True, bbox=True).dump([], many=True)
+        assert "bbox" not in data
+
     def test_from_json(self):
         p1 = ParentSchema().load(
             {
@@ -498,3 +514,227 @@ class TestGeoSchema:
         d = json.loads(result)
         expected = schema.dump(list(generate_objects()), many=True)
         assert d == expected
+
+    def test_from_geojson_feature_collection_invalid_geom(self):
+        bowtie = {
+            "type": "Polygon",
+            "coordinates": [[(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)]],
+        }
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": (6.0, 10.0)},
+                "properties": {"pk": 1},
+            },
+            {"type": "Feature", "geometry": bowtie, "properties": {"pk": 2}},
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": (6.0, 100.0)},
+                "properties": {"pk": 3},
+            },
+            {"type": "Feature", "geometry": None, "properties": {"pk": 4}},
+        ]
+        with pytest.raises(ValidationError) as excinfo:
+            ParentSchema(as_geojson=True).load(
+                {"type": "FeatureCollection", "features": features}, many=True
+            )
+        assert excinfo.value.messages == {
+            1: {"geom": ["Invalid geometry."]},
+            2: {"geom": {"coordinates": {1: ["Latitude must be between -90, 90"]}}},
+        }
+        p1, p4 = ParentSchema(as_geojson=True).load(
+            {"type": "FeatureCollection", "features": [features[0], features[3]]}, many=True
+        )
+        assert to_shape(p1["geom"]).equals(Point(6, 10))
+        assert p4["geom"] is None
+
+    def test_from_geojson_feature_collection_on_invalid(self):
+        bowtie = {
+            "type": "Polygon",
+            "coordinates": [[(0, 0), (2, 2), (2, 0), (0, 2), (0, 0)]],
+        }
+        flat = {"type": "Polygon", "coordinates": [[(0, 0), (1, 1), (1, 1), (0, 0)]]}
+        features = [
+            {"type": "Feature", "geometry": bowtie, "properties": {"pk": 1}},
+            {"type": "Feature", "geometry": flat, "properties": {"pk": 2}},
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": (6.0, 10.0)},
+                "properties": {"pk": 3},
+            },
+        ]
+        collection = {"type": "FeatureCollection", "features": features}
+
+        result = ParentSchema(as_geojson=True, on_invalid="drop").load(collection, many=True)
+        assert isinstance(result, LoadResult)
+        assert [p["pk"] for p in result] == [3]
+        assert (result.repaired, result.dropped) == ([], [0, 1])
+
+        with pytest.raises(ValidationError) as excinfo:
+            ParentSchema(as_geojson=True, on_invalid="make_valid").load(collection, many=True)
+        # the flat polygon cannot be repaired
+        assert excinfo.value.messages == {1: {"geom": ["Invalid geometry."]}}
+
+        schema = ParentSchema(as_geojson=True, on_invalid="make_valid")
+        features[2]["geometry"] = {"type": "Point", "coordinates": (6.0, 100.0)}
+        with pytest.raises(ValidationError) as excinfo:
+            schema.load({"type": "FeatureCollection", "features": features[::2]}, many=True)
+        assert list(excinfo.value.messages) == [1]
+
+        features[2]["geometry"] = {"type": "Point", "coordinates": (6.0, 10.0)}
+        p1, p3 = schema.load({"type": "FeatureCollection", "features": features[::2]}, many=True)
+        assert to_shape(p1["geom"]).is_valid
+        assert to_shape(p1["geom"]).geom_type == "MultiPolygon"
+        assert to_shape(p3["geom"]).equals(Point(6, 10))
+
+        # dropped items are not counted in error indexes
+        features[2]["geometry"] = {"type": "Point", "coordinates": (6.0, 100.0)}
+        with pytest.raises(ValidationError) as excinfo:
+            ParentSchema(as_geojson=True, on_invalid="drop").load(collection, many=True)
+        assert list(excinfo.value.messages) == [2]
+
+        p = ParentSchema(as_geojson=True, on_invalid="make_valid").load(features[0])
+        assert to_shape(p["geom"]).is_valid
+        with pytest.raises(ValidationError):
+            ParentSchema(as_geojson=True, on_invalid="drop").load(features[0])
+        with pytest.raises(ValueError):
+            ParentSchema(as_geojson=True, on_invalid="fix")
+
+    def test_load_stream(self):
+        features = [
+            {
+                "id": i,
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [i, i]},
+                "properties": {"pk": i, "name": f"p{i}"},
+            }
+            for i in range(5)
+        ]
+        document = {"type": "FeatureCollection", "features": features}
+        fp = io.BytesIO(json.dumps(document).encode())
+        batches = list(ParentSchema(as_geojson=True).load_stream(fp, batch_size=2))
+        assert [len(batch) for batch in batches] == [2, 2, 1]
+        loaded = [item for batch in batches for item in batch]
+        assert [p["name"] for p in loaded] == [f"p{i}" for i in range(5)]
+        assert to_shape(loaded[3]["geom"]).equals(Point(3, 3))
+
+        # values longer than the reads
+        for feature in features:
+            feature["properties"]["name"] *= 100
+        fp = io.StringIO(json.dumps(document))
+        batches = list(ParentSchema(as_geojson=True).load_stream(fp, batch_size=2, chunk_size=64))
+        loaded = [item for batch in batches for item in batch]
+        assert [p["name"] for p in loaded] == [f"p{i}" * 100 for i in range(5)]
+
+        fp = io.StringIO(json.dumps([{"pk": 1, "name": "p1"}, {"pk": 2, "name": "p2"}]))
+        assert list(ParentSchema().load_stream(fp)) == [
+            [{"pk": 1, "name": "p1"}, {"pk": 2, "name": "p2"}]
+        ]
+
+        features[3]["geometry"]["coordinates"] = [3, 100]
+        fp = io.StringIO(json.dumps(document))
+        with pytest.raises(ValidationError) as excinfo:
+            list(ParentSchema(as_geojson=True).load_stream(fp, batch_size=2))
+        assert list(excinfo.value.messages) == [3]
+
+        fp = io.StringIO(json.dumps({"type": "FeatureCollection", "crs": {}, "features": []}))
+        with pytest.raises(ValidationError, match="'crs': \\['Unknown field.'\\]"):
+            list(ParentSchema(as_geojson=True).load_stream(fp))
+
+    def test_load_stream_members_order(self):
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [1, 1]},
+            "properties": {"pk": 1, "name": "p1"},
+        }
+        # members of a JSON object have no required order
+        fp = io.StringIO(json.dumps({"features": [feature], "type": "FeatureCollection"}))
+        batches = list(ParentSchema(as_geojson=True).load_stream(fp))
+        assert [p["name"] for batch in batches for p in batch] == ["p1"]
+
+        # required members are checked once the features have been read
+        fp = io.StringIO(json.dumps({"features": [feature]}))
+        with pytest.raises(ValidationError, match="'type': \\['Missing data"):
+            list(ParentSchema(as_geojson=True).load_stream(fp))
+
+    def test_cached(self):
+        class CachedSchema(ParentSchema):
+            cache_size = 2
+
+        schema = CachedSchema.cached(as_geojson=True, only=["pk", "name"])
+        assert CachedSchema.cached(only=("name", "pk"), as_geojson=True) is schema
+        assert CachedSchema.cached(only=["pk"], as_geojson=True) is not schema
+        assert CachedSchema.cached(only=["pk", "name"]) is not schema
+        assert CachedSchema.cache_info() == (1, 3, 2, 2)
+        # least recently used instance has been evicted
+        assert CachedSchema.cached(as_geojson=True, only=["pk", "name"]) is not schema
+        assert CachedSchema.cache_info().misses == 4
+        assert ParentSchema.cached() is not CachedSchema.cached()
+
+        # instances with enrichments are not cached (they keep their reference layers alive)
+        layer = ReferenceLayer([Point(0, 0).buffer(1)], [{"code": 1}])
+        enrichments = (SpatialEnrichment(layer),)
+        info = CachedSchema.cache_info()
+        schema = CachedSchema.cached(enrichments=enrichments)
+        assert schema.enrichments == enrichments
+        assert CachedSchema.cached(enrichments=enrichments) is not schema
+        assert CachedSchema.cache_info() == info
+
+    def test_cached_load_session(self):
+        class InstanceSchema(ParentSchema):
+            class Meta(ParentSchema.Meta):
+                load_instance = True
+
+        class FakeSession:
+            def __init__(self, name):
+                self.parent = Parent(pk=1, name=name)
+
+            def get(self, model, filters):
+                return self.parent
+
+        s1, s2 = FakeSession("s1"), FakeSession("s2")
+        schema = InstanceSchema.cached()
+        assert schema.load({"pk": 1, "name": "a"}, session=s1) is s1.parent
+        assert InstanceSchema.cached() is schema
+        # the session of the previous load is not kept on the shared instance
+        assert schema.session is None
+        assert schema.load({"pk": 1, "name": "b"}, session=s2) is s2.parent
+        assert (s1.parent.name, s2.parent.name) == ("a", "b")
+        loaded = schema.load({"pk": 1, "name": "c"}, transient=True)
+        assert loaded not in (s1.parent, s2.parent)
+        assert not schema.transient
+        with pytest.raises(ValueError):
+            schema.load({"pk": 1, "name": "d"})
+
+        # not shared instances keep them, as with marshmallow-sqlalchemy
+        schema = InstanceSchema()
+        schema.load({"pk": 1, "name": "a"}, session=s1)
+        assert schema.session is s1
+
+    def test_to_geojson_same_as_feature_schema(self, p1, p2):
+        schema = ParentSchema(as_geojson=True)
+        features = [
+            {
+                "id": p.pk,
+                "geometry": to_shape(p.geom).__geo_interface__,
+                "properties": {"pk": p.pk, "name": p.name},
+            }
+            for p in (p1, p2)
+        ]
+        assert json.dumps(schema.dump(p1)) == json.dumps(FeatureSchema().dump(features[0]))
+        assert json.dumps(schema.dump([p1, p2], many=True)) == json.dumps(
+            FeatureCollectionSchema().dump({"features": features})
+        )
+
+    def test_target_srid(self, p1, p2):
+        p1.geom = from_shape(Point(6, 45), srid=4326)
+        schema = ParentSchema(only=["pk", "geom"], target_srid=2154)
+        data = schema.dump([p1, p2, Parent(pk=3)], many=True)
+        x, y = wkt.loads(data[0]["geom"]).coords[0]
+        assert (round(x), round(y)) == (936341, 6437909)
+        assert data[2]["geom"] is None
+
+        data = ParentSchema(as_geojson=True, target_srid=2154).dump(p1)
+        x, y = data["geometry"]["coordinates"]
+        assert (round(x), round(y)) == (936341, 6437909)
+        assert data["properties"] == {"pk": 1, "name": "p1"}
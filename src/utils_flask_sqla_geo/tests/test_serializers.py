@@ -1,12 +1,25 @@
+import asyncio
+import json
+from decimal import Decimal
 import pytest
 from unittest import TestCase
 
 from shapely import wkt
+from shapely.geometry import Point
 
 from flask_sqlalchemy import SQLAlchemy
 from geoalchemy2 import Geometry
+from geoalchemy2.shape import from_shape, to_shape
+from geojson import Feature
+from sqlalchemy.dialects import postgresql
+from utils_flask_sqla.errors import UtilsSqlaError
 
-from utils_flask_sqla_geo.serializers import geoserializable
+from utils_flask_sqla_geo.serializers import (
+    geoserializable,
+    sqla_query_to_geojson_async,
+    sqla_query_to_grid_geojson,
+    txt_query_as_geojson_async,
+)
 
 
 db = SQLAlchemy()
@@ -54,3 +67,153 @@ class TestSerializers:
             },
             d,
         )
+
+    def test_as_geofeature(self):
+        @geoserializable(geoCol="geom", idCol="pk")
+        class TestModel3(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String)
+            geom = db.Column(Geometry("GEOMETRY", 4326))
+
+        o1 = TestModel3(pk=1, name="o1", geom=from_shape(Point(6.1234567, 10), srid=4326))
+        o2 = TestModel3(pk=2, name="o2")
+        expected1 = Feature(
+            id="1", geometry=Point(6.1234567, 10), properties={"pk": 1, "name": "o1"}
+        )
+        expected2 = Feature(
+            id="2",
+            geometry={"type": "Point", "coordinates": [0, 0]},
+            properties={"pk": 2, "name": "o2"},
+        )
+
+        f1 = o1.as_geofeature()
+        assert isinstance(f1, Feature)
+        assert json.dumps(f1) == json.dumps(expected1)
+        assert json.dumps(o2.as_geofeature()) == json.dumps(expected2)
+        assert o1.as_geofeature(fields=["name"])["properties"] == {"name": "o1"}
+
+        features = TestModel3.as_geofeatures(iter([o1, o2]), chunk_size=1)
+        assert json.dumps(list(features)) == json.dumps([expected1, expected2])
+
+    def test_as_geofeature_empty_geometries(self):
+        @geoserializable(geoCol="geom", idCol="pk")
+        class TestModel7(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            geom = db.Column(Geometry("GEOMETRY", 4326))
+
+        objects = [
+            TestModel7(pk=1, geom=from_shape(wkt.loads("POINT EMPTY"), srid=4326)),
+            TestModel7(pk=2, geom=from_shape(wkt.loads("POLYGON EMPTY"), srid=4326)),
+        ]
+        # written as null geometries, as by the geojson library
+        expected = [
+            json.dumps(Feature(id=str(o.pk), geometry=to_shape(o.geom), properties={"pk": o.pk}))
+            for o in objects
+        ]
+        assert [json.dumps(o.as_geofeature()) for o in objects] == expected
+        features = TestModel7.as_geofeatures(objects)
+        assert [json.dumps(feature) for feature in features] == expected
+        assert all(o.as_geofeature()["geometry"] is None for o in objects)
+
+    def test_from_geofeature_on_invalid(self):
+        @geoserializable
+        class TestModel5(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            name = db.Column(db.String)
+            geom = db.Column(Geometry("GEOMETRY", 4326))
+
+        bowtie = {
+            "type": "Polygon",
+            "coordinates": [[[0, 0], [2, 2], [2, 0], [0, 2], [0, 0]]],
+        }
+        feature = {"type": "Feature", "geometry": bowtie, "properties": {"name": "o"}}
+
+        o = TestModel5()
+        assert o.from_geofeature(feature)
+        assert not to_shape(o.geom).is_valid
+        with pytest.raises(UtilsSqlaError):
+            TestModel5().from_geofeature(feature, on_invalid="reject")
+        o = TestModel5()
+        assert o.from_geofeature(feature, on_invalid="drop") is False
+        assert o.name is None and o.geom is None
+        o = TestModel5()
+        assert o.from_geofeature(feature, on_invalid="make_valid")
+        assert o.name == "o"
+        assert to_shape(o.geom).is_valid
+        assert to_shape(o.geom).geom_type == "MultiPolygon"
+
+    def test_grid_invalid_parameters(self):
+        class TestModel4(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            geom = db.Column(Geometry("POINT", 4326))
+
+        query = db.select(TestModel4)
+        with pytest.raises(ValueError):
+            sqla_query_to_grid_geojson(None, query, "geom", 1, shape="triangle")
+        with pytest.raises(ValueError):
+            sqla_query_to_grid_geojson(None, query, "geom", 1, aggregates={"x": ("median", "pk")})
+
+    def test_grid_statement(self):
+        class TestModel6(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            value = db.Column(db.Integer)
+            geom = db.Column(Geometry("POINT", 2154))
+
+        class FakeSession:
+            def execute(self, statement):
+                self.sql = str(statement.compile(dialect=postgresql.dialect()))
+                return [('{"type": "Polygon", "coordinates": []}', 2, Decimal("3"))]
+
+        session = FakeSession()
+        query = db.select(TestModel6)
+        result = sqla_query_to_grid_geojson(
+            session, query, "geom", 1000, aggregates={"total": ("sum", "value")}, geom_srid=2154
+        )
+        assert result["features"][0]["properties"] == {"count": 2, "total": 3.0}
+        sql = " ".join(session.sql.split())
+        assert "JOIN ST_HexagonGrid(" in sql
+        assert "ON ST_Intersects(cells.geom, anon_" in sql
+        assert "GROUP BY cells.i, cells.j" in sql
+        assert "ST_AsGeoJSON(ST_Transform(cells.geom," in sql
+
+        sqla_query_to_grid_geojson(session, query, "geom", 1000, shape="square")
+        assert "JOIN ST_SquareGrid(" in session.sql
+
+    def test_query_as_geojson_async(self):
+        class TestModel8(db.Model):
+            pk = db.Column(db.Integer, primary_key=True)
+            geom = db.Column(Geometry("POINT", 2154))
+
+        collection = {"type": "FeatureCollection", "features": []}
+
+        class FakeAsyncSession:
+            def __init__(self, rows):
+                self.rows = rows
+
+            async def execute(self, statement):
+                await asyncio.sleep(0)
+                self.sql = " ".join(statement.text.split())
+                return iter(self.rows)
+
+        session = FakeAsyncSession([(collection,)])
+        result = asyncio.run(
+            txt_query_as_geojson_async(session, "SELECT * FROM t", "pk", "geom", keep_id_col=True)
+        )
+        assert result is collection
+        assert "'geometry', ST_AsGeoJSON(geom)::jsonb" in session.sql
+        assert "to_jsonb(row) - 'geom' ) AS feature" in session.sql
+        assert "FROM ( SELECT * FROM t ) row" in session.sql
+
+        query = db.select(TestModel8).where(TestModel8.pk > 10)
+        result = asyncio.run(
+            sqla_query_to_geojson_async(session, query, "pk", "geom", geom_srid=2154)
+        )
+        assert result is collection
+        assert "ST_AsGeoJSON(st_transform(geom, 4326))::jsonb" in session.sql
+        assert "to_jsonb(row) - 'geom' - 'pk'" in session.sql
+        assert "WHERE test_model8.pk > 10" in session.sql
+
+        assert (
+            asyncio.run(txt_query_as_geojson_async(FakeAsyncSession([]), "q", "pk", "geom"))
+            is None
+        )
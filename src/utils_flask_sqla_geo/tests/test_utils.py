@@ -0,0 +1,177 @@
+import gzip
+import io
+import json
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+from utils_flask_sqla_geo.cache import CachedJSON
+from utils_flask_sqla_geo.utils import (
+    CompressedWriter,
+    JSONStreamReader,
+    JsonifiableGenerator,
+    geojsonify,
+    geojsonify_stream,
+    geojsonseq_stream,
+)
+
+
+class TestJSONStreamReader:
+    def test_iter_array(self):
+        items = [
+            {"a": "x" * 20, "b": [1.5, 2e-10, None, True]},
+            123456789,
+            "é\U0001f600",
+            [],
+            False,
+        ]
+        for chunk_size in (1, 3, 7, 1000):
+            reader = JSONStreamReader(io.BytesIO(json.dumps(items).encode()), chunk_size)
+            assert list(reader.iter_array()) == items
+
+    def test_iter_array_long_strings(self):
+        items = [{"a": "x" * 200}, {"b": "y" * 500}]
+        for chunk_size in (7, 64, 100):
+            reader = JSONStreamReader(io.BytesIO(json.dumps(items).encode()), chunk_size)
+            assert list(reader.iter_array()) == items
+
+    def test_syntax_error_early(self):
+        items = [{"a": 1, "b": "x" * 100}] * 10000
+        fp = io.BytesIO(('[{"a": 1 "b": 2}, ' + json.dumps(items)[1:]).encode())
+        reader = JSONStreamReader(fp, 64)
+        with pytest.raises(json.JSONDecodeError):
+            list(reader.iter_array())
+        # the rest of the stream has not been read
+        assert fp.tell() <= 128
+
+    def test_iter_object(self):
+        reader = JSONStreamReader(io.StringIO('{"a": 1, "b": [1, 2] , "c": {}}'), 2)
+        members = {}
+        for key, _ in reader.iter_object():
+            if key == "b":
+                members[key] = list(reader.iter_array())
+            else:
+                members[key] = reader.read_value()
+        assert members == {"a": 1, "b": [1, 2], "c": {}}
+        assert reader.peek() is None
+
+    def test_invalid(self):
+        reader = JSONStreamReader(io.StringIO('[{"a": 1}, {"a": }]'), 4)
+        with pytest.raises(ValueError):
+            list(reader.iter_array())
+
+
+class TestCompressedWriter:
+    def test_write(self):
+        fp = io.BytesIO()
+        with CompressedWriter(fp, "gzip") as writer:
+            writer.write(b"abc" * 1000)
+        assert gzip.decompress(fp.getvalue()) == b"abc" * 1000
+
+    def test_error_leaves_stream_unfinished(self):
+        fp = io.BytesIO()
+        with pytest.raises(RuntimeError):
+            with CompressedWriter(fp, "gzip") as writer:
+                writer.write(b"abc" * 1000)
+                raise RuntimeError
+        with pytest.raises(EOFError):
+            gzip.decompress(fp.getvalue())
+
+
+class TestConditionalResponses:
+    @pytest.fixture
+    def app(self):
+        return Flask(__name__)
+
+    @pytest.mark.parametrize("view", [geojsonify, geojsonify_stream])
+    def test_etag(self, app, view):
+        calls = []
+
+        def data():
+            calls.append(1)
+            return {"type": "FeatureCollection", "features": JsonifiableGenerator(iter([]))}
+
+        with app.test_request_context():
+            response = view(data, etag="abc")
+            assert response.status_code == 200
+            assert response.headers["ETag"] == '"abc"'
+            assert response.mimetype == "application/geo+json"
+            assert json.loads(response.get_data()) == {"type": "FeatureCollection", "features": []}
+        with app.test_request_context(headers={"If-None-Match": '"abc"'}):
+            response = view(data, etag="abc")
+            assert response.status_code == 304
+            assert response.headers["ETag"] == '"abc"'
+        assert len(calls) == 1
+
+    def test_last_modified(self, app):
+        last_modified = datetime(2024, 5, 2, 10, 30, 15, 123)
+        with app.test_request_context(
+            headers={"If-Modified-Since": "Thu, 02 May 2024 10:30:15 GMT"}
+        ):
+            assert geojsonify({}, last_modified=last_modified).status_code == 304
+        with app.test_request_context(
+            headers={"If-Modified-Since": "Thu, 02 May 2024 10:30:14 GMT"}
+        ):
+            response = geojsonify({}, last_modified=last_modified)
+            assert response.status_code == 200
+            assert response.headers["Last-Modified"] == "Thu, 02 May 2024 10:30:15 GMT"
+
+    @pytest.mark.parametrize("view", [geojsonify, geojsonify_stream])
+    def test_compress(self, app, view):
+        data = {"type": "FeatureCollection", "features": [{"id": i} for i in range(100)]}
+        headers = {"Accept-Encoding": "gzip"}
+        with app.test_request_context(headers=headers):
+            response = view(data, etag="abc", compress=True, compression_level=9)
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["ETag"] == '"abc-gzip"'
+            assert "Accept-Encoding" in response.vary
+            # compressed on the fly, the body is never built as a whole
+            assert response.is_streamed
+            assert json.loads(gzip.decompress(response.get_data())) == data
+        with app.test_request_context(headers={**headers, "If-None-Match": '"abc-gzip"'}):
+            assert view(data, etag="abc", compress=True).status_code == 304
+        with app.test_request_context():
+            response = view(data, compress=True)
+            assert "Content-Encoding" not in response.headers
+            assert json.loads(response.get_data()) == data
+
+    @pytest.mark.parametrize("view", [geojsonify, geojsonify_stream])
+    def test_cached_json(self, app, view):
+        data = b'{"type": "FeatureCollection", "features": []}'
+        with app.test_request_context():
+            response = view(CachedJSON(data))
+            assert response.get_data() == data
+            assert response.mimetype == "application/geo+json"
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            response = view(CachedJSON(data), compress=True)
+            assert gzip.decompress(response.get_data()) == data
+
+    def test_compress_args(self, app):
+        with app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+            response = geojsonify(1, 2, compress=True)
+            assert json.loads(gzip.decompress(response.get_data())) == [1, 2]
+            response = geojsonify(type="FeatureCollection", features=[], compress=True)
+            assert json.loads(gzip.decompress(response.get_data())) == {
+                "type": "FeatureCollection",
+                "features": [],
+            }
+            with pytest.raises(TypeError):
+                geojsonify({}, type="FeatureCollection", compress=True)
+
+    @pytest.mark.parametrize(
+        "rfc8142,prefix,mimetype",
+        [(True, "\x1e", "application/geo+json-seq"), (False, "", "application/x-ndjson")],
+    )
+    def test_geojsonseq_stream(self, app, rfc8142, prefix, mimetype):
+        features = [{"type": "Feature", "id": i, "properties": {}} for i in range(3)]
+        with app.test_request_context():
+            response = geojsonseq_stream(
+                lambda: {"type": "FeatureCollection", "features": iter(features)},
+                rfc8142=rfc8142,
+                buffer_size=1,
+            )
+            assert response.mimetype == mimetype
+            assert response.is_streamed
+            lines = response.get_data(as_text=True).split("\n")[:-1]
+        assert [json.loads(line.removeprefix(prefix)) for line in lines] == features
@@ -0,0 +1,194 @@
+import os
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+
+import fiona
+import pytest
+from geoalchemy2 import Geometry
+from geoalchemy2.shape import from_shape
+from shapely.geometry import Point, box
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    Numeric,
+    String,
+    Table,
+    Text,
+)
+from sqlalchemy.dialects.postgresql import UUID
+
+from utils_flask_sqla_geo.utilsgeometry import (
+    FionaGpkgService,
+    FionaShapeService,
+    cluster_grid,
+    fiona_field,
+    geometries_bbox,
+    grid_cell_size,
+)
+
+
+class TestClustering:
+    def test_grid_cell_size(self):
+        assert grid_cell_size(0, cells_per_tile=1) == 360
+        assert grid_cell_size(3) == 5.625
+
+    def test_cluster_grid(self):
+        geometries = [
+            Point(0.1, 0.1),
+            Point(0.3, 0.1),
+            None,
+            Point(5, 5),
+            box(4.9, 4.9, 5.1, 5.1),
+            Point(50, 50),
+        ]
+        clusters = cluster_grid(geometries, 1, bbox=(-1, -1, 10, 10))
+        assert [(centroid.coords[0], count) for centroid, count in clusters] == [
+            (pytest.approx((0.2, 0.1)), 2),
+            (pytest.approx((5, 5)), 2),
+        ]
+        assert len(cluster_grid(geometries, 1000)) == 1
+        assert cluster_grid([None], 1) == []
+
+
+class TestBbox:
+    def test_geometries_bbox(self):
+        geometries = [
+            Point(1, 2),
+            None,
+            box(-1, 0, 0.5, 5),
+            {"type": "Point", "coordinates": [3, 1]},
+        ]
+        assert geometries_bbox(geometries) == [-1.0, 0.0, 3.0, 5.0]
+        assert geometries_bbox([]) is None
+        assert geometries_bbox([None, Point()]) is None
+
+
+class TestFionaShapeService:
+    columns = Table(
+        "observation",
+        MetaData(),
+        Column("pk", Integer, primary_key=True),
+        Column("name", String),
+        Column("geom", Geometry("GEOMETRY", 4326)),
+    ).columns
+
+    def write(self, tmp_path, max_file_size=None):
+        FionaShapeService.create_fiona_struct(
+            self.columns, 4326, str(tmp_path), "export", max_file_size=max_file_size
+        )
+        for i in range(20):
+            # integers up to 1.9e9 (wider than the default dbf width)
+            pk = i * 10**8
+            FionaShapeService.create_feature({"pk": pk, "name": "p"}, from_shape(Point(i, i)))
+            FionaShapeService.create_feature(
+                {"pk": pk, "name": "b"},
+                from_shape(box(0, 0, i + 1, 1).difference(box(0, 0, 0.5, 0.5))),
+            )
+        FionaShapeService.save_files()
+
+    def test_sizes(self, tmp_path):
+        self.write(tmp_path)
+        for shape_format in ("POINT", "POLYGON"):
+            path = tmp_path / f"{shape_format}_export" / f"{shape_format}_export"
+            assert FionaShapeService.sizes[shape_format] == [
+                os.path.getsize(f"{path}.shp"),
+                os.path.getsize(f"{path}.dbf"),
+            ]
+
+    def test_sizes_long_strings(self, tmp_path):
+        FionaShapeService.create_fiona_struct(self.columns, 4326, str(tmp_path), "export")
+        for i in range(5):
+            FionaShapeService.create_feature({"pk": i, "name": "x" * 200}, from_shape(Point(i, i)))
+        FionaShapeService.save_files()
+        path = tmp_path / "POINT_export" / "POINT_export"
+        assert FionaShapeService.sizes["POINT"] == [
+            os.path.getsize(f"{path}.shp"),
+            os.path.getsize(f"{path}.dbf"),
+        ]
+        with fiona.open(f"{path}.shp") as f:
+            assert [feature["properties"]["name"] for feature in f] == ["x" * 200] * 5
+
+    def test_split_parts(self, tmp_path):
+        self.write(tmp_path, max_file_size=1000)
+        assert FionaShapeService.parts == {"POINT": 7, "POLYGON": 7, "POLYLINE": 1}
+        features = {"POINT": 0, "POLYGON": 0}
+        for shape_format in features:
+            for part in range(1, FionaShapeService.parts[shape_format] + 1):
+                name = FionaShapeService.part_name(shape_format, part)
+                for ext in ("shp", "dbf"):
+                    assert os.path.getsize(tmp_path / name / f"{name}.{ext}") <= 1000
+                with fiona.open(tmp_path / name / f"{name}.shp") as f:
+                    features[shape_format] += len(f)
+        assert features == {"POINT": 20, "POLYGON": 20}
+        with zipfile.ZipFile(tmp_path / "export.zip") as zp_file:
+            names = zp_file.namelist()
+        assert "POLYGON_export_part4.shp" in names and "POINT_export.dbf" in names
+        assert len(names) == 4 * 14
+
+
+class TestFionaTypes:
+    @pytest.mark.parametrize(
+        "sql_type,gpkg_type,shp_type",
+        [
+            (Boolean(), "bool", "bool"),
+            (DateTime(), "datetime", "str:32"),
+            (Date(), "date", "date"),
+            (BigInteger(), "int64", "int64"),
+            (Integer(), "int32", "int32:11"),
+            (Numeric(10, 2), "float:10.2", "float:10.2"),
+            (Float(), "float", "float"),
+            (String(20), "str:20", "str:20"),
+            (String(1000), "str:1000", "str:254"),
+            (Text(), "str", "str:254"),
+            (UUID(), "str", "str:254"),
+            (JSON(), "str", "str:254"),
+        ],
+    )
+    def test_fiona_field(self, sql_type, gpkg_type, shp_type):
+        assert fiona_field(sql_type, "GPKG")[0] == gpkg_type
+        assert fiona_field(sql_type, "ESRI Shapefile")[0] == shp_type
+
+    def test_native_gpkg_values(self, tmp_path):
+        columns = Table(
+            "typed",
+            MetaData(),
+            Column("pk", BigInteger, primary_key=True),
+            Column("created", DateTime),
+            Column("day", Date),
+            Column("amount", Numeric(10, 2)),
+            Column("valid", Boolean),
+            Column("extra", JSON),
+            Column("geom", Geometry("POINT", 4326)),
+        ).columns
+        FionaGpkgService.create_fiona_struct(columns, 4326, str(tmp_path), "typed")
+        FionaGpkgService.create_feature(
+            {
+                "pk": 2**40,
+                "created": "2024-05-02 10:30:15",
+                "day": date(2024, 5, 2),
+                "amount": Decimal("12.50"),
+                "valid": True,
+                "extra": {"a": 1},
+            },
+            from_shape(Point(1, 2), srid=4326),
+        )
+        FionaGpkgService.save_files()
+        with fiona.open(tmp_path / "typed.gpkg") as f:
+            assert f.schema["properties"]["valid"] == "bool"
+            properties = dict(next(iter(f))["properties"])
+        assert properties == {
+            "pk": 2**40,
+            "created": datetime(2024, 5, 2, 10, 30, 15).isoformat(),
+            "day": "2024-05-02",
+            "amount": 12.5,
+            "valid": True,
+            "extra": '{"a": 1}',
+        }
@@ -1,6 +1,16 @@
-from flask import jsonify
+import codecs
+import json
+import re
+import zlib
+from collections import OrderedDict, namedtuple
+from datetime import datetime, time, timezone
+from threading import Lock
+
+from flask import current_app, jsonify, request, stream_with_context
 from marshmallow import fields
 
+from .cache import CachedJSON
+
 
 class JsonifiableGenerator(list):
     """
@@ -48,7 +58,464 @@ class GeneratorField(fields.List):
         return result
 
 
-def geojsonify(*args, **kwargs):
-    response = jsonify(*args, **kwargs)
-    response.mimetype = "application/geo+json"
+COMPRESSION_ENCODINGS = ("br", "gzip")
+DEFAULT_COMPRESSION_LEVELS = {"br": 4, "gzip": 6}
+
+
+class StreamCompressor:
+    """
+    Incremental gzip or brotli compressor: data is compressed chunk by chunk
+    as it is produced.
+
+    :param encoding: "gzip" or "br" (requires the optional brotli package)
+    :param level: compression level (gzip: 1-9, brotli: 0-11)
+    """
+
+    def __init__(self, encoding, level=None):
+        if level is None:
+            level = DEFAULT_COMPRESSION_LEVELS.get(encoding)
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._compress = self._compressor.compress
+            self._flush = self._compressor.flush
+        elif encoding == "br":
+            try:
+                import brotli
+            except ImportError:
+                raise ImportError("brotli is required for brotli compression: pip install brotli")
+            self._compressor = brotli.Compressor(quality=level)
+            self._compress = self._compressor.process
+            self._flush = self._compressor.finish
+        else:
+            raise ValueError(f"Unsupported compression '{encoding}'")
+        self.encoding = encoding
+
+    def compress(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self._compress(data)
+
+    def flush(self):
+        return self._flush()
+
+
+def compress_stream(chunks, encoding, level=None):
+    """
+    Compress an iterable of str or bytes chunks, yielding compressed bytes chunks.
+    """
+    compressor = StreamCompressor(encoding, level)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressedWriter:
+    """
+    Text file-like object compressing what is written to it into the binary
+    file object ``fp``. ``close`` must be called to write the end of the stream,
+    ``fp`` itself is not closed.
+    Used as a context manager, the end of the stream is not written when an exception
+    is raised, so that a truncated output fails to decompress instead of looking complete.
+    """
+
+    def __init__(self, fp, encoding, level=None):
+        self.fp = fp
+        self.compressor = StreamCompressor(encoding, level)
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fp.write(compressed)
+        return len(data)
+
+    def close(self):
+        self.fp.write(self.compressor.flush())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def negotiate_encoding(encodings=COMPRESSION_ENCODINGS):
+    """
+    Return the preferred encoding among ``encodings`` accepted by the client
+    of the current request (Accept-Encoding header), or None.
+    Brotli is only proposed when the brotli package is installed.
+    """
+    available = []
+    for encoding in encodings:
+        if encoding == "br":
+            try:
+                import brotli  # noqa: F401
+            except ImportError:
+                continue
+        available.append(encoding)
+    return request.accept_encodings.best_match(available)
+
+
+def _is_not_modified(etag, last_modified):
+    """
+    Check request conditional headers against the given validators.
+    As stated by RFC 9110, If-Modified-Since is ignored when If-None-Match is present.
+    """
+    if etag is not None and request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if last_modified is not None and request.if_modified_since:
+        last_modified = _http_datetime(last_modified)
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _http_datetime(value):
+    """Aware datetime of a last modification date or datetime (naive values are in UTC)."""
+    if not isinstance(value, datetime):
+        # Date column: start of the day
+        value = datetime.combine(value, time.min)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def _set_validators(response, etag, last_modified, encoding=None):
+    if etag is not None:
+        # each encoding is a distinct representation, with its own strong ETag
+        response.set_etag(f"{etag}-{encoding}" if encoding else etag)
+    if last_modified is not None:
+        response.last_modified = _http_datetime(last_modified)
     return response
+
+
+def _prepare_response(etag, last_modified, compress):
+    """
+    Negotiate the response encoding and return (encoding, 304 response if the client
+    copy is still valid else None).
+    """
+    encoding = negotiate_encoding() if compress else None
+    if etag is None and last_modified is None:
+        return encoding, None
+    if not _is_not_modified(f"{etag}-{encoding}" if encoding else etag, last_modified):
+        return encoding, None
+    response = current_app.response_class(status=304)
+    if compress:
+        response.vary.add("Accept-Encoding")
+    return encoding, _set_validators(response, etag, last_modified, encoding)
+
+
+def _compress_response(response, compress, encoding, compression_level):
+    """Compress the (streamed) response body on the fly, if an encoding has been negotiated"""
+    if compress:
+        response.vary.add("Accept-Encoding")
+    if encoding is None:
+        return response
+    response.response = compress_stream(response.response, encoding, compression_level)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def geojsonify(
+    *args, etag=None, last_modified=None, compress=False, compression_level=None, **kwargs
+):
+    """
+    As flask jsonify, with the geojson mimetype.
+
+    When ``etag`` and/or ``last_modified`` (e.g. computed with
+    ``GenericQueryGeo.cache_validators``) are given, they are sent as response headers
+    and a 304 Not Modified response is returned if the client copy is still valid.
+    If the only positional argument is callable, it is called to build the data only
+    when the full response must be sent. A ``cache.CachedJSON`` (cached results) is sent
+    as is, without being decoded and encoded again.
+    When ``compress`` is True, the body is compressed (gzip or brotli) according to
+    the Accept-Encoding request header, with ``compression_level``: the body is then
+    encoded and compressed on the fly by chunks (as by ``geojsonify_stream``), it is
+    never held in memory as a whole.
+    """
+    encoding, response = _prepare_response(etag, last_modified, compress)
+    if response is not None:
+        return response
+    if len(args) == 1 and callable(args[0]):
+        args = (args[0](),)
+    if len(args) == 1 and not kwargs and isinstance(args[0], CachedJSON):
+        response = _stream_response(args[0], STREAM_BUFFER_SIZE)
+    elif encoding is None:
+        response = jsonify(*args, **kwargs)
+        response.mimetype = "application/geo+json"
+    else:
+        if args and kwargs:
+            raise TypeError("geojsonify() behavior undefined when passed both args and kwargs")
+        data = kwargs if not args else args[0] if len(args) == 1 else list(args)
+        response = _stream_response(data, STREAM_BUFFER_SIZE)
+    response = _compress_response(response, compress, encoding, compression_level)
+    return _set_validators(response, etag, last_modified, encoding)
+
+
+# minimal size of the chunks of streamed responses
+STREAM_BUFFER_SIZE = 65536
+
+
+def _stream_response(data, buffer_size):
+    if isinstance(data, CachedJSON):
+        # already serialized (cache hit): sent as is
+        return current_app.response_class([data.data], mimetype="application/geo+json")
+    encoder = json.JSONEncoder(default=current_app.json.default, ensure_ascii=False)
+    return current_app.response_class(
+        stream_with_context(_buffered(encoder.iterencode(data), buffer_size)),
+        mimetype="application/geo+json",
+    )
+
+
+def geojsonify_stream(
+    data,
+    etag=None,
+    last_modified=None,
+    buffer_size=STREAM_BUFFER_SIZE,
+    compress=False,
+    compression_level=None,
+):
+    """
+    Streaming counterpart of geojsonify: the response body is encoded on the fly,
+    so features given as generator (e.g. ``JsonifiableGenerator``) are never
+    fully loaded in memory.
+
+    :param data: data to encode, or a callable returning it (called only
+        when the full response must be sent). A ``cache.CachedJSON`` is sent as is.
+    :param etag: strong ETag of the data
+    :param last_modified: last modification datetime of the data
+    :param buffer_size: minimal size of the chunks sent to the client
+    :param compress: compress each chunk (gzip or brotli, negotiated from the
+        Accept-Encoding request header)
+    :param compression_level: compression level
+    """
+    encoding, response = _prepare_response(etag, last_modified, compress)
+    if response is not None:
+        return response
+    if callable(data):
+        data = data()
+    response = _stream_response(data, buffer_size)
+    response = _compress_response(response, compress, encoding, compression_level)
+    return _set_validators(response, etag, last_modified, encoding)
+
+
+GEOJSONSEQ_SEPARATOR = "\x1e"
+
+
+def geojsonseq_stream(
+    features,
+    etag=None,
+    last_modified=None,
+    buffer_size=STREAM_BUFFER_SIZE,
+    compress=False,
+    compression_level=None,
+    rfc8142=True,
+):
+    """
+    Streaming response of features, one feature per line: GeoJSON Text Sequence
+    (RFC 8142, application/geo+json-seq) or newline delimited JSON
+    (``rfc8142=False``, application/x-ndjson).
+
+    :param features: iterable of features (e.g. the ``features`` of a
+        ``GeoAlchemyAutoSchema`` dump), a FeatureCollection, or a callable
+        returning one of them
+    :param rfc8142: prefix each feature with the record separator
+    See geojsonify_stream for other parameters.
+    """
+    encoding, response = _prepare_response(etag, last_modified, compress)
+    if response is not None:
+        return response
+    if callable(features):
+        features = features()
+    if isinstance(features, dict):
+        features = features["features"]
+    encoder = json.JSONEncoder(default=current_app.json.default, ensure_ascii=False)
+    prefix = GEOJSONSEQ_SEPARATOR if rfc8142 else ""
+    lines = (prefix + encoder.encode(feature) + "\n" for feature in features)
+    response = current_app.response_class(
+        stream_with_context(_buffered(lines, buffer_size)),
+        mimetype="application/geo+json-seq" if rfc8142 else "application/x-ndjson",
+    )
+    response = _compress_response(response, compress, encoding, compression_level)
+    return _set_validators(response, etag, last_modified, encoding)
+
+
+def _buffered(chunks, buffer_size):
+    """Group small str chunks into chunks of at least buffer_size characters"""
+    buffer, size = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of bounded size, with hit/miss counters
+    (same ``cache_info`` as ``functools.lru_cache``).
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, factory):
+        """Return value cached for ``key``, calling ``factory()`` to build it if missing."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+        # build outside the lock: concurrent misses may build twice, first one wins
+        value = factory()
+        with self._lock:
+            value = self._data.setdefault(key, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def cache_info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+class JSONStreamReader:
+    """
+    Incremental reader of a JSON document from a file-like object (text or binary).
+
+    Only the current value is kept in memory: it allows iterating over the items
+    of a (possibly huge) array without parsing the whole document first.
+    """
+
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+    literals = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+    # end of a number cut by the end of the buffer (e.g. "1." or "1e+")
+    number_end = re.compile(r"\.|[eE][-+]?")
+
+    def __init__(self, fp, chunk_size=65536):
+        if isinstance(fp.read(0), bytes):
+            fp = codecs.getreader("utf-8")(fp)
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None):
+        chunk = self.fp.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return next non-whitespace character (without consuming it), or None at EOF."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in self.whitespace:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return None
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expecting '{char}', found {found!r}")
+        self.pos += 1
+
+    def read_value(self):
+        """Decode next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                # the value may be truncated by the end of the buffer: read more data
+                # and retry, other errors are raised without reading the rest of the source
+                if self.eof or not self._is_truncated(error):
+                    raise
+                # grow reads to avoid decoding large values too many times
+                self._fill(max(self.chunk_size, len(self.buffer) - self.pos))
+                continue
+            if end == len(self.buffer) and not self.eof:
+                # e.g. numbers may continue in the next chunk
+                if self._fill():
+                    continue
+            self.pos = end
+            return value
+
+    def _is_truncated(self, error):
+        """Whether a decoding error may come from the end of the buffer."""
+        if error.msg.startswith("Unterminated string"):
+            # the decoder has reached the end of the buffer without finding the closing quote
+            return True
+        rest = self.buffer[error.pos :]
+        if error.msg.startswith("Invalid \\uXXXX escape"):
+            # escape at the end of the buffer ("uXXXX" included: the decoder expects more)
+            return len(rest) <= 5
+        rest = rest.lstrip(self.whitespace)
+        # start of a literal (e.g. "tru" or "-", an empty rest included)
+        if any(literal.startswith(rest) for literal in self.literals):
+            return True
+        return self.number_end.fullmatch(rest) is not None
+
+    def iter_array(self):
+        """Iterate over the items of the JSON array starting at current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+    def iter_object(self):
+        """
+        Iterate over ``(key, reader)`` members of the JSON object starting at current position.
+        For each member, caller must consume the value with ``read_value`` or ``iter_array``
+        before resuming iteration.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"Expecting property name, found {key!r}")
+            self.expect(":")
+            yield key, self
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
@@ -2,14 +2,33 @@ import ast
 
 from abc import ABC, abstractmethod
 from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
 
 import zipfile
 import fiona
 import logging
 import json
+from datetime import datetime
+from warnings import warn
 
+import numpy as np
+import shapely
 from fiona.crs import from_epsg
+from geoalchemy2.elements import WKBElement, WKTElement
 from geoalchemy2.shape import to_shape
+from geojson.geometry import Geometry as GeoJSONGeometry, DEFAULT_PRECISION
+from sqlalchemy.types import (
+    BigInteger,
+    Boolean,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    Numeric,
+    String,
+    Time,
+)
 from shapely.geometry import (
     mapping,
     shape,
@@ -27,7 +46,8 @@ from utils_flask_sqla.errors import UtilsSqlaError
 
 # Creation des shapefiles avec la librairies fiona
 
-FIONA_MAPPING = {
+# Obsolète (plus utilisé, cf FIONA_TYPES et fiona_field) : conservé pour compatibilité
+_FIONA_MAPPING = {
     "date": "str",
     "datetime": "str",
     "time": "str",
@@ -46,9 +66,220 @@ FIONA_MAPPING = {
     "json": "str",
 }
 
+
+def __getattr__(name):
+    if name == "FIONA_MAPPING":
+        warn(
+            "'FIONA_MAPPING' is deprecated. Please use 'fiona_field' instead.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return _FIONA_MAPPING
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Types fiona natifs des colonnes, selon la classe du type SQLAlchemy
+# (la première classe correspondante est retenue, les autres types sont exportés en texte)
+FIONA_TYPES = (
+    (Boolean, "bool"),
+    (DateTime, "datetime"),
+    (Date, "date"),
+    (Time, "time"),
+    (BigInteger, "int64"),
+    (Integer, "int32"),
+    (Numeric, "float"),
+    (String, "str"),
+)
+# Types non supportés par les drivers
+FIONA_UNSUPPORTED_TYPES = {
+    "ESRI Shapefile": {"datetime", "time"},
+    "GPKG": {"time"},
+}
+# Taille maximum des champs texte d'un shapefile
+DBF_MAX_STR_WIDTH = 254
+# Taille des dates et heures exportées en texte (ISO 8601, microsecondes et fuseau compris)
+ISO_DATETIME_WIDTH = 32
+# Largeur des champs entiers 32 bits d'un shapefile, signe compris (-2147483648) :
+# la largeur par défaut (9) ne permet pas d'écrire les valeurs à partir de 1e9
+DBF_INT32_WIDTH = 11
+
+# Options GDAL appliquées à l'ouverture d'un geopackage en mode écriture en masse :
+# journalisation et écritures synchrones désactivées, cache SQLite augmenté (Mo)
+GPKG_BULK_CONFIG = {
+    "OGR_SQLITE_JOURNAL": "OFF",
+    "OGR_SQLITE_SYNCHRONOUS": "OFF",
+    "OGR_SQLITE_CACHE": "512",
+}
+
 log = logging.getLogger()
 
 
+def open_gpkg(filename, schema, crs, bulk=False, spatial_index=True, **kwargs):
+    """
+    Ouvre un geopackage en écriture
+
+    Parameters:
+        filename (str): chemin du fichier
+        schema (dict): schéma fiona
+        crs: système de coordonnées fiona
+        bulk (bool): mode écriture en masse (cf GPKG_BULK_CONFIG)
+        spatial_index (bool): création de l'index spatial. Il est construit
+            par GDAL en une fois à la fermeture du fichier
+        kwargs: autres options fiona (layer, etc.)
+    """
+    if not spatial_index:
+        kwargs["SPATIAL_INDEX"] = "NO"
+    if bulk:
+        # les options sont lues par GDAL à l'ouverture de la base SQLite
+        with fiona.Env(**GPKG_BULK_CONFIG):
+            return fiona.open(filename, "w", "GPKG", schema, crs=crs, **kwargs)
+    return fiona.open(filename, "w", "GPKG", schema, crs=crs, **kwargs)
+
+
+def write_records(collection, records, chunk_size=10000):
+    """
+    Ecrit les enregistrements par lots : fiona écrit chaque lot dans une seule transaction
+    (alors que collection.write fait une transaction par enregistrement)
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        collection.writerecords(chunk)
+
+
+# A .shp or .dbf file cannot exceed 2 GB (32 bits offsets)
+SHAPEFILE_MAX_SIZE = 2 * 1024**3 - 1
+SHP_HEADER_SIZE = 100
+# default width of the dbf fields by fiona type (see fiona/GDAL)
+DBF_FIELD_WIDTHS = {
+    "str": 80,
+    "int": 18,
+    "int64": 18,
+    "int32": 9,
+    "float": 24,
+    "date": 8,
+    "bool": 1,
+}
+# shape format: (collection attribute, "has features" attribute, schema attribute)
+SHAPE_FORMATS = {
+    "POINT": ("point_shape", "point_feature", "point_schema"),
+    "POLYGON": ("polygone_shape", "polygon_feature", "polygon_schema"),
+    "POLYLINE": ("polyline_shape", "polyline_feature", "polyline_schema"),
+}
+
+
+def dbf_header_size(properties):
+    # header, field descriptors, terminator and end of file marker
+    return 32 + 32 * len(properties) + 2
+
+
+def dbf_record_size(properties):
+    """
+    Size of a dbf record for fiona properties ({name: "type[:width[.precision]]"})
+    """
+    size = 1  # deletion flag
+    for field_type in properties.values():
+        field_type, _, width = field_type.partition(":")
+        size += int(width.split(".")[0]) if width else DBF_FIELD_WIDTHS.get(field_type, 80)
+    return size
+
+
+def shp_record_size(geom):
+    """
+    Size of the .shp record (header included) of a point, line or polygon geometry
+    (points are written as multipoints)
+    """
+    points = int(shapely.get_num_coordinates(geom))
+    if geom.geom_type in ("Point", "MultiPoint"):
+        # type, bbox, number of points
+        return 8 + 40 + 16 * points
+    parts = shapely.get_parts(geom)
+    if geom.geom_type in ("Polygon", "MultiPolygon"):
+        parts = shapely.get_rings(parts)
+    # type, bbox, number of parts, number of points, parts index
+    return 8 + 44 + 4 * len(parts) + 16 * points
+
+
+def _to_str(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_datetime(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+FIONA_CONVERTERS = {
+    "str": _to_str,
+    "datetime": _to_datetime,
+    "float": float,
+}
+
+
+def fiona_field(sql_type, driver="GPKG"):
+    """
+    Renvoie le type fiona (avec largeur et précision le cas échéant) d'une colonne
+    et la fonction de conversion de ses valeurs (None si aucune conversion n'est nécessaire)
+
+    Parameters:
+        sql_type (TypeEngine): type SQLAlchemy de la colonne
+        driver (str): driver fiona ("GPKG" ou "ESRI Shapefile")
+    """
+    fiona_type = next((t for cls, t in FIONA_TYPES if isinstance(sql_type, cls)), "str")
+    unsupported = fiona_type in FIONA_UNSUPPORTED_TYPES.get(driver, ())
+    if unsupported:
+        fiona_type = "str"
+
+    converter = FIONA_CONVERTERS.get(fiona_type)
+    if isinstance(sql_type, String) or (isinstance(sql_type, Float) and not sql_type.asdecimal):
+        # valeurs déjà du type attendu
+        converter = None
+
+    width = None
+    if unsupported:
+        # dates et heures exportées en texte
+        width = ISO_DATETIME_WIDTH
+    elif fiona_type == "str" and getattr(sql_type, "length", None):
+        width = sql_type.length
+        if driver == "ESRI Shapefile":
+            width = min(width, DBF_MAX_STR_WIDTH)
+    elif fiona_type == "str" and driver == "ESRI Shapefile":
+        # sans largeur, GDAL élargit le champ lors de l'écriture de valeurs plus longues
+        # que la largeur par défaut (80) : la taille des enregistrements ne serait plus connue
+        width = DBF_MAX_STR_WIDTH
+    elif fiona_type == "float" and not isinstance(sql_type, Float) and sql_type.precision:
+        width = f"{sql_type.precision}.{sql_type.scale or 0}"
+    elif fiona_type == "int32" and driver == "ESRI Shapefile":
+        width = DBF_INT32_WIDTH
+    if width is not None:
+        fiona_type = f"{fiona_type}:{width}"
+    return fiona_type, converter
+
+
+def properties_converter(converters):
+    """
+    Compile une fonction convertissant (sur place) les valeurs d'un dictionnaire de propriétés
+    à partir des fonctions de conversion des colonnes ({nom: fonction ou None})
+    """
+    items = [(key, converter) for key, converter in converters.items() if converter is not None]
+
+    def convert(properties):
+        for key, converter in items:
+            value = properties.get(key)
+            if value is not None:
+                properties[key] = converter(value)
+        return properties
+
+    return convert
+
+
 class FionaService(ABC):
     """
     Abstract class to provide functions to create geofiles with Fiona
@@ -62,7 +293,9 @@ class FionaService(ABC):
     supported_type = ("shp", "gpkg")
 
     @classmethod
-    def create_fiona_properties(cls, db_cols, srid, dir_path, file_name, col_mapping=None):
+    def create_fiona_properties(
+        cls, db_cols, srid, dir_path, file_name, col_mapping=None, target_srid=None
+    ):
         """
         Create three shapefiles (point, line, polygon) with the attributes give by db_cols
         Parameters:
@@ -72,31 +305,37 @@ class FionaService(ABC):
             file_name (str): file of the shapefiles
             col_mapping (dict): mapping between SQLA class
                             attributes and 'beatifiul' columns name
+            target_srid (int): epsg code of the files, if geometries must be reprojected
 
         Returns:
             void
         """
         cls.db_cols = db_cols
-        cls.source_crs = from_epsg(srid)
+        cls.srid = srid
+        cls.target_srid = target_srid or srid
+        cls.source_crs = from_epsg(cls.target_srid)
         cls.dir_path = dir_path
         cls.file_name = file_name
         cls.columns = []
         # if we want to change to columns name of the SQLA class
         # in the export shapefiles structures
         cls.shp_properties = OrderedDict()
+        cls.converters = {}
         if col_mapping:
             for db_col in db_cols:
                 cls.add_fiona_col_mapping(col_mapping.get(db_col.key), db_col)
         else:
             for db_col in db_cols:
                 cls.add_fiona_col_mapping(db_col.key, db_col)
+        cls.convert_properties = staticmethod(properties_converter(cls.converters))
 
     @classmethod
     def add_fiona_col_mapping(cls, key, db_col):
         if not db_col.type.__class__.__name__ == "Geometry":
-            cls.shp_properties.update(
-                {key: FIONA_MAPPING.get(db_col.type.__class__.__name__.lower(), "str")}
-            )
+            driver = "ESRI Shapefile" if getattr(cls, "export_type", None) == "shp" else "GPKG"
+            fiona_type, converter = fiona_field(db_col.type, driver)
+            cls.shp_properties.update({key: fiona_type})
+            cls.converters[key] = converter
             cls.columns.append(key)
 
     @classmethod
@@ -178,8 +417,13 @@ class FionaService(ABC):
                 geom_geojson = geom
             else:
                 geom_wkt = to_shape(geom)
+                geom_geojson = None
+            if cls.target_srid != cls.srid:
+                geom_wkt = reproject(geom_wkt, cls.srid, cls.target_srid)
+                geom_geojson = None
+            if geom_geojson is None:
                 geom_geojson = mapping(geom_wkt)
-            feature = {"geometry": geom_geojson, "properties": data}
+            feature = {"geometry": geom_geojson, "properties": cls.convert_properties(data)}
             cls.write_a_feature(feature, geom_wkt)
         except AssertionError:
             # TODO déplacer car le fichier est fermé à la moindre erreur
@@ -192,7 +436,9 @@ class FionaService(ABC):
 
     @classmethod
     @abstractmethod
-    def create_fiona_struct(cls, db_cols, srid, dir_path, file_name, col_mapping=None):
+    def create_fiona_struct(
+        cls, db_cols, srid, dir_path, file_name, col_mapping=None, target_srid=None
+    ):
         pass
 
     @classmethod
@@ -219,23 +465,43 @@ class FionaGpkgService(FionaService):
     FionaShapeService.create_shapes_struct(**args)
     FionaShapeService.create_features(**args)
     FionaShapeService.save_and_zip_shapefiles()
+
+    In bulk mode (``bulk=True``), features are buffered and written by chunks of
+    ``bulk_size`` in large transactions, with SQLite journaling and synchronous
+    writes disabled (see GPKG_BULK_CONFIG).
     """
 
     @classmethod
-    def create_fiona_struct(cls, db_cols, srid, dir_path, file_name, col_mapping=None):
+    def create_fiona_struct(
+        cls,
+        db_cols,
+        srid,
+        dir_path,
+        file_name,
+        col_mapping=None,
+        target_srid=None,
+        bulk=False,
+        bulk_size=10000,
+        spatial_index=True,
+    ):
         cls.export_type = "gpkg"
-        cls.create_fiona_properties(db_cols, srid, dir_path, file_name, col_mapping)
+        cls.create_fiona_properties(
+            db_cols, srid, dir_path, file_name, col_mapping, target_srid=target_srid
+        )
 
         cls.gpkg_schema = {"geometry": "Unknown", "properties": cls.shp_properties}
 
         cls.filename_gpkg = cls.dir_path + "/" + cls.file_name + ".gpkg"
 
-        cls.gpkg_file = fiona.open(
+        cls.bulk = bulk
+        cls.bulk_size = bulk_size
+        cls.buffer = []
+        cls.gpkg_file = open_gpkg(
             cls.filename_gpkg,
-            "w",
-            "GPKG",
             cls.gpkg_schema,
             crs=cls.source_crs,
+            bulk=bulk,
+            spatial_index=spatial_index,
         )
 
     @classmethod
@@ -243,7 +509,21 @@ class FionaGpkgService(FionaService):
         """
         write a feature by checking the type of the shape given
         """
-        cls.gpkg_file.write(feature)
+        if cls.bulk:
+            cls.buffer.append(feature)
+            if len(cls.buffer) >= cls.bulk_size:
+                cls.flush()
+        else:
+            cls.gpkg_file.write(feature)
+
+    @classmethod
+    def flush(cls):
+        """
+        Write buffered features (bulk mode)
+        """
+        if cls.buffer:
+            cls.gpkg_file.writerecords(cls.buffer)
+            cls.buffer = []
 
     @classmethod
     def save_files(cls):
@@ -262,7 +542,12 @@ class FionaGpkgService(FionaService):
         """
         Save the files
         """
-        cls.gpkg_file.close()
+        try:
+            if not cls.gpkg_file.closed:
+                cls.flush()
+        finally:
+            cls.buffer = []
+            cls.gpkg_file.close()
 
 
 class FionaShapeService(FionaService):
@@ -277,7 +562,15 @@ class FionaShapeService(FionaService):
 
     @classmethod
     def create_fiona_struct(
-        cls, db_cols, srid, dir_path, file_name, col_mapping=None, encoding="utf-8"
+        cls,
+        db_cols,
+        srid,
+        dir_path,
+        file_name,
+        col_mapping=None,
+        encoding="utf-8",
+        target_srid=None,
+        max_file_size=None,
     ):
         """
         Create three shapefiles (point, line, polygon) with the attributes give by db_cols
@@ -288,6 +581,9 @@ class FionaShapeService(FionaService):
             file_name (str): file of the shapefiles
             col_mapping (dict): mapping between SQLA class attributes and 'beatifiul' columns name
             encoding (str): define encoding of data to store in Shape. Default: utf-8.
+            target_srid (int): epsg code of the shapefiles, if geometries must be reprojected
+            max_file_size (int): maximum size (bytes) of a .shp or .dbf file; above, features are
+                written in a new shapefile ("POLYGON_<file_name>_part2", ...). Default: 2 GB.
 
 
         Returns:
@@ -295,7 +591,9 @@ class FionaShapeService(FionaService):
         """
         cls.export_type = "shp"
         # Création structure des proprités fiona
-        cls.create_fiona_properties(db_cols, srid, dir_path, file_name, col_mapping)
+        cls.create_fiona_properties(
+            db_cols, srid, dir_path, file_name, col_mapping, target_srid=target_srid
+        )
 
         cls.polygon_schema = {
             "geometry": ["Polygon", "MultiPolygon"],
@@ -310,6 +608,12 @@ class FionaShapeService(FionaService):
             "properties": cls.shp_properties,
         }
 
+        cls.encoding = encoding
+        cls.max_file_size = max_file_size or SHAPEFILE_MAX_SIZE
+        cls.dbf_record_size = dbf_record_size(cls.shp_properties)
+        # number of files (parts) and size of the current part files by shape format
+        cls.parts = {shape_format: 1 for shape_format in SHAPE_FORMATS}
+        cls.sizes = {}
         cls.file_point = cls.dir_path + "/POINT_" + cls.file_name
         cls.file_poly = cls.dir_path + "/POLYGON_" + cls.file_name
         cls.file_line = cls.dir_path + "/POLYLINE_" + cls.file_name
@@ -317,33 +621,59 @@ class FionaShapeService(FionaService):
         cls.point_feature = False
         cls.polygon_feature = False
         cls.polyline_feature = False
-        cls.point_shape = fiona.open(
-            cls.file_point,
-            "w",
-            "ESRI Shapefile",
-            cls.point_schema,
-            crs=cls.source_crs,
-            encoding=encoding,
-        )
-        cls.polygone_shape = fiona.open(
-            cls.file_poly,
-            "w",
-            "ESRI Shapefile",
-            cls.polygon_schema,
-            crs=cls.source_crs,
-            encoding=encoding,
-        )
-        cls.polyline_shape = fiona.open(
-            cls.file_line,
+        for shape_format in SHAPE_FORMATS:
+            cls.open_shape(shape_format)
+
+    # TODO mark as deprecated
+    create_shapes_struct = create_fiona_struct
+
+    @classmethod
+    def part_name(cls, shape_format, part):
+        """
+        Name of a shapefile: <shape_format>_<file_name>[_part<part>]
+        """
+        name = shape_format + "_" + cls.file_name
+        return name if part == 1 else f"{name}_part{part}"
+
+    @classmethod
+    def open_shape(cls, shape_format):
+        """
+        Open the current part of the shapefile of the given format
+        and reset its size counters
+        """
+        shape_attr, _, schema_attr = SHAPE_FORMATS[shape_format]
+        collection = fiona.open(
+            cls.dir_path + "/" + cls.part_name(shape_format, cls.parts[shape_format]),
             "w",
             "ESRI Shapefile",
-            cls.polyline_schema,
+            getattr(cls, schema_attr),
             crs=cls.source_crs,
-            encoding=encoding,
+            encoding=cls.encoding,
         )
+        setattr(cls, shape_attr, collection)
+        cls.sizes[shape_format] = [SHP_HEADER_SIZE, dbf_header_size(cls.shp_properties)]
 
-    # TODO mark as deprecated
-    create_shapes_struct = create_fiona_struct
+    @classmethod
+    def write_shape(cls, shape_format, feature, geom_wkt):
+        """
+        Write the feature in the shapefile of the given format, rolling over
+        to a new part if the .shp or .dbf file would exceed max_file_size
+        """
+        shape_attr, feature_attr, _ = SHAPE_FORMATS[shape_format]
+        sizes = cls.sizes[shape_format]
+        shp_size = shp_record_size(geom_wkt)
+        if getattr(cls, feature_attr) and (
+            sizes[0] + shp_size > cls.max_file_size
+            or sizes[1] + cls.dbf_record_size > cls.max_file_size
+        ):
+            getattr(cls, shape_attr).close()
+            cls.parts[shape_format] += 1
+            cls.open_shape(shape_format)
+            sizes = cls.sizes[shape_format]
+        getattr(cls, shape_attr).write(feature)
+        sizes[0] += shp_size
+        sizes[1] += cls.dbf_record_size
+        setattr(cls, feature_attr, True)
 
     @classmethod
     def write_a_feature(cls, feature, geom_wkt):
@@ -353,19 +683,15 @@ class FionaShapeService(FionaService):
         if isinstance(geom_wkt, Point):
             # Transform point as multipoint :
             #   In shape file point and multipoint canot be mixed
-            geom_geojson = mapping(MultiPoint([geom_wkt]))
-            feature["geometry"] = geom_geojson
-            cls.point_shape.write(feature)
-            cls.point_feature = True
+            geom_wkt = MultiPoint([geom_wkt])
+            feature["geometry"] = mapping(geom_wkt)
+            cls.write_shape("POINT", feature, geom_wkt)
         elif isinstance(geom_wkt, MultiPoint):
-            cls.point_shape.write(feature)
-            cls.point_feature = True
+            cls.write_shape("POINT", feature, geom_wkt)
         elif isinstance(geom_wkt, Polygon) or isinstance(geom_wkt, MultiPolygon):
-            cls.polygone_shape.write(feature)
-            cls.polygon_feature = True
+            cls.write_shape("POLYGON", feature, geom_wkt)
         elif isinstance(geom_wkt, LineString) or isinstance(geom_wkt, MultiLineString):
-            cls.polyline_shape.write(feature)
-            cls.polyline_feature = True
+            cls.write_shape("POLYLINE", feature, geom_wkt)
 
     @classmethod
     def save_files(cls):
@@ -391,20 +717,14 @@ class FionaShapeService(FionaService):
         zp_file = zipfile.ZipFile(zip_path, mode="w")
 
         for shape_format in format_to_save:
-            final_file_name = cls.dir_path + "/" + shape_format + "_" + cls.file_name
-            final_file_name = (
-                "{dir_path}/{shape_format}_{file_name}/{shape_format}_{file_name}".format(
-                    dir_path=cls.dir_path,
-                    shape_format=shape_format,
-                    file_name=cls.file_name,
-                )
-            )
-            extentions = ("dbf", "shx", "shp", "prj")
-            for ext in extentions:
-                zp_file.write(
-                    final_file_name + "." + ext,
-                    shape_format + "_" + cls.file_name + "." + ext,
+            for part in range(1, cls.parts[shape_format] + 1):
+                part_name = cls.part_name(shape_format, part)
+                final_file_name = "{dir_path}/{part_name}/{part_name}".format(
+                    dir_path=cls.dir_path, part_name=part_name
                 )
+                extentions = ("dbf", "shx", "shp", "prj")
+                for ext in extentions:
+                    zp_file.write(final_file_name + "." + ext, part_name + "." + ext)
         zp_file.close()
 
     # TODO mark as deprecated
@@ -565,3 +885,183 @@ def remove_third_dimension(geom):
         raise RuntimeError(
             "Currently this type of geometry is not supported: {}".format(type(geom))
         )
+
+
+def elements_to_shapes(elements):
+    """
+    Décode un lot de géométries geoalchemy (WKBElement, WKTElement) en géométries shapely
+
+    Le décodage des WKB est fait en un seul appel vectorisé à ``shapely.from_wkb``.
+    Les valeurs ``None`` sont conservées, les géométries shapely sont renvoyées telles quelles.
+
+    Parameters:
+        elements (iterable): géométries à décoder
+    Returns:
+        numpy.ndarray: tableau de géométries shapely (ou None)
+    """
+    elements = list(elements)
+    shapes = np.empty(len(elements), dtype=object)
+    wkb_idx, wkb_data = [], []
+    for i, element in enumerate(elements):
+        if isinstance(element, WKBElement):
+            wkb_idx.append(i)
+            data = element.data
+            wkb_data.append(data if isinstance(data, str) else bytes(data))
+        elif isinstance(element, WKTElement):
+            shapes[i] = to_shape(element)
+        else:
+            shapes[i] = element
+    if wkb_idx:
+        shapes[wkb_idx] = shapely.from_wkb(np.array(wkb_data, dtype=object))
+    return shapes
+
+
+def repair_geometries(geometries):
+    """
+    Répare un tableau de géométries shapely invalides, en un seul appel vectorisé
+    à ``shapely.make_valid``
+
+    Le type de géométrie est conservé : quand la réparation produit une collection,
+    ou une géométrie de dimension différente, seuls les éléments de la dimension d'origine
+    sont gardés (ex : les lignes ou points isolés issus d'un polygone sont supprimés).
+    Une géométrie irréparable est renvoyée vide.
+
+    Parameters:
+        geometries: tableau (numpy) de géométries shapely
+    Returns:
+        numpy.ndarray: géométries réparées
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    repaired = shapely.make_valid(geometries)
+    dimensions = shapely.get_dimensions(geometries)
+    changed = np.flatnonzero(
+        (shapely.get_type_id(repaired) == shapely.GeometryType.GEOMETRYCOLLECTION)
+        | (shapely.get_dimensions(repaired) != dimensions)
+    )
+    for i in changed:
+        parts = shapely.get_parts(repaired[i])
+        repaired[i] = shapely.union_all(parts[shapely.get_dimensions(parts) == dimensions[i]])
+    return repaired
+
+
+def geometries_bbox(geometries):
+    """
+    Renvoie l'emprise [xmin, ymin, xmax, ymax] d'un ensemble de géométries
+    avec ``shapely.total_bounds`` (les géométries geojson sont d'abord converties
+    une à une en géométries shapely)
+
+    Parameters:
+        geometries (iterable): géométries shapely ou geojson (dict), None acceptées
+    Returns:
+        list: emprise, ou None s'il n'y a aucune géométrie
+    """
+    geometries = [
+        shape(geom) if isinstance(geom, dict) else geom for geom in geometries if geom is not None
+    ]
+    if not geometries:
+        return None
+    shapes = np.empty(len(geometries), dtype=object)
+    shapes[:] = geometries
+    bounds = shapely.total_bounds(shapes)
+    if np.isnan(bounds).any():  # géométries vides
+        return None
+    return bounds.tolist()
+
+
+def shape_to_geojson(geom, precision=DEFAULT_PRECISION):
+    """
+    Renvoie la géométrie geojson (dict) d'une géométrie shapely
+
+    Les coordonnées sont arrondies comme le fait la librairie geojson,
+    sans passer par la construction (et la validation) d'un objet geojson.
+    Comme avec la librairie geojson, une géométrie vide (ou None) donne None.
+    """
+    if geom is None or geom.is_empty:
+        return None
+    mapping = geom.__geo_interface__
+    if "coordinates" not in mapping:  # GeometryCollection : laissée telle quelle par geojson
+        return mapping
+    return {
+        "type": mapping["type"],
+        "coordinates": GeoJSONGeometry.clean_coordinates(mapping["coordinates"], precision),
+    }
+
+
+@lru_cache(maxsize=None)
+def get_transformer(source_srid, target_srid):
+    """
+    Renvoie le Transformer pyproj (mis en cache pour tout le processus)
+    entre deux codes EPSG, avec l'ordre des axes x, y
+    """
+    try:
+        from pyproj import Transformer
+    except ImportError as error:
+        raise ImportError(
+            "Reprojection needs the optional pyproj dependency. "
+            "Please install it with 'pip install utils-flask-sqlalchemy-geo[pyproj]'."
+        ) from error
+    return Transformer.from_crs(f"EPSG:{source_srid}", f"EPSG:{target_srid}", always_xy=True)
+
+
+def reproject(geometries, source_srid, target_srid):
+    """
+    Reprojette une géométrie shapely ou un tableau de géométries
+
+    Les coordonnées de toutes les géométries sont transformées en un seul appel
+    à pyproj (via shapely.transform). Les valeurs None sont conservées,
+    les géométries reprojetées sont en 2D.
+
+    Parameters:
+        geometries: géométrie shapely ou tableau (numpy) de géométries
+        source_srid (int): code epsg des géométries
+        target_srid (int): code epsg de destination
+    """
+    if not target_srid or source_srid == target_srid:
+        return geometries
+    transformer = get_transformer(source_srid, target_srid)
+
+    def transform(coords):
+        if len(coords) == 1:
+            # pyproj traite un tableau de taille 1 comme un scalaire
+            return np.array([transformer.transform(*coords[0])])
+        return np.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+    return shapely.transform(geometries, transform)
+
+
+def grid_cell_size(zoom, cells_per_tile=8):
+    """
+    Taille (en degrés) des cellules de regroupement pour un niveau de zoom :
+    une tuile de niveau zoom couvre 360 / 2^zoom degrés de longitude
+    """
+    return 360 / (2**zoom) / cells_per_tile
+
+
+def cluster_grid(geometries, cell_size, bbox=None):
+    """
+    Regroupe des géométries (en 4326) par cellules d'une grille régulière,
+    comme GenericQueryGeo.as_clusters côté PostGIS
+
+    Le centroïde de chaque géométrie est affecté à la cellule floor(x / cell_size + 0.5)
+    (np.round arrondit les demis au pair, round() de PostgreSQL à l'opposé de zéro).
+
+    Parameters:
+        geometries: tableau de géométries shapely (None ignorés)
+        cell_size (float): taille des cellules
+        bbox (tuple): (xmin, ymin, xmax, ymax), seules les géométries l'intersectant sont gardées
+    Returns:
+        list: (centroïde (Point shapely), nombre de géométries) de chaque cellule non vide
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    geometries = geometries[~shapely.is_missing(geometries)]
+    if bbox is not None:
+        geometries = geometries[shapely.intersects(geometries, shapely.box(*bbox))]
+    if not len(geometries):
+        return []
+    coords = shapely.get_coordinates(shapely.centroid(geometries))
+    cells = np.floor(coords / cell_size + 0.5)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    x = np.bincount(inverse, weights=coords[:, 0]) / counts
+    y = np.bincount(inverse, weights=coords[:, 1]) / counts
+    return list(zip(shapely.points(x, y), counts.tolist()))